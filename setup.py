@@ -60,6 +60,7 @@ setup(name='user-sync',
       extras_require={
           ':python_version<"3"':[
               'zipp==1.1.0',
+              'futures',
           ],
           ':sys_platform=="linux" or sys_platform=="linux2"': [
               'secretstorage',
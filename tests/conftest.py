@@ -1,4 +1,5 @@
 import logging
+import multiprocessing
 import os
 
 import pytest
@@ -33,6 +34,20 @@ def cli_args():
     return _cli_args
 
 
+@pytest.fixture
+def spawn_start_method():
+    """
+    Start worker processes the way they are started on Windows and by the frozen exe, which
+    don't share anything with the parent process.
+    """
+    if not hasattr(multiprocessing, 'set_start_method'):
+        pytest.skip("the start method can't be chosen in this Python version")
+    start_method = multiprocessing.get_start_method()
+    multiprocessing.set_start_method('spawn', force=True)
+    yield
+    multiprocessing.set_start_method(start_method, force=True)
+
+
 @pytest.fixture
 def log_stream():
     stream = ClearableStringIO()
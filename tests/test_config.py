@@ -274,6 +274,11 @@ class TestConfigLoader():
             'directory_group': 'DIR-2',
             'adobe_groups': ['GRP-2.1', 'GRP-2.2']}])
         modify_root_config(['limits', 'max_adobe_only_users'], '300')
+        modify_root_config(['limits', 'max_concurrent_requests'], 4)
+        modify_root_config(['limits', 'max_requests_per_second'], 2.5)
+        modify_root_config(['limits', 'bulk_group_threshold'], 500)
+        modify_root_config(['limits', 'user_store_directory'], 'user-store')
+        modify_root_config(['limits', 'sync_processes'], 0)
 
         config_loader = ConfigLoader(default_args)
         options = config_loader.invocation_options
@@ -291,6 +296,13 @@ class TestConfigLoader():
         assert result['exclude_adobe_groups'] == ['one', 'two']
         assert result['exclude_users'] == ['UserA', 'UserB']
         assert result['max_adobe_only_users'] == 300
+        assert result['max_concurrent_requests'] == 4
+        assert result['max_requests_per_second'] == 2.5
+        assert result['bulk_group_threshold'] == 500
+        # the user store directory is relative to the config file
+        assert os.path.isabs(result['user_store_directory'])
+        assert os.path.basename(result['user_store_directory']) == 'user-store'
+        assert result['sync_processes'] == 0
 
     def test_get_rule_options_exceptions(self, cleanup, modify_root_config, default_args):
 
@@ -365,6 +377,21 @@ class TestConfigLoader():
         assert 'Unable to parse max_adobe_only_users value. Value must be a percentage or an integer.' in str(
             error.value)
 
+        # the limits on other changes are optional, and can also be percentages
+        modify_root_config(['limits', 'max_adobe_only_users'], 200)
+        modify_root_config(['limits', 'max_adobe_users_created'], '5%')
+        modify_root_config(['limits', 'max_adobe_group_removals'], 1000)
+        reset_rule_options()  # Reset the ruleprocessor
+        result = ConfigLoader(default_args).get_rule_options()
+        assert result['max_adobe_users_created'] == '5%'
+        assert result['max_adobe_group_removals'] == 1000
+        assert result['max_adobe_users_updated'] is None
+        assert not result.get('stop_at_max_adobe_only_users')
+        modify_root_config(['limits', 'stop_at_max_adobe_only_users'], True)
+        reset_rule_options()
+        result = ConfigLoader(default_args).get_rule_options()
+        assert result['stop_at_max_adobe_only_users'] is True
+
     def test_get_rule_options_extension(self, cleanup, modify_root_config, default_args, modify_config):
 
         # Set the extension-config file to be called in user-sync-config. Assert after_mapping_hook is processed correctly
@@ -1,6 +1,7 @@
 import pytest
 
 from user_sync.connector.directory import DirectoryConnector
+from user_sync.connector.helper import DirectoryUser, SharedValues, create_blank_user
 from user_sync.error import AssertionException
 
 
@@ -18,3 +19,32 @@ def test_required_functions(get_implementation):
     base_impl = get_implementation
     del base_impl.connector_initialize
     pytest.raises(AssertionException, DirectoryConnector, base_impl)
+
+
+def test_directory_user():
+    user = create_blank_user()
+    assert user == {'identity_type': None, 'username': None, 'domain': None, 'firstname': None,
+                    'lastname': None, 'email': None, 'groups': [], 'country': None}
+    user['domain'] = ''.join(['example', '.com'])
+    user['groups'].extend(['Group A', 'Group B'])
+    user['source_attributes'] = {'c': 'US'}
+    user['extra'] = 1
+    assert 'uid' not in user and 'extra' in user
+    assert user.get('uid') is None
+    assert len(user) == 10
+    del user['extra']
+    with pytest.raises(KeyError):
+        del user['uid']
+    user.update(firstname='First')
+    assert dict(user.copy()) == dict(user)
+    shared_values = SharedValues()
+    other = DirectoryUser(groups=['Group A', 'Group B'], domain='example.com').compact(shared_values)
+    user.compact(shared_values)
+    # repeated values are shared between users
+    assert user['domain'] is other['domain']
+    assert user['groups'] == ('Group A', 'Group B')
+    assert user['groups'] is other['groups']
+    # the shared copies belong to the run, and go when it clears them
+    shared_values.clear()
+    assert shared_values.values == {}
+    assert DirectoryUser(groups=['Group A']).compact()['groups'] == ('Group A',)
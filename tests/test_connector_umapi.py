@@ -0,0 +1,585 @@
+import json
+import logging
+import os
+import threading
+import time
+
+import mock
+import pytest
+import requests
+import umapi_client
+from umapi_client.auth import Auth
+
+from user_sync.connector.umapi import ActionManager, Commands, UmapiConnector
+from user_sync.connector.umapi_cache import UmapiUserCache
+from user_sync.connector.umapi_journal import ActionJournal, get_current_actions
+from user_sync.connector.umapi_util import RateLimiter, get_retry_after
+from user_sync.error import AssertionException
+
+
+def make_action_manager(batch_size=3, sender_threads=0):
+    connection = mock.MagicMock()
+    logger = logging.getLogger('test_umapi')
+    return ActionManager(connection, 'org_id', logger, batch_size, sender_threads), connection
+
+
+def make_action(action_manager, username):
+    commands = Commands('federatedID', username, username, None)
+    commands.add_groups({'group a'})
+    return action_manager.create_action(commands)
+
+
+def test_add_action_batches():
+    am, connection = make_action_manager(batch_size=3)
+    results = []
+    for i in range(7):
+        am.add_action(make_action(am, 'user%d@example.com' % i), results.append)
+
+    # two full batches were sent, one action remains queued
+    assert connection.execute_multiple.call_count == 2
+    for c in connection.execute_multiple.mock_calls:
+        assert len(c[1][0]) == 3
+        assert c[2] == {'immediate': True}
+    assert len(results) == 6
+    assert am.has_work()
+
+    am.flush()
+    assert connection.execute_multiple.call_count == 3
+    assert not am.has_work()
+    assert len(results) == 7
+    assert all(r['is_success'] for r in results)
+    assert am.get_statistics() == (7, 0)
+
+
+def test_batch_error_marks_batch():
+    am, connection = make_action_manager(batch_size=2)
+    error = umapi_client.BatchError([Exception('boom')], 0, 2, 0)
+    connection.execute_multiple.side_effect = error
+    results = []
+    am.add_action(make_action(am, 'user1@example.com'), results.append)
+    am.add_action(make_action(am, 'user2@example.com'), results.append)
+    assert [r['is_success'] for r in results] == [False, False]
+    assert results[0]['errors'] == [error]
+    assert am.get_statistics() == (2, 2)
+
+
+def test_action_errors_are_per_action():
+    am, connection = make_action_manager(batch_size=2)
+
+    def execute(actions, immediate):
+        actions[1].report_command_error({'index': 1, 'step': 0, 'errorCode': 'error.user.nonexistent',
+                                         'message': 'no such user'})
+        return 0, len(actions), len(actions) - 1
+
+    connection.execute_multiple.side_effect = execute
+    results = []
+    am.add_action(make_action(am, 'user1@example.com'), results.append)
+    am.add_action(make_action(am, 'user2@example.com'), results.append)
+    assert [r['is_success'] for r in results] == [True, False]
+    assert am.get_statistics() == (2, 1)
+
+
+def test_sender_threads_drain_on_flush():
+    am, connection = make_action_manager(batch_size=2, sender_threads=2)
+    results = []
+    for i in range(9):
+        am.add_action(make_action(am, 'user%d@example.com' % i), results.append)
+    am.flush()
+    assert not am.has_work()
+    assert connection.execute_multiple.call_count == 5
+    assert len(results) == 9
+    assert am.get_statistics() == (9, 0)
+    am.shutdown()
+    assert not am.sender_threads
+
+
+def test_sender_thread_error_is_raised():
+    am, connection = make_action_manager(batch_size=1, sender_threads=1)
+    connection.execute_multiple.side_effect = umapi_client.UnavailableError(3, 30, None)
+    am.add_action(make_action(am, 'user1@example.com'))
+    with pytest.raises(AssertionException):
+        am.flush()
+    assert not am.sender_threads
+
+
+def make_response(content):
+    response = requests.models.Response()
+    response.status_code = 200
+    response._content = json.dumps(content).encode('utf-8')
+    return response
+
+
+def make_connection():
+    return umapi_client.Connection('org_id', auth=Auth('api_key', 'token'), retry_max_attempts=1,
+                                   user_management_endpoint='https://umapi.example.com/v2/usermanagement')
+
+
+@pytest.mark.parametrize('own_connections', [True, False])
+def test_sender_threads_with_real_connections(own_connections):
+    received = []
+    received_lock = threading.Lock()
+
+    def post(session, url, data=None, **kwargs):
+        actions = json.loads(data)
+        # hold each request long enough for the sender threads to overlap
+        time.sleep(0.02)
+        with received_lock:
+            received.extend(action['requestID'] for action in actions)
+        return make_response({'result': 'success', 'completed': len(actions), 'notCompleted': 0})
+
+    connections = []
+
+    def connection_factory():
+        connection = make_connection()
+        connections.append(connection)
+        return connection
+
+    shared = make_connection()
+    am = ActionManager(shared, 'org_id', logging.getLogger('test_umapi'), 3, 4,
+                       connection_factory=connection_factory if own_connections else None)
+    results = []
+    with mock.patch('requests.Session.post', post):
+        for i in range(30):
+            am.add_action(make_action(am, 'user%d@example.com' % i), results.append)
+        am.flush()
+    am.shutdown()
+
+    request_ids = [r['action'].frame['requestID'] for r in results]
+    assert sorted(received) == sorted(request_ids)
+    assert len(set(request_ids)) == 30
+    assert all(r['is_success'] for r in results)
+    assert am.get_statistics() == (30, 0)
+    if own_connections:
+        assert connections and shared.local_status['actions-sent'] == 0
+        assert all(c.action_queue == [] for c in connections)
+    else:
+        connections = [shared]
+    assert sum(c.local_status['actions-sent'] for c in connections) == 30
+    assert sum(c.local_status['actions-completed'] for c in connections) == 30
+
+
+def test_sender_thread_error_drops_later_batches():
+    am, connection = make_action_manager(batch_size=1, sender_threads=1)
+    all_queued = threading.Event()
+
+    def execute(actions, immediate):
+        all_queued.wait(5)
+        raise umapi_client.UnavailableError(3, 30, None)
+
+    connection.execute_multiple.side_effect = execute
+    results = []
+    for i in range(4):
+        am.add_action(make_action(am, 'user%d@example.com' % i), results.append)
+    all_queued.set()
+    with pytest.raises(AssertionException):
+        am.flush()
+    # the failed batch and the three that were dropped after it all report their failure
+    assert connection.execute_multiple.call_count == 1
+    assert len(results) == 4
+    assert not any(r['is_success'] for r in results)
+    assert am.get_statistics() == (4, 4)
+
+
+def test_request_ids_are_unique_across_threads():
+    managers = [make_action_manager()[0] for _ in range(4)]
+    request_ids = []
+
+    def take(am):
+        ids = [am.get_next_request_id() for _ in range(2000)]
+        request_ids.extend(ids)
+
+    threads = [threading.Thread(target=take, args=(am,)) for am in managers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(request_ids) == len(set(request_ids)) == 8000
+
+
+def test_add_commands_merges_per_user():
+    am, connection = make_action_manager(batch_size=10)
+    results = []
+    first = Commands('federatedID', 'user1@example.com', 'user1@example.com', 'example.com')
+    first.add_user({'email': 'user1@example.com', 'firstname': 'One'})
+    first.update_user({'firstname': 'Uno'})
+    am.add_commands(first, results.append)
+    other = Commands('federatedID', 'user2@example.com', 'user2@example.com', 'example.com')
+    other.add_groups({'group a'})
+    am.add_commands(other, results.append)
+    # the same user, with a differently cased username and no email
+    second = Commands('federatedID', None, 'User1@Example.com', 'example.com')
+    second.add_groups({'group b'})
+    am.add_commands(second, results.append)
+    am.flush()
+
+    actions = connection.execute_multiple.call_args[0][0]
+    assert len(actions) == 2
+    assert [list(c) for c in actions[0].wire_dict()['do']] == [['createFederatedID'], ['update'], ['add']]
+    assert len(first) == 2
+    assert len(results) == 3
+    # callbacks come in the order of the actions, so both of user1's come first
+    assert results[0]['action'] is results[1]['action'] is actions[0]
+    assert am.get_statistics() == (2, 0)
+
+
+def test_add_commands_keeps_removals_separate():
+    am, connection = make_action_manager(batch_size=10)
+    remove = Commands('federatedID', 'user1@example.com', 'user1@example.com', 'example.com')
+    remove.remove_from_org(False)
+    am.add_commands(remove)
+    add = Commands('federatedID', 'user1@example.com', 'user1@example.com', 'example.com')
+    add.add_groups({'group a'})
+    am.add_commands(add)
+    renamed = Commands('federatedID', 'user1@new.example.com', 'user1@example.com', 'example.com')
+    renamed.update_user({'email': 'user1@new.example.com'})
+    am.add_commands(renamed)
+    am.flush()
+    assert len(connection.execute_multiple.call_args[0][0]) == 3
+
+
+def test_add_commands_after_send_starts_new_action():
+    am, connection = make_action_manager(batch_size=1)
+    for group in ('group a', 'group b'):
+        commands = Commands('federatedID', 'user1@example.com', 'user1@example.com', 'example.com')
+        commands.add_groups({group})
+        am.add_commands(commands)
+    am.flush()
+    assert connection.execute_multiple.call_count == 2
+    assert not am.open_items
+
+
+def make_umapi_connector(pages, read_threads, user_cache=None):
+    """
+    Make a connector (without connecting) whose user query returns the given pages
+    """
+    connector = UmapiConnector.__new__(UmapiConnector)
+    connector.action_manager, connector.connection = make_action_manager()
+    connector.read_threads = read_threads
+    connector.user_cache = user_cache
+    connector.plan_writer = None
+    connector.journal = None
+    connector.unfinished_actions = []
+    connector.prefetch = None
+    connector.name = 'umapi'
+    connector.logger = logging.getLogger('umapi')
+    connector.group_action_size = 2
+    connector.options = {'test_mode': False}
+
+    def query_multiple(object_type, page, url_params, query_params):
+        values = pages[page] if page < len(pages) else []
+        return values, page >= len(pages) - 1, 0, len(pages), page + 1, 2
+
+    connector.connection.query_multiple.side_effect = query_multiple
+    return connector
+
+
+@pytest.mark.parametrize('read_threads', [0, 1, 3])
+def test_iter_users(read_threads):
+    pages = [[{'email': 'user%d@example.com' % (p * 2 + i)} for i in range(2)] for p in range(5)]
+    # the same user can show up on more than one page
+    pages[3].append({'email': 'user0@example.com'})
+    connector = make_umapi_connector(pages, read_threads)
+    emails = [u['email'] for u in connector.iter_users()]
+    assert emails == ['user%d@example.com' % i for i in range(10)]
+    if read_threads:
+        # the page count from the first page keeps us from reading past the end
+        assert connector.connection.query_multiple.call_count == len(pages)
+
+
+def test_prefetch_users():
+    pages = [[{'email': 'user%d@example.com' % (p * 2 + i)} for i in range(2)] for p in range(3)]
+    connector = make_umapi_connector(pages, 0)
+    connector.prefetch_users()
+    emails = [u['email'] for u in connector.iter_users()]
+    assert emails == ['user%d@example.com' % i for i in range(6)]
+    assert connector.connection.query_multiple.call_count == len(pages)
+    # the buffered users are only used once
+    assert len(list(connector.iter_users())) == 6
+    assert connector.connection.query_multiple.call_count == len(pages) * 2
+
+
+def test_prefetch_users_error():
+    connector = make_umapi_connector([], 0)
+    connector.connection.query_multiple.side_effect = umapi_client.UnavailableError(1, 0, None)
+    connector.prefetch_users()
+    with pytest.raises(AssertionException):
+        list(connector.iter_users())
+
+
+def make_user(username, groups):
+    return {'email': username, 'username': username, 'domain': 'example.com', 'type': 'federatedID',
+            'firstname': 'One', 'lastname': 'User', 'country': 'US', 'groups': groups, 'status': 'active'}
+
+
+def test_user_cache_snapshot(tmpdir):
+    pages = [[make_user('user1@example.com', ['Group A']), make_user('user2@example.com', [])]]
+    cache = UmapiUserCache(str(tmpdir), 'org_id', 3600, logging.getLogger('test_umapi'))
+    connector = make_umapi_connector(pages, 0, cache)
+    assert len(list(connector.iter_users())) == 2
+    assert connector.connection.query_multiple.call_count == 1
+
+    # the run's successful actions are applied to the snapshot
+    commands = Commands('federatedID', 'user1@example.com', 'user1@example.com', 'example.com')
+    commands.update_user({'first_name': 'Uno'})
+    commands.add_groups({'group b'})
+    commands.remove_groups({'group a'})
+    connector.send_commands(commands)
+    commands = Commands('federatedID', 'user2@example.com', 'user2@example.com', 'example.com')
+    commands.remove_from_org(False)
+    connector.send_commands(commands)
+    commands = Commands('federatedID', 'user3@example.com', 'user3@example.com', 'example.com')
+    commands.add_user({'email': 'user3@example.com', 'first_name': 'Three', 'country': 'US'})
+    connector.send_commands(commands)
+    connector.get_action_manager().flush()
+    connector.save_user_cache()
+
+    # a later run reads the snapshot instead of the server
+    cache = UmapiUserCache(str(tmpdir), 'org_id', 3600, logging.getLogger('test_umapi'))
+    connector = make_umapi_connector(pages, 0, cache)
+    users = {u['username']: u for u in connector.iter_users()}
+    assert connector.connection.query_multiple.call_count == 0
+    assert sorted(users) == ['user1@example.com', 'user3@example.com']
+    assert users['user1@example.com']['firstname'] == 'Uno'
+    assert users['user1@example.com']['groups'] == ['group b']
+    assert users['user3@example.com']['firstname'] == 'Three'
+
+
+def test_add_users_to_group(tmpdir):
+    cache = UmapiUserCache(str(tmpdir), 'org_id', 3600, logging.getLogger('test_umapi'))
+    pages = [[make_user('user%d@example.com' % i, ['Group A']) for i in range(3)]]
+    connector = make_umapi_connector(pages, 0, cache)
+    list(connector.iter_users())
+    connector.add_users_to_group('Group B', ['user%d@example.com' % i for i in range(3)])
+    connector.remove_users_from_group('Group A', ['user0@example.com'])
+    connector.get_action_manager().flush()
+
+    # users are split across actions of at most group_action_size users
+    actions = connector.connection.execute_multiple.call_args[0][0]
+    assert [a.wire_dict()['do'] for a in actions] == [
+        [{'add': {'user': ['user0@example.com', 'user1@example.com']}}],
+        [{'add': {'user': ['user2@example.com']}}],
+        [{'remove': {'user': ['user0@example.com']}}],
+    ]
+    assert actions[0].wire_dict()['usergroup'] == 'Group B'
+    users = {u['email']: u for u in cache.iter_users()}
+    assert users['user0@example.com']['groups'] == ['Group B']
+    assert users['user1@example.com']['groups'] == ['Group A', 'Group B']
+
+
+def test_add_users_to_group_by_email(tmpdir):
+    cache = UmapiUserCache(str(tmpdir), 'org_id', 3600, logging.getLogger('test_umapi'))
+    renamed = dict(make_user('jdoe@example.com', ['Group A']), email='john.doe@example.com')
+    pages = [[make_user('user1@example.com', []), renamed]]
+    connector = make_umapi_connector(pages, 0, cache)
+    list(connector.iter_users())
+    connector.add_users_to_group('Group B', ['user1@example.com', 'John.Doe@example.com'])
+    connector.get_action_manager().flush()
+    connector.save_user_cache()
+
+    assert cache.load()
+    users = {u['username']: u for u in cache.iter_users()}
+    assert users['user1@example.com']['groups'] == ['Group B']
+    assert users['jdoe@example.com']['groups'] == ['Group A', 'Group B']
+
+
+def test_user_cache_ignored_create(tmpdir):
+    cache = UmapiUserCache(str(tmpdir), 'org_id', 3600, logging.getLogger('test_umapi'))
+    connector = make_umapi_connector([[make_user('user1@example.com', ['Group A'])]], 0, cache)
+    list(connector.iter_users())
+    commands = Commands('federatedID', 'user1@example.com', 'user1@example.com', 'example.com')
+    commands.add_user({'email': 'user1@example.com', 'firstname': 'Other', 'option': 'ignoreIfAlreadyExists'})
+    commands.add_groups({'group b'})
+    connector.send_commands(commands)
+    connector.get_action_manager().flush()
+    connector.save_user_cache()
+
+    # the create's attributes aren't taken; the user is read again when the snapshot is next used
+    cache = UmapiUserCache(str(tmpdir), 'org_id', 3600, logging.getLogger('test_umapi'))
+    connector = make_umapi_connector([], 0, cache)
+    connector.get_user = mock.MagicMock(return_value=make_user('user1@example.com', ['Group A', 'group b']))
+    users = list(connector.iter_users())
+    connector.get_user.assert_called_once_with('user1@example.com')
+    assert connector.connection.query_multiple.call_count == 0
+    assert [(u['firstname'], u['groups']) for u in users] == [('One', ['Group A', 'group b'])]
+    connector.save_user_cache()
+    assert cache.stale == {}
+    with open(cache.path) as f:
+        assert json.load(f)['stale'] == {}
+
+
+def test_user_cache_expires(tmpdir):
+    with open(os.path.join(str(tmpdir), 'org_id.json'), 'w') as f:
+        json.dump({'org_id': 'org_id', 'created': time.time() - 7200, 'users': []}, f)
+    cache = UmapiUserCache(str(tmpdir), 'org_id', 3600, logging.getLogger('test_umapi'))
+    connector = make_umapi_connector([[make_user('user1@example.com', [])]], 0, cache)
+    assert len(list(connector.iter_users())) == 1
+    assert connector.connection.query_multiple.call_count == 1
+
+
+def test_user_cache_invalidated_by_failure(tmpdir):
+    cache = UmapiUserCache(str(tmpdir), 'org_id', 3600, logging.getLogger('test_umapi'))
+    connector = make_umapi_connector([[make_user('user1@example.com', [])]], 0, cache)
+    list(connector.iter_users())
+    connector.connection.execute_multiple.side_effect = umapi_client.BatchError([Exception('boom')], 0, 1, 0)
+    commands = Commands('federatedID', 'user1@example.com', 'user1@example.com', 'example.com')
+    commands.add_groups({'group b'})
+    connector.send_commands(commands)
+    connector.get_action_manager().flush()
+    connector.save_user_cache()
+    assert not os.path.exists(cache.path)
+    assert not cache.load()
+
+
+def test_rate_limiter_spaces_requests():
+    limiter = RateLimiter(20)
+    start = time.time()
+    for _ in range(30):
+        limiter.acquire()
+    # a second's worth of requests go at once, the rest are spaced out
+    assert 0.4 < time.time() - start < 1.0
+    requests, throttled, rate, wait_time = limiter.get_statistics()
+    assert (requests, throttled, rate) == (30, 0, 20)
+    assert wait_time > 0
+
+
+def test_rate_limiter_adapts_to_throttling():
+    limiter = RateLimiter(8)
+    limiter.throttled(0)
+    # requests in flight during the same pause don't slow the rate again
+    limiter.throttled(0)
+    assert limiter.get_statistics()[1:3] == (2, 4)
+    start = time.time()
+    limiter.acquire()
+    assert time.time() - start >= 0.9
+    for _ in range(100):
+        limiter.succeeded()
+    assert limiter.get_statistics()[2] == 8
+
+
+def test_rate_limiter_without_limit():
+    limiter = RateLimiter()
+    for _ in range(20):
+        limiter.acquire()
+    assert limiter.get_statistics()[2] is None
+    limiter.throttled(0)
+    # with no configured limit, throttling starts limiting from the recent request rate
+    assert 0 < limiter.get_statistics()[2] <= 10
+    limiter.succeeded()
+    assert limiter.get_statistics()[2] > 0
+
+
+def test_get_retry_after():
+    assert get_retry_after(None) == 0
+    assert get_retry_after('5') == 5
+    assert 55 < get_retry_after(time.strftime('%a, %d %b %Y %H:%M:%S GMT', time.gmtime(time.time() + 60))) <= 60
+
+
+def test_plan_writer():
+    connector = make_umapi_connector([], 0)
+    plan_writer = mock.MagicMock()
+    connector.set_plan_writer(plan_writer, 'org2')
+    commands = Commands('federatedID', 'user1@example.com', 'user1@example.com', 'example.com')
+    commands.remove_from_org(False)
+    connector.send_commands(commands)
+    connector.add_users_to_group('Group B', ['user1@example.com'])
+    connector.create_group('Group C')
+    connector.flush_actions()
+
+    # changes are written to the plan, and nothing is sent
+    plan_writer.add_commands.assert_called_once_with('org2', commands)
+    plan_writer.add_group_users.assert_called_once_with('org2', 'Group B', ['user1@example.com'], True)
+    plan_writer.add_create_group.assert_called_once_with('org2', 'Group C')
+    plan_writer.add_flush.assert_called_once_with('org2')
+    assert not connector.get_action_manager().has_work()
+    assert connector.connection.execute_multiple.call_count == 0
+    assert connector.connection.execute_single.call_count == 0
+
+
+def make_journaled_connector(tmpdir, resume=False):
+    connector = make_umapi_connector([], 0)
+    connector.journal = ActionJournal(str(tmpdir), 'org_id', logging.getLogger('test_umapi'))
+    connector.journal.resume = resume
+    connector.action_manager.journal = connector.journal
+    connector.action_manager.batch_size = 10
+    connector.group_action_size = 10
+    return connector
+
+
+def test_action_journal_resume(tmpdir):
+    connector = make_journaled_connector(tmpdir)
+    commands = Commands('federatedID', 'user1@example.com', 'user1@example.com', 'example.com')
+    commands.add_groups({'Group A'})
+    connector.send_commands(commands)
+    connector.flush_actions()
+    # the run dies while sending the next batch
+    connector.connection.execute_multiple.side_effect = RuntimeError('host went away')
+    commands = Commands('federatedID', 'user3@example.com', 'user3@example.com', 'example.com')
+    commands.update_user({'firstname': 'Tres', 'country': 'US'})
+    connector.send_commands(commands)
+    connector.add_users_to_group('Group B', ['user1@example.com', 'user4@example.com', 'user5@example.com'])
+    with pytest.raises(RuntimeError):
+        connector.flush_actions()
+
+    # only the unfinished actions are resumed, and only the parts that are still needed
+    connector = make_journaled_connector(tmpdir, resume=True)
+    connector.unfinished_actions = connector.journal.load_unfinished()
+    assert len(connector.unfinished_actions) == 2
+    users = {'user1@example.com': make_user('user1@example.com', ['Group A', 'Group B']),
+             'user3@example.com': make_user('user3@example.com', []),
+             'user4@example.com': make_user('user4@example.com', [])}
+    connector.connection.query_single.side_effect = lambda object_type, url_params, query_params: \
+        users.get(url_params[0], {})
+    assert connector.resume_actions() == 2
+    actions = connector.connection.execute_multiple.call_args[0][0]
+    assert [a.wire_dict()['do'] for a in actions] == [
+        [{'update': {'firstname': 'Tres'}}],
+        [{'add': {'user': ['user4@example.com']}}]]
+
+    # once the replays have been sent, there is nothing left to resume
+    assert connector.journal.load_unfinished() == []
+
+
+def test_action_journal_sync_and_set_aside(tmpdir):
+    connector = make_journaled_connector(tmpdir)
+    events = []
+    commands = Commands('federatedID', 'user1@example.com', 'user1@example.com', 'example.com')
+    commands.add_groups({'Group A'})
+    connector.send_commands(commands)
+    with mock.patch('os.fsync', side_effect=lambda fd: events.append('fsync')):
+        connector.connection.execute_multiple.side_effect = lambda *args, **kwargs: events.append('send')
+        connector.flush_actions()
+    # the intent reaches the disk before the action is sent, and the outcome after
+    assert events == ['fsync', 'send', 'fsync']
+
+    # the run dies before the next action is answered
+    connector.connection.execute_multiple.side_effect = RuntimeError('host went away')
+    connector.send_commands(commands)
+    with pytest.raises(RuntimeError):
+        connector.flush_actions()
+
+    # a run that doesn't resume keeps the unfinished journal rather than starting over it
+    connector = make_journaled_connector(tmpdir)
+    connector.send_commands(commands)
+    connector.flush_actions()
+    saved = [name for name in os.listdir(str(tmpdir)) if name.startswith('org_id.journal.')]
+    assert len(saved) == 1
+    saved_journal = ActionJournal(str(tmpdir), 'org_id', logging.getLogger('test_umapi'))
+    saved_journal.path = os.path.join(str(tmpdir), saved[0])
+    assert len(saved_journal.load_unfinished()) == 1
+    assert connector.journal.load_unfinished() == []
+
+    # a finished journal is simply started over
+    connector = make_journaled_connector(tmpdir)
+    connector.send_commands(commands)
+    connector.flush_actions()
+    assert len([name for name in os.listdir(str(tmpdir)) if name.startswith('org_id.journal.')]) == 1
+
+
+def test_get_current_actions():
+    user = make_user('user1@example.com', ['Group A'])
+    actions = [['create', {'first_name': 'One'}], ['add_to_groups', {'groups': ['Group A', 'Group B']}],
+               ['remove_from_groups', {'groups': ['Group C']}]]
+    assert get_current_actions(actions, user) == [['add_to_groups', {'groups': ['Group B']}]]
+    assert get_current_actions(actions, None) == actions[:2]
+    assert get_current_actions([['remove_from_organization', {'delete_account': False}]], None) == []
+    assert get_current_actions([['remove_from_groups', {'all_groups': True}]], make_user('user2@example.com', [])) == []
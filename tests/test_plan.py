@@ -0,0 +1,74 @@
+import logging
+
+import mock
+import pytest
+import umapi_client
+
+from user_sync.connector.umapi import Commands
+from user_sync.error import AssertionException
+from user_sync.plan import PlanWriter, apply_plan, read_plan
+
+
+def make_commands():
+    commands = Commands('federatedID', 'user@example.com', 'user@example.com', 'example.com')
+    commands.add_user({'firstname': 'First', 'option': 'ignoreIfAlreadyExists'})
+    commands.add_groups({'group b', 'group a'})
+    commands.remove_all_groups()
+    return commands
+
+
+def make_connectors(*secondary_names):
+    connectors = mock.MagicMock()
+    primary = mock.MagicMock(user_cache=None)
+    secondaries = {name: mock.MagicMock(user_cache=None) for name in secondary_names}
+    connectors.get_primary_connector.return_value = primary
+    connectors.get_secondary_connectors.return_value = secondaries
+    return connectors, primary, secondaries
+
+
+def write_plan(path, complete=True):
+    writer = PlanWriter(path, logging.getLogger('test'))
+    writer.add_create_group(None, 'group a')
+    writer.add_commands(None, make_commands())
+    writer.add_group_users('org2', 'group c', ['a@example.com', 'b@example.com'], False)
+    writer.add_flush('org2')
+    writer.close(complete)
+
+
+def test_plan_round_trip(tmpdir):
+    path = str(tmpdir / 'plan.jsonl')
+    write_plan(path)
+    assert [entry['type'] for entry in read_plan(path)] == ['create_group', 'user', 'group_users', 'flush']
+
+    connectors, primary, secondaries = make_connectors('org2')
+    counts = apply_plan(path, connectors, logging.getLogger('test'))
+    assert counts == {'user': 1, 'group_users': 1, 'create_group': 1}
+    primary.create_group.assert_called_once_with('group a')
+    commands = primary.send_commands.call_args[0][0]
+    assert (commands.identity_type, commands.email, commands.username, commands.domain) == \
+        ('federatedID', 'user@example.com', 'user@example.com', 'example.com')
+    assert commands.do_list == [
+        ('create', {'first_name': 'First', 'on_conflict': umapi_client.IfAlreadyExistsOptions.ignoreIfAlreadyExists}),
+        ('add_to_groups', {'groups': {'group a', 'group b'}}),
+        ('remove_from_groups', {'all_groups': True})]
+    secondaries['org2'].remove_users_from_group.assert_called_once_with('group c', ['a@example.com', 'b@example.com'])
+    secondaries['org2'].flush_actions.assert_called_once_with()
+    connectors.execute_actions.assert_called_once_with()
+
+
+def test_incomplete_plan(tmpdir):
+    path = str(tmpdir / 'plan.jsonl')
+    write_plan(path, complete=False)
+    connectors, primary, _ = make_connectors('org2')
+    with pytest.raises(AssertionException):
+        apply_plan(path, connectors, logging.getLogger('test'))
+    assert not primary.send_commands.called
+
+
+def test_plan_unknown_org(tmpdir):
+    path = str(tmpdir / 'plan.jsonl')
+    write_plan(path)
+    connectors, primary, _ = make_connectors('org3')
+    with pytest.raises(AssertionException):
+        apply_plan(path, connectors, logging.getLogger('test'))
+    assert not primary.send_commands.called
@@ -1,4 +1,5 @@
 import csv
+import logging
 import re
 
 import mock
@@ -7,9 +8,15 @@ import six
 import yaml
 from mock import MagicMock
 
+from tests.test_connector_umapi import make_umapi_connector, make_user
 from tests.util import compare_iter
+from user_sync.connector.helper import AdobeUser
 from user_sync.connector.umapi import Commands
-from user_sync.rules import AdobeGroup, UmapiTargetInfo, UmapiConnectors, RuleProcessor
+from user_sync.connector.umapi_cache import UmapiUserCache
+from user_sync.connector.umapi_util import get_rate_limiter
+from user_sync.error import AssertionException
+from user_sync.rules import AdobeGroup, AdobeGroupRegistry, AdditionalGroupMatcher, ChangeLimit, GroupInterner, \
+    UmapiTargetInfo, UmapiConnectors, RuleProcessor, UserExclusionMatcher, UserKey
 
 
 @pytest.fixture
@@ -58,6 +65,9 @@ class MockUmapiConnector(MagicMock):
     def get_action_manager(self):
         return self.action_manager
 
+    def flush_actions(self):
+        self.action_manager.flush()
+
     def iter_users(self):
         return self.users
 
@@ -65,6 +75,7 @@ class MockUmapiConnector(MagicMock):
 def test_log_action_summary(rule_processor, log_stream, mock_umapi_connectors):
     connectors = mock_umapi_connectors('umapi-2', 'umapi-3')
     stream, rule_processor.logger = log_stream
+    get_rate_limiter().configure(None)
     rule_processor.log_action_summary(connectors)
     expected = """---------------------------------- Action Summary ----------------------------------
                                 Number of directory users read: 0
@@ -84,6 +95,21 @@ def test_log_action_summary(rule_processor, log_stream, mock_umapi_connectors):
     assert expected == stream.getvalue()
 
 
+def test_log_action_summary_rate_limit(rule_processor, log_stream, mock_umapi_connectors):
+    connectors = mock_umapi_connectors()
+    stream, rule_processor.logger = log_stream
+    limiter = get_rate_limiter()
+    limiter.configure(5)
+    limiter.acquire()
+    limiter.throttled(0)
+    rule_processor.log_action_summary(connectors)
+    limiter.configure(None)
+    lines = stream.getvalue().splitlines()
+    assert lines[-4].endswith('Number of UMAPI requests (total, throttled): (1, 1)')
+    assert lines[-3].endswith('UMAPI request rate limit (per second): 2.5')
+    assert lines[-2].endswith('Seconds waited for the UMAPI rate limit: 0.0')
+
+
 def test_read_desired_user_groups_basic(rule_processor, mock_dir_user):
     rp = rule_processor
     mock_dir_user['groups'] = ['Group A', 'Group B']
@@ -91,12 +117,12 @@ def test_read_desired_user_groups_basic(rule_processor, mock_dir_user):
     directory_connector = mock.MagicMock()
     directory_connector.load_users_and_groups.return_value = [mock_dir_user]
     mappings = {
-        'Group A': [AdobeGroup.create('Console Group')]}
+        'Group A': [rp.group_registry.create('Console Group')]}
     rp.read_desired_user_groups(mappings, directory_connector)
 
-    # Assert the security group and adobe group end up in the correct scope
-    assert "Group A" in rp.after_mapping_hook_scope['source_groups']
-    assert "Console Group" in rp.after_mapping_hook_scope['target_groups']
+    # without a hook, the hook scope is left alone
+    assert rp.after_mapping_hook_scope['source_groups'] is None
+    assert rp.after_mapping_hook_scope['target_groups'] is None
 
     # Assert the user group updated in umapi info
     user_key = rp.get_directory_user_key(mock_dir_user)
@@ -104,6 +130,29 @@ def test_read_desired_user_groups_basic(rule_processor, mock_dir_user):
     assert user_key in rp.filtered_directory_user_by_user_key
 
 
+def test_read_desired_user_groups_shared_groups(rule_processor, get_mock_user_list):
+    rp = rule_processor
+    users = get_mock_user_list(count=4, groups=['Group A', 'Group B'])
+    list(users.values())[3]['groups'] = ['Group B']
+    directory_connector = mock.MagicMock()
+    directory_connector.load_users_and_groups.return_value = list(users.values())
+    mappings = {
+        'Group A': [rp.group_registry.create('Console Group'), rp.group_registry.create('umapi-2::Other Group')],
+        'Group B': [rp.group_registry.create('Console Group')]}
+    with mock.patch.object(rp.group_registry, 'lookup', wraps=rp.group_registry.lookup) as lookup:
+        rp.read_desired_user_groups(mappings, directory_connector)
+    # each distinct set of directory groups is resolved once
+    assert lookup.call_count == 3
+    user_keys = list(users.keys())
+    primary_groups = rp.umapi_info_by_name[None].get_desired_groups_by_user_key()
+    secondary_groups = rp.umapi_info_by_name['umapi-2'].get_desired_groups_by_user_key()
+    for user_key in user_keys[:3]:
+        assert primary_groups[user_key] == {'console group'}
+        assert secondary_groups[user_key] == {'other group'}
+    assert primary_groups[user_keys[3]] == {'console group'}
+    assert user_keys[3] not in secondary_groups
+
+
 def test_after_mapping_hook(rule_processor, mock_dir_user):
     rp = rule_processor
     mock_dir_user['groups'] = ['Group A']
@@ -118,7 +167,7 @@ if first is not None:
 target_groups.add('ext group 2')
 """
 
-    AdobeGroup.create('existing_group')
+    rp.group_registry.create('existing_group')
     rp.options['after_mapping_hook'] = compile(
         after_mapping_hook_text, '<per-user after-mapping-hook>', 'exec')
 
@@ -128,6 +177,79 @@ target_groups.add('ext group 2')
     assert "ext group 2" in rp.after_mapping_hook_scope['target_groups']
 
 
+@pytest.mark.parametrize('batch_hook,processes', [(False, 0), (True, 0), (False, 2), (True, 2)])
+def test_after_mapping_hook_chunks(rule_processor, get_mock_user_list, batch_hook, processes):
+    rp = rule_processor
+    users = get_mock_user_list(count=5, groups=['Group A'])
+    directory_connector = mock.MagicMock()
+    directory_connector.load_users_and_groups.return_value = list(users.values())
+    for name in ['Console Group', 'US Group']:
+        rp.group_registry.create(name)
+    per_user_hook = """
+target_attributes['country'] = 'US'
+target_groups.add('US Group')
+"""
+    batch_hook_text = """
+for user in users:
+    user['target_attributes']['country'] = 'US'
+    user['target_groups'].add('US Group')
+"""
+    if batch_hook:
+        rp.options['after_mapping_batch_hook'] = compile(batch_hook_text, '<batch after-mapping-hook>', 'exec')
+    else:
+        rp.options['after_mapping_hook'] = compile(per_user_hook, '<per-user after-mapping-hook>', 'exec')
+    rp.options['hook_batch_size'] = 2
+    rp.options['hook_processes'] = processes
+    rp.read_desired_user_groups({'Group A': [rp.group_registry.lookup('Console Group')]}, directory_connector)
+    desired_groups = rp.umapi_info_by_name[None].get_desired_groups_by_user_key()
+    assert len(desired_groups) == 5
+    for user_key, directory_user in six.iteritems(rp.filtered_directory_user_by_user_key):
+        assert directory_user['country'] == 'US'
+        assert desired_groups[user_key] == {'console group', 'us group'}
+
+
+def test_after_mapping_hook_processes_log(rule_processor, get_mock_user_list, spawn_start_method, caplog):
+    # a spawned worker has no log handlers, so the hook's messages are logged by the main process
+    rp = rule_processor
+    directory_connector = mock.MagicMock()
+    directory_connector.load_users_and_groups.return_value = list(get_mock_user_list(count=3).values())
+    rp.options['after_mapping_hook'] = compile("logger.warning('hook ran for %s', source_attributes['email'])",
+                                               '<per-user after-mapping-hook>', 'exec')
+    rp.options['hook_processes'] = 2
+    with caplog.at_level(logging.INFO):
+        rp.read_desired_user_groups({}, directory_connector)
+    messages = sorted(r.getMessage() for r in caplog.records if r.getMessage().startswith('hook ran'))
+    assert messages == ['hook ran for user%d@example.com' % i for i in range(3)]
+
+
+def test_after_mapping_hook_cache(get_mock_user_list, tmpdir):
+    cache_path = str(tmpdir.join('hook_cache.json'))
+    hook_text = """
+hook_storage = (hook_storage or 0) + 1
+target_attributes['country'] = 'US'
+target_groups.add('US Group')
+"""
+
+    def run(text):
+        rp = RuleProcessor({})
+        rp.group_registry.create('US Group')
+        rp.options['after_mapping_hook'] = compile(text, '<per-user after-mapping-hook>', 'exec')
+        rp.options['hook_cache'] = cache_path
+        directory_connector = mock.MagicMock()
+        directory_connector.load_users_and_groups.return_value = list(get_mock_user_list(count=3).values())
+        rp.read_desired_user_groups({}, directory_connector)
+        for user_key, directory_user in six.iteritems(rp.filtered_directory_user_by_user_key):
+            assert directory_user['country'] == 'US'
+            assert rp.umapi_info_by_name[None].get_desired_groups(user_key) == {'us group'}
+        # the number of users the hook code ran for
+        return rp.after_mapping_hook_scope['hook_storage']
+
+    assert run(hook_text) == 3
+    assert run(hook_text) is None
+    # changing the hook code invalidates the cache
+    assert run(hook_text + "pass\n") == 3
+
+
 def test_additional_groups(rule_processor, mock_dir_user):
     rp = rule_processor
     mock_dir_user['member_groups'] = ['other_security_group', 'security_group', 'more_security_group']
@@ -152,6 +274,24 @@ def test_additional_groups(rule_processor, mock_dir_user):
         rp.umapi_info_by_name[None].desired_groups_by_user_key[user_key])
 
 
+def test_additional_group_matcher(rule_processor):
+    rp = rule_processor
+    matcher = AdditionalGroupMatcher([
+        {'source': re.compile('(.+)_users'), 'target': AdobeGroup.create('\\1_group')},
+        {'source': re.compile('(.+)_admins'), 'target': AdobeGroup.create('\\1_group')},
+        {'source': re.compile('(.+)_users'), 'target': AdobeGroup.create('umapi2::\\1')}], rp.get_umapi_info)
+    result = matcher.resolve('sales_users')
+    assert [(info.get_name(), groups) for info, groups in result] == [(None, ('sales_group',)), ('umapi2', ('sales',))]
+    assert matcher.resolve('sales_users') is result
+    assert matcher.resolve('unrelated') == []
+
+    # both member groups stay recorded against the same target, for conflict detection
+    matcher.resolve('sales_admins')
+    umapi_info = rp.get_umapi_info(None)
+    assert umapi_info.additional_group_map['sales_group'] == ['sales_users', 'sales_admins']
+    assert 'sales_group' in umapi_info.get_mapped_groups()
+
+
 @mock.patch("user_sync.rules.RuleProcessor.update_umapi_users_for_connector")
 def test_sync_umapi_users(update_umapi, rule_processor, mock_umapi_connectors, get_mock_user_list, mock_umapi_info):
     rule_processor.options['exclude_unmapped_users'] = False
@@ -519,29 +659,119 @@ def test_update_umapi_users_for_connector(add_stray, update_umapi_user, rule_pro
         'firstname': dir_users[0]['firstname']}
     assert c[4] == {'new group'}
     assert c[5] == {'to remove'}
-    assert c[6] == umapi_users[0]
+    # adobe users are kept as compact records, with their groups in shared tuples
+    assert c[6] == AdobeUser(umapi_users[0]).compact()
+    assert c[6]['groups'] == ('Current Group', 'To Remove')
+    assert c[6]['groups'] is rp.shared_values.share(('Current Group', 'To Remove'))
 
     # Check that a stray is handled correctly
     strays = add_stray.mock_calls[1][1]
     assert strays == (None, rp.get_umapi_user_key(umapi_users[-1]), {"to remove"})
 
 
+@mock.patch("user_sync.rules.RuleProcessor.update_umapi_user")
+def test_update_umapi_users_for_connector_bulk_groups(update_umapi_user, rule_processor, get_mock_user_list):
+    rp = rule_processor
+    rp.options['process_groups'] = True
+    rp.options['bulk_group_threshold'] = 3
+
+    conn = MockUmapiConnector()
+    info = UmapiTargetInfo(None)
+    info.add_mapped_group("New Group")
+    info.add_mapped_group("Small Group")
+    info.add_mapped_group("To Remove")
+
+    umapi_users = get_mock_user_list(count=5, umapi_users=True, groups=["To Remove"])
+    dir_users = get_mock_user_list(count=5)
+    for k in dir_users:
+        info.add_desired_group_for(k, "New Group")
+    small_group_key = sorted(dir_users)[0]
+    info.add_desired_group_for(small_group_key, "Small Group")
+    conn.users = umapi_users.values()
+    rp.filtered_directory_user_by_user_key.update(dir_users)
+
+    rp.update_umapi_users_for_connector(info, conn)
+
+    # the large changes are sent per group, the small one per user
+    emails = sorted(u['email'] for u in umapi_users.values())
+    assert sorted(conn.add_users_to_group.call_args[0][1]) == emails
+    assert conn.add_users_to_group.call_args[0][0] == 'new group'
+    assert sorted(conn.remove_users_from_group.call_args[0][1]) == emails
+    assert update_umapi_user.call_count == 1
+    assert update_umapi_user.call_args[0][4:6] == ({'small group'}, set())
+    assert rp.updated_user_keys == set(dir_users)
+
+
+@mock.patch("user_sync.rules.RuleProcessor.update_umapi_user")
+def test_bulk_groups_only_name_users_by_email(update_umapi_user, rule_processor, get_mock_user_list,
+                                               get_mock_user):
+    rp = rule_processor
+    rp.options['process_groups'] = True
+    rp.options['bulk_group_threshold'] = 2
+
+    conn = MockUmapiConnector()
+    info = UmapiTargetInfo(None)
+    info.add_mapped_group("New Group")
+
+    umapi_users = get_mock_user_list(count=2, umapi_users=True)
+    dir_users = get_mock_user_list(count=2)
+    # users that a group-level action can't name by their email address
+    others = [dict(identifier='user7', username='jdoe'), dict(identifier='user8', username='jane@example.com'),
+              dict(identifier='user9', identity_type='adobeID')]
+    for kwargs in others:
+        umapi_user = get_mock_user(is_umapi_user=True, **kwargs)
+        umapi_users[rp.get_umapi_user_key(umapi_user)] = umapi_user
+        dir_user = get_mock_user(**kwargs)
+        dir_users[rp.get_directory_user_key(dir_user)] = dir_user
+    for k in dir_users:
+        info.add_desired_group_for(k, "New Group")
+    conn.users = umapi_users.values()
+    rp.filtered_directory_user_by_user_key.update(dir_users)
+
+    rp.update_umapi_users_for_connector(info, conn)
+
+    assert sorted(conn.add_users_to_group.call_args[0][1]) == ['user0@example.com', 'user1@example.com']
+    assert sorted(c[0][1] for c in update_umapi_user.call_args_list) == sorted(
+        rp.get_umapi_user_key(u) for u in umapi_users.values() if u['email'] in
+        ('user7@example.com', 'user8@example.com', 'user9@example.com'))
+
+
 def test_is_umapi_user_excluded(rule_processor):
     in_primary_org = True
-    rule_processor.exclude_identity_types = ['adobeID']
+    rule_processor.user_exclusion_matcher = UserExclusionMatcher(['adobeID'], set(), [])
     user_key = 'adobeID,adobe.user@example.com,'
     current_groups = {'default acrobat pro dc configuration', 'one', '_admin_group a'}
     assert rule_processor.is_umapi_user_excluded(in_primary_org, user_key, current_groups)
 
     user_key = 'federatedID,adobe.user@example.com,'
-    rule_processor.exclude_groups = {'one'}
+    rule_processor.user_exclusion_matcher = UserExclusionMatcher(['adobeID'], {'one'}, [])
     assert rule_processor.is_umapi_user_excluded(in_primary_org, user_key, current_groups)
 
     user_key = 'federatedID,adobe.user@example.com,'
-    rule_processor.exclude_groups = set()
     compiled_expression = re.compile(r'\A' + "adobe.user@example.com" + r'\Z', re.IGNORECASE)
-    rule_processor.exclude_users = {compiled_expression}
+    rule_processor.user_exclusion_matcher = UserExclusionMatcher(['adobeID'], set(), [compiled_expression])
     assert rule_processor.is_umapi_user_excluded(in_primary_org, user_key, current_groups)
+    assert rule_processor.excluded_user_count == 3
+
+    user_key = 'federatedID,other.user@example.com,'
+    assert not rule_processor.is_umapi_user_excluded(in_primary_org, user_key, current_groups)
+    assert user_key in rule_processor.included_user_keys
+
+
+def test_user_exclusion_matcher():
+    patterns = [re.compile(r'\A' + p + r'\Z', re.UNICODE | re.IGNORECASE)
+                for p in ['.*@special.com', 'freelancer-[0-9]+.*', '(a)\\1@example.com', '(x|y)+@example.com']]
+    matcher = UserExclusionMatcher(['adobeID'], {'excluded'}, patterns)
+    assert matcher.combined_pattern is not None
+    assert matcher.separate_indexes == [2]
+    assert matcher.match('adobeID', 'user@example.com', set()) == 'type'
+    assert matcher.match('federatedID', 'user@example.com', {'excluded', 'other'}) == 'group'
+    assert matcher.match('federatedID', 'Someone@SPECIAL.com', set()) == "name pattern '%s'" % patterns[0].pattern
+    assert matcher.match('federatedID', 'freelancer-12@example.com', set()) == \
+        "name pattern '%s'" % patterns[1].pattern
+    assert matcher.match('federatedID', 'aa@example.com', set()) == "name pattern '%s'" % patterns[2].pattern
+    assert matcher.match('federatedID', 'xyx@example.com', set()) == "name pattern '%s'" % patterns[3].pattern
+    assert matcher.match('federatedID', 'user@example.com', {'other'}) is None
 
 
 def test_get_user_attribute_difference(rule_processor, mock_dir_user, mock_umapi_user):
@@ -565,6 +795,21 @@ def test_get_user_attribute_difference(rule_processor, mock_dir_user, mock_umapi
         umapi_users_mock_data, umapi_users_mock_data) == {}
 
 
+def test_get_user_attribute_differences(rule_processor, get_mock_user_list):
+    dir_users = list(get_mock_user_list(count=4).values())
+    umapi_users = [dict(u) for u in dir_users]
+    umapi_users[0]['email'] = umapi_users[0]['email'].upper()
+    umapi_users[1]['firstname'] = 'Changed'
+    umapi_users[3]['lastname'] = 'Changed'
+    umapi_users[3]['email'] = 'changed@example.com'
+    assert rule_processor.get_user_attribute_differences(dir_users, umapi_users) == [
+        None,
+        {'firstname': dir_users[1]['firstname']},
+        None,
+        {'email': dir_users[3]['email'], 'lastname': dir_users[3]['lastname']},
+    ]
+
+
 # Todo: test_get_directory_user_key
 def test_get_directory_user_key():
     pass
@@ -593,6 +838,20 @@ def test_get_user_key(rule_processor):
     assert not rule_processor.get_user_key("federatedID", None, "wriker@example.com")
 
 
+def test_user_key(rule_processor):
+    key = rule_processor.get_user_key("FederatedID", "Wriker", " Example.com ")
+    assert isinstance(key, UserKey)
+    assert key == 'federatedID,wriker,example.com'
+    assert {key: 1}['federatedID,wriker,example.com'] == 1
+    assert key.get_parts() == ['federatedID', 'wriker', 'example.com']
+    assert (key.get_identity_type(), key.get_username(), key.get_domain()) == ('federatedID', 'wriker', 'example.com')
+    assert rule_processor.parse_user_key(key) == ['federatedID', 'wriker', 'example.com']
+    assert rule_processor.get_username_from_user_key(key) == 'wriker'
+    # a username with a comma doesn't confuse the parts
+    assert UserKey.make('enterpriseID', 'smith, j', 'example.com').get_parts() == ['enterpriseID', 'smith, j', 'example.com']
+    assert rule_processor.get_user_key("federatedID", "", "example.com", " W@Example.com") == 'federatedID,w@example.com,'
+
+
 def test_parse_user_key(rule_processor):
     parsed_user_key = rule_processor.parse_user_key("federatedID,test_user@email.com,")
     assert parsed_user_key == ['federatedID', 'test_user@email.com', '']
@@ -770,6 +1029,46 @@ class TestAdobeGroup():
         assert isinstance(group, AdobeGroup)
         assert group.get_group_name() == 'group_name'
 
+    def test_hash(self):
+        group = AdobeGroup.create('umapi-2::Group A')
+        assert group == AdobeGroup('Group A', 'umapi-2')
+        assert hash(group) == hash(AdobeGroup('Group A', 'umapi-2'))
+        assert hash(group) != hash(AdobeGroup('Group A', None))
+        assert len({AdobeGroup.create(name) for name in ['Group A', 'umapi-2::Group A', 'Group A']}) == 2
+
+
+class TestAdobeGroupRegistry():
+
+    def test_create(self):
+        registry = AdobeGroupRegistry()
+        group = registry.create('umapi-2::Group A')
+        assert group.group_id == 0
+        assert registry.create('umapi-2::Group A') is group
+        assert registry.create('Group A').group_id == 1
+        assert registry.create('') is None
+        assert registry.get(0) is group
+        assert list(registry.iter_groups()) == [group, registry.get(1)]
+
+    def test_lookup(self):
+        registry = AdobeGroupRegistry()
+        group = registry.create('Group A')
+        assert registry.lookup('Group A') is group
+        assert registry.lookup('Group B') is None
+        assert len(registry) == 1
+        # each run has its own registry
+        assert AdobeGroupRegistry().lookup('Group A') is None
+
+
+def test_group_interner():
+    interner = GroupInterner()
+    a, b = interner.get_bit('group a'), interner.get_bit('group b')
+    assert (a, b) == (1, 2)
+    assert interner.get_raw_bits([' Group A', 'GROUP B', 'Group C']) == 7
+    assert interner.get_bits(['group a', 'group c']) == 5
+    assert interner.get_names(6) == {'group b', 'group c'}
+    assert interner.get_names(0) == set()
+    assert interner.get_raw_bits(None) == 0
+
 
 #################################
 ### Umapi Target Info Tests #####
@@ -793,3 +1092,159 @@ class TestUmapiTargetInfo():
             mock_desired_groups.return_value = None
             umapi_target_info.add_desired_group_for('user_key', 'group_name')
             assert umapi_target_info.desired_groups_by_user_key['user_key'] == {'group_name'}
+
+
+def test_execute_actions_concurrently(mock_umapi_connectors):
+    connectors = mock_umapi_connectors('umapi-2', 'umapi-3')
+    flushed = []
+    for connector in connectors.connectors:
+        action_manager = mock.MagicMock()
+        action_manager.has_work.side_effect = [True, False]
+        action_manager.flush.side_effect = lambda name=connector.name: flushed.append(name)
+        connector.action_manager = action_manager
+    connectors.execute_actions()
+    assert compare_iter(flushed, ['umapi', 'umapiumapi-2', 'umapiumapi-3'])
+    for connector in connectors.connectors:
+        connector.action_manager.shutdown.assert_called_once_with()
+
+
+def test_manage_strays_secondaries_before_primary(rule_processor, mock_umapi_connectors):
+    connectors = mock_umapi_connectors('umapi-2', 'umapi-3')
+    events = []
+    for connector in connectors.connectors:
+        action_manager = mock.MagicMock()
+        action_manager.flush.side_effect = lambda name=connector.name: events.append(name)
+        connector.action_manager = action_manager
+    user_key = 'federatedID,example@email.com,'
+    rule_processor.stray_key_map = {None: {user_key: None}, 'umapi-2': {user_key: None}, 'umapi-3': {user_key: None}}
+    rule_processor.options['delete_strays'] = True
+    rule_processor.manage_strays(connectors)
+    assert compare_iter(events[:2], ['umapiumapi-2', 'umapiumapi-3'])
+    assert events[2] == 'umapi'
+
+
+def test_prefetch_umapi_users(rule_processor, mock_umapi_connectors):
+    connectors = mock_umapi_connectors('umapi-2', 'umapi-3')
+    rule_processor.get_umapi_info('umapi-2').add_mapped_group('Group A')
+    rule_processor.prefetch_umapi_users(connectors)
+    primary = connectors.get_primary_connector()
+    secondaries = connectors.get_secondary_connectors()
+    primary.prefetch_users.assert_called_once_with()
+    secondaries['umapi-2'].prefetch_users.assert_called_once_with()
+    # no groups are mapped to umapi-3, so it won't be synced
+    secondaries['umapi-3'].prefetch_users.assert_not_called()
+
+
+def sync_sample_users(get_mock_user_list, options):
+    """
+    Sync a few directory users with a few adobe users, some of which match.
+    :return: the users to create, the commands sent, the strays, and the user counts
+    """
+    rp = RuleProcessor(dict(options, process_groups=True, update_user_info=True, remove_strays=True))
+    dir_users = get_mock_user_list(count=6, groups=['Group A'])
+    for i, user in enumerate(dir_users.values()):
+        user['firstname'] += ' Updated' if i % 2 else ''
+    umapi_users = get_mock_user_list(count=6, start=3, umapi_users=True, groups=['Console Group', 'Old Group'])
+    directory_connector = mock.MagicMock()
+    directory_connector.load_users_and_groups.return_value = [dict(u) for u in dir_users.values()]
+    mappings = {'Group A': [rp.group_registry.create('Console Group')],
+                'Group B': [rp.group_registry.create('Old Group')]}
+    rp.prepare_umapi_infos()
+    rp.read_desired_user_groups(mappings, directory_connector)
+    conn = MockUmapiConnector()
+    conn.users = [dict(u, groups=['Console Group', 'Old Group']) for u in umapi_users.values()]
+    sent = []
+    conn.send_commands = sent.append
+    adds = rp.update_umapi_users(rp.get_umapi_info(None), conn)
+    commands = sorted((c.username, [(action, dict((k, sorted(v) if isinstance(v, set) else v)
+                                                  for k, v in six.iteritems(params)))
+                                    for action, params in c.do_list]) for c in sent)
+    result = (sorted(six.iteritems(adds)), commands, sorted(rp.get_stray_keys()),
+              len(rp.included_user_keys), len(rp.updated_user_keys), rp.primary_user_count,
+              len(rp.directory_user_by_user_key), len(rp.filtered_directory_user_by_user_key))
+    if rp.user_store is not None:
+        assert all(rp.filtered_directory_user_by_user_key[user_key]['email'] for user_key, _ in result[0])
+        rp.user_store.close()
+    if rp.shard_executor is not None:
+        rp.shard_executor.shutdown()
+    return result
+
+
+def test_user_store_sync(tmpdir, get_mock_user_list):
+    # the same changes are found with the users on disk as with the users in memory
+    in_memory = sync_sample_users(get_mock_user_list, {})
+    on_disk = sync_sample_users(get_mock_user_list, {'user_store_directory': str(tmpdir.join('store'))})
+    assert on_disk == in_memory
+    adds, commands, strays = in_memory[:3]
+    assert len(adds) == 3 and len(strays) == 3
+    assert commands[0] == ('user3@example.com', [
+        ('update', {'first_name': 'user3 First Updated'}), ('remove_from_groups', {'groups': ['old group']})])
+    assert commands[1] == ('user4@example.com', [('remove_from_groups', {'groups': ['old group']})])
+    assert not tmpdir.join('store').listdir()
+
+
+def test_sync_processes(get_mock_user_list):
+    # the same changes are found by worker processes as in one process
+    assert sync_sample_users(get_mock_user_list, {'sync_processes': 3}) == sync_sample_users(get_mock_user_list, {})
+
+
+def test_sync_processes_spawn(get_mock_user_list, spawn_start_method):
+    assert sync_sample_users(get_mock_user_list, {'sync_processes': 2}) == sync_sample_users(get_mock_user_list, {})
+
+
+@pytest.mark.parametrize('sync_processes', [0, 3])
+def test_change_limits(get_mock_user_list, sync_processes):
+    # the sample sync updates two users, removes three from groups, and finds three strays
+    options = {'sync_processes': sync_processes, 'max_adobe_users_updated': 2, 'max_adobe_group_removals': 3,
+               'max_adobe_only_users': 3, 'stop_at_max_adobe_only_users': True}
+    sync_sample_users(get_mock_user_list, options)
+    for name in ('max_adobe_users_updated', 'max_adobe_group_removals', 'max_adobe_only_users'):
+        with pytest.raises(AssertionException) as error:
+            sync_sample_users(get_mock_user_list, dict(options, **{name: options[name] - 1}))
+        assert name in str(error.value)
+
+
+def test_change_limit_drops_user_cache(tmpdir):
+    # a run stopped by a limit after sending actions leaves no snapshot, so the next run reads the server
+    pages = [[make_user('user1@example.com', ['Group A'])]]
+    connector = make_umapi_connector(pages, 0, UmapiUserCache(str(tmpdir), 'org_id', 3600, logging.getLogger('test')))
+    list(connector.iter_users())
+    connector.save_user_cache()
+    rp = RuleProcessor({'max_adobe_users_updated': 0})
+
+    def sync_umapi_users(umapi_connectors):
+        commands = Commands('federatedID', 'user1@example.com', 'user1@example.com', 'example.com')
+        commands.add_groups({'group b'})
+        connector.send_commands(commands)
+        connector.get_action_manager().flush()
+        rp.update_limit.add(1)
+
+    rp.sync_umapi_users = sync_umapi_users
+    with pytest.raises(AssertionException) as error:
+        rp.run({}, mock.MagicMock(), UmapiConnectors(connector, {}))
+    assert 'max_adobe_users_updated' in str(error.value)
+    connector = make_umapi_connector(pages, 0, UmapiUserCache(str(tmpdir), 'org_id', 3600, logging.getLogger('test')))
+    assert len(list(connector.iter_users())) == 1
+    assert connector.connection.query_multiple.call_count == 1
+
+
+@pytest.mark.parametrize('sync_processes', [0, 3])
+def test_stray_limit_default(get_mock_user_list, sync_processes):
+    # by default, going over max_adobe_only_users doesn't stop the run; the rest of the sync goes ahead
+    # and only the processing of the strays is skipped (see test_process_strays)
+    options = {'sync_processes': sync_processes}
+    assert sync_sample_users(get_mock_user_list, dict(options, max_adobe_only_users=2)) == \
+        sync_sample_users(get_mock_user_list, dict(options, max_adobe_only_users=200))
+    rp = RuleProcessor({'remove_strays': True, 'max_adobe_only_users': 0})
+    assert rp.stray_limit.limit is None
+    rp.stray_limit.add(10)
+
+
+def test_change_limit_percentage():
+    change_limit = ChangeLimit('max_adobe_users_created', '50%', 'Adobe users created')
+    # a percentage limit doesn't apply until its base is known
+    change_limit.add(5)
+    change_limit.set_base(20)
+    change_limit.add(5)
+    with pytest.raises(AssertionException):
+        change_limit.add()
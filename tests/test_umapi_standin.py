@@ -0,0 +1,123 @@
+import threading
+
+import pytest
+import requests
+import umapi_client
+from umapi_client.auth import Auth
+
+import user_sync.certgen
+from user_sync.connector.umapi import Commands, UmapiConnector
+from user_sync.connector.umapi_util import RateLimiter, limit_connection
+from user_sync.umapi_standin import StandinPopulation, StandinServer
+
+
+@pytest.fixture
+def make_server():
+    servers = []
+
+    def make(**kwargs):
+        population = StandinPopulation(450, 10, 2)
+        server = StandinServer(('localhost', 0), population, page_size=200, **kwargs)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        servers.append(server)
+        return server
+
+    yield make
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def make_connection(server):
+    return umapi_client.Connection('org_id', auth=Auth('api_key', 'token'), ssl_verify=False,
+                                   user_management_endpoint='https://localhost:%d/v2/usermanagement'
+                                                            % server.server_address[1],
+                                   retry_first_delay=0, retry_random_delay=0)
+
+
+def test_queries(make_server):
+    connection = make_connection(make_server())
+    users = list(umapi_client.UsersQuery(connection))
+    assert len(users) == 450
+    assert users[0]['email'] == 'user0000000@example.com'
+    assert users[0]['groups'] == ['Group 0', 'Group 1']
+    assert len(list(umapi_client.UsersQuery(connection, in_group='group 1'))) == 90
+    assert len(list(umapi_client.GroupsQuery(connection))) == 10
+
+
+def test_actions(make_server):
+    server = make_server()
+    connection = make_connection(server)
+    create = umapi_client.UserAction(umapi_client.IdentityTypes.federatedID, email='new@example.com')
+    create.create(first_name='New', country='US').add_to_groups(['Group 3'])
+    update = umapi_client.UserAction(umapi_client.IdentityTypes.federatedID, email='user0000001@example.com')
+    update.update(last_name='Changed').remove_from_groups(all_groups=True)
+    remove = umapi_client.UserAction(umapi_client.IdentityTypes.federatedID, email='user0000002@example.com')
+    remove.remove_from_organization()
+    missing = umapi_client.UserAction(umapi_client.IdentityTypes.federatedID, email='nobody@example.com')
+    missing.add_to_groups(['Group 3'])
+    assert connection.execute_multiple([create, update, remove, missing], immediate=True) == (0, 4, 3)
+    assert missing.execution_errors()[0]['errorCode'] == 'error.user.nonexistent'
+
+    users = {u['email']: u for u in umapi_client.UsersQuery(connection)}
+    assert len(users) == 450
+    assert users['new@example.com']['groups'] == ['Group 3']
+    assert users['user0000001@example.com']['lastname'] == 'Changed'
+    assert users['user0000001@example.com']['groups'] == []
+    assert 'user0000002@example.com' not in users
+
+    summary = server.stats.get_summary()['requests']
+    assert summary['action']['count'] == 1
+    assert summary['users']['statuses'] == {'200': 3}
+
+
+def test_throttling(make_server):
+    server = make_server(rate_limit=1, retry_after=30)
+    url = 'https://localhost:%d/v2/usermanagement/users/org_id/0' % server.server_address[1]
+    assert requests.get(url, verify=False).status_code == 200
+    response = requests.get(url, verify=False)
+    assert response.status_code == 429
+    assert response.headers['Retry-After'] == '30'
+    stats = requests.get('https://localhost:%d/standin/stats' % server.server_address[1], verify=False).json()
+    assert stats['requests']['users']['statuses'] == {'200': 1, '429': 1}
+
+
+def test_umapi_connector(make_server, tmpdir):
+    server = make_server()
+    key_file = str(tmpdir.join('private.key'))
+    user_sync.certgen.generate(key_file, str(tmpdir.join('certificate.crt')),
+                               user_sync.certgen.get_subject_fields(True))
+    host = 'localhost:%d' % server.server_address[1]
+    connector = UmapiConnector('', {
+        'server': {'host': host, 'ims_host': host, 'ssl_verify': False},
+        'enterprise': {'org_id': 'org_id', 'tech_acct': 'tech_acct', 'api_key': 'api_key',
+                       'client_secret': 'client_secret', 'priv_key_path': key_file},
+    })
+    assert len(connector.get_users()) == 450
+    results = []
+    for i in range(15):
+        commands = Commands('federatedID', 'user%07d@example.com' % i, 'user%07d@example.com' % i, 'example.com')
+        commands.add_groups({'group 9'})
+        connector.send_commands(commands, results.append)
+    connector.get_action_manager().flush()
+    assert len(results) == 15 and all(r['is_success'] for r in results)
+    assert len(list(connector.iter_users(in_group='Group 9'))) == 90 + 13
+    # group-level actions
+    connector.add_users_to_group('Group 5', ['user%07d@example.com' % i for i in range(250)])
+    connector.get_action_manager().flush()
+    assert len(list(connector.iter_users(in_group='Group 5'))) == 250 + 90 - 50
+    assert server.stats.get_summary()['requests']['ims']['count'] == 1
+
+
+def test_rate_limited_connection(make_server):
+    server = make_server(rate_limit=2, retry_after=1)
+    connection = make_connection(server)
+    limiter = RateLimiter()
+    limit_connection(connection, limiter)
+    assert len(list(umapi_client.UsersQuery(connection))) == 450
+    requests_sent, throttled, rate, wait_time = limiter.get_statistics()
+    assert throttled >= 1
+    assert rate is not None
+    assert server.stats.get_summary()['requests']['users']['statuses']['200'] == 3
@@ -0,0 +1,57 @@
+import logging
+
+import pytest
+
+from user_sync.connector.helper import DirectoryUser
+from user_sync.user_store import ExternalUserStore, StoredDirectoryUsers, StoredUserGroups, StoredUserKeySet, \
+    merge_sorted
+
+
+@pytest.fixture
+def user_store(tmpdir):
+    store = ExternalUserStore(str(tmpdir), logging.getLogger('test'))
+    yield store
+    store.close()
+
+
+def test_merge_sorted():
+    left = [('a', 1), ('c', 3), ('d', 4)]
+    right = [('b', 20), ('c', 30), ('e', 50)]
+    assert list(merge_sorted(left, right)) == [
+        ('a', 1, None), ('b', None, 20), ('c', 3, 30), ('d', 4, None), ('e', None, 50)]
+    assert list(merge_sorted([], right)) == [('b', None, 20), ('c', None, 30), ('e', None, 50)]
+
+
+def test_directory_users(user_store):
+    users = StoredDirectoryUsers(user_store)
+    selected_users = StoredDirectoryUsers(user_store, selected=True)
+    users['b'] = DirectoryUser(email='b@example.com', groups=['one'])
+    users['a'] = DirectoryUser(email='a@example.com')
+    selected_users['b'] = users['b']
+    # a selected user is kept in memory until its groups are complete
+    assert selected_users['b']['email'] == 'b@example.com'
+    selected_users.store_selected_user('b', users['b'], {None: {'one'}})
+    selected_users.store_selected_user('b', users['b'], {None: {'two'}, 'umapi-2': {'three'}})
+    assert not selected_users.pending
+    assert len(users) == 2 and len(selected_users) == 1
+    assert 'a' in users and 'a' not in selected_users
+    assert selected_users.get('a') is None
+    with pytest.raises(KeyError):
+        selected_users['a']
+    assert selected_users['b'] == DirectoryUser(email='b@example.com', groups=['one'])
+    assert list(user_store.iter_selected_users())[0][1][1] == {None: {'one', 'two'}, 'umapi-2': {'three'}}
+    assert list(StoredUserGroups(user_store, 'umapi-2').items()) == [('b', {'three'})]
+
+
+def test_adobe_users_and_keys(user_store):
+    assert user_store.add_adobe_user(None, 'b', {'email': 'b'})
+    assert user_store.add_adobe_user(None, 'a', {'email': 'a'})
+    assert not user_store.add_adobe_user(None, 'a', {'email': 'other'})
+    assert user_store.add_adobe_user('umapi-2', 'a', {'email': 'a2'})
+    assert list(user_store.iter_adobe_users(None)) == [('a', {'email': 'a'}), ('b', {'email': 'b'})]
+    keys = StoredUserKeySet(user_store, 'created')
+    keys.add('z')
+    keys.add('y')
+    keys.add('z')
+    assert len(keys) == 2 and 'y' in keys and 'x' not in keys
+    assert list(keys) == ['y', 'z']
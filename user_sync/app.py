@@ -20,6 +20,7 @@
 
 import argparse
 import logging
+import multiprocessing
 import os
 import sys
 import click
@@ -32,11 +33,14 @@ import six
 import user_sync.config
 import user_sync.connector.directory
 import user_sync.connector.umapi
+import user_sync.connector.umapi_util
 import user_sync.helper
 import user_sync.lockfile
+import user_sync.plan
 import user_sync.rules
 import user_sync.cli
 import user_sync.resource
+import user_sync.umapi_standin
 from user_sync.error import AssertionException
 from user_sync.version import __version__ as app_version
 
@@ -131,6 +135,9 @@ def main():
               help='if membership in mapped groups differs between the enterprise directory and Adobe sides, '
                    'the group membership is updated on the Adobe side so that the memberships in mapped '
                    'groups match those on the enterprise directory side.')
+@click.option('--resume/--no-resume', default=None,
+              help='instead of syncing, send the actions that the last run recorded in its action journal '
+                   'but did not finish, if they are still needed.')
 @click.option('--strategy',
               help="whether to fetch and sync the Adobe directory against the customer directory "
                    "or just to push each customer user to the Adobe side.  Default is to fetch and sync.",
@@ -156,6 +163,46 @@ def main():
               help='user attributes on the Adobe side are updated from the directory.')
 def sync(**kwargs):
     """Run User Sync [default command]"""
+    run_user_sync(kwargs, begin_work)
+
+
+@main.command()
+@click.help_option('-h', '--help')
+@click.option('--plan-file', required=True,
+              help="path of the plan file to write.",
+              metavar='path-to-file')
+def plan(**kwargs):
+    """Work out a sync's changes and write them to a plan file, without sending them"""
+    plan_path = kwargs.pop('plan_file')
+    run_user_sync(kwargs, lambda config_loader: begin_work(config_loader, plan_path))
+
+
+# the plan command takes all the sync options
+plan.params.extend(p for p in sync.params if p.name != 'help')
+
+
+@main.command()
+@click.help_option('-h', '--help')
+@click.option('--plan-file', required=True,
+              help="path of a plan file written by the plan command.",
+              metavar='path-to-file')
+def apply(**kwargs):
+    """Send the changes in a plan file, without reading the directory"""
+    plan_path = kwargs.pop('plan_file')
+    run_user_sync(kwargs, lambda config_loader: apply_plan(config_loader, plan_path))
+
+
+# the apply command only needs the options for reading the config and sending changes
+apply.params.extend(p for p in sync.params if p.name in ('encoding_name', 'config_filename', 'test_mode'))
+
+
+def run_user_sync(kwargs, work):
+    """
+    Load the config, start logging, and do the work of a command while holding the lock.
+    :type kwargs: dict
+    :param work: does the work, given the config loader
+    :type work: callable(user_sync.config.ConfigLoader)
+    """
     run_stats = None
     try:
         # load the config files and start the file logger
@@ -172,7 +219,7 @@ def sync(**kwargs):
         lock = user_sync.lockfile.ProcessLock(lock_path)
         if lock.set_lock():
             try:
-                begin_work(config_loader)
+                work(config_loader)
             finally:
                 lock.unlock()
         else:
@@ -233,6 +280,59 @@ def docs():
         click.launch(url)
 
 
+@main.command()
+@click.help_option('-h', '--help')
+@click.option('--host', default='localhost', show_default=True,
+              help="Host name or address to listen on")
+@click.option('--port', type=int, default=8443, show_default=True,
+              help="Port to listen on")
+@click.option('--endpoint', default='/v2/usermanagement', show_default=True,
+              help="UMAPI endpoint path")
+@click.option('--users', 'user_count', type=int, default=10000, show_default=True,
+              help="Number of synthetic users in the organization")
+@click.option('--groups', 'group_count', type=int, default=50, show_default=True,
+              help="Number of synthetic groups in the organization")
+@click.option('--groups-per-user', type=int, default=3, show_default=True,
+              help="Number of groups each synthetic user is a member of")
+@click.option('--domain', default='example.com', show_default=True,
+              help="Domain of the synthetic users")
+@click.option('--page-size', type=int, default=200, show_default=True,
+              help="Number of users or groups in each query page")
+@click.option('--latency', type=float, default=0.0, show_default=True,
+              help="Milliseconds added to each UMAPI response")
+@click.option('--latency-jitter', type=float, default=0.0, show_default=True,
+              help="Up to this many more milliseconds are added at random to each UMAPI response")
+@click.option('--rate-limit', type=float, default=0.0, show_default=True,
+              help="UMAPI requests per second allowed before 429 responses (0 for no limit)")
+@click.option('--retry-after', type=int, default=1, show_default=True,
+              help="Retry-After seconds sent with 429 and 503 responses")
+@click.option('--error-rate', type=float, default=0.0, show_default=True,
+              help="Fraction of UMAPI requests that get a 503 response")
+@click.option('--seed', type=int, default=None,
+              help="Random seed, to make latency and errors repeatable")
+def umapi_standin(**kwargs):
+    """Run a local stand-in UMAPI server for testing"""
+    standin_logger = logging.getLogger('standin')
+    console_log_handler.setLevel(logging.INFO)
+    population = user_sync.umapi_standin.StandinPopulation(kwargs['user_count'], kwargs['group_count'],
+                                                           kwargs['groups_per_user'], kwargs['domain'])
+    server = user_sync.umapi_standin.StandinServer(
+        (kwargs['host'], kwargs['port']), population, endpoint=kwargs['endpoint'], page_size=kwargs['page_size'],
+        latency=kwargs['latency'] / 1000, latency_jitter=kwargs['latency_jitter'] / 1000,
+        rate_limit=kwargs['rate_limit'], retry_after=kwargs['retry_after'], error_rate=kwargs['error_rate'],
+        seed=kwargs['seed'], logger=standin_logger)
+    standin_logger.info('Stand-in UMAPI server listening on https://%s:%d%s (%d users, %d groups)',
+                        kwargs['host'], server.server_address[1], kwargs['endpoint'],
+                        kwargs['user_count'], kwargs['group_count'])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.stats.log_summary(standin_logger)
+
+
 def init_log(logging_config):
     """
     :type logging_config: user_sync.config.DictConfig
@@ -296,12 +396,21 @@ def log_parameters(argv, config_loader):
     logger.info('-------------------------------------')
 
 
-def begin_work(config_loader):
+def begin_work(config_loader, plan_path=None):
     """
     :type config_loader: user_sync.config.ConfigLoader
+    :param plan_path: if given, the changes are written to this plan file rather than sent
+    :type plan_path: str
     """
+    if config_loader.get_invocation_options()['resume']:
+        if plan_path is not None:
+            raise AssertionException('You cannot resume an earlier run when writing a plan')
+        resume_work(config_loader)
+        return
+
     directory_groups = config_loader.get_directory_groups()
     rule_config = config_loader.get_rule_options()
+    user_sync.connector.umapi_util.get_rate_limiter().configure(rule_config['max_requests_per_second'])
 
     # make sure that all the adobe groups are from known umapi connector names
     primary_umapi_config, secondary_umapi_configs = config_loader.get_umapi_options()
@@ -338,6 +447,33 @@ def begin_work(config_loader):
     if directory_connector is not None:
         directory_connector.state.additional_group_filters = additional_group_filters
 
+    umapi_connectors = create_umapi_connectors(primary_umapi_config, secondary_umapi_configs, rule_config)
+
+    rule_processor = user_sync.rules.RuleProcessor(rule_config, config_loader.group_registry)
+    if len(directory_groups) == 0 and rule_processor.will_process_groups():
+        logger.warning('No group mapping specified in configuration but --process-groups requested on command line')
+    if plan_path is None:
+        rule_processor.run(directory_groups, directory_connector, umapi_connectors)
+        return
+    plan_writer = user_sync.plan.PlanWriter(plan_path, logger)
+    umapi_connectors.get_primary_connector().set_plan_writer(plan_writer, None)
+    for umapi_name, umapi_connector in six.iteritems(umapi_connectors.get_secondary_connectors()):
+        umapi_connector.set_plan_writer(plan_writer, umapi_name)
+    complete = False
+    try:
+        rule_processor.run(directory_groups, directory_connector, umapi_connectors)
+        complete = True
+    finally:
+        plan_writer.close(complete)
+
+
+def create_umapi_connectors(primary_umapi_config, secondary_umapi_configs, rule_config):
+    """
+    :type primary_umapi_config: dict
+    :type secondary_umapi_configs: dict(str, dict)
+    :type rule_config: dict
+    :rtype: user_sync.rules.UmapiConnectors
+    """
     primary_name = '.primary' if secondary_umapi_configs else ''
     umapi_primary_connector = user_sync.connector.umapi.UmapiConnector(primary_name, primary_umapi_config)
     umapi_other_connectors = {}
@@ -345,13 +481,60 @@ def begin_work(config_loader):
         umapi_secondary_conector = user_sync.connector.umapi.UmapiConnector(".secondary.%s" % secondary_umapi_name,
                                                                             secondary_config)
         umapi_other_connectors[secondary_umapi_name] = umapi_secondary_conector
-    umapi_connectors = user_sync.rules.UmapiConnectors(umapi_primary_connector, umapi_other_connectors)
+    return user_sync.rules.UmapiConnectors(umapi_primary_connector, umapi_other_connectors,
+                                           rule_config['max_concurrent_requests'])
 
-    rule_processor = user_sync.rules.RuleProcessor(rule_config)
-    if len(directory_groups) == 0 and rule_processor.will_process_groups():
-        logger.warning('No group mapping specified in configuration but --process-groups requested on command line')
-    rule_processor.run(directory_groups, directory_connector, umapi_connectors)
+
+def resume_work(config_loader):
+    """
+    Send the actions that the last run journaled but did not finish.  Only the umapi connectors
+    are set up: the directory isn't read.
+    :type config_loader: user_sync.config.ConfigLoader
+    """
+    rule_config = config_loader.get_rule_options()
+    user_sync.connector.umapi_util.get_rate_limiter().configure(rule_config['max_requests_per_second'])
+    primary_umapi_config, secondary_umapi_configs = config_loader.get_umapi_options()
+    umapi_connectors = create_umapi_connectors(primary_umapi_config, secondary_umapi_configs, rule_config)
+    if all(umapi_connector.journal is None for umapi_connector in umapi_connectors.connectors):
+        raise AssertionException('To resume a run, the umapi connector configuration must have an action_journal')
+    replayed_counts = {}
+
+    def resume_actions(umapi_connector):
+        replayed_counts[umapi_connector.name] = umapi_connector.resume_actions()
+
+    umapi_connectors.run_concurrently(resume_actions, umapi_connectors.connectors)
+    umapi_connectors.execute_actions()
+    logger.info('---------------------------------- Resume Summary ----------------------------------')
+    for umapi_connector in umapi_connectors.connectors:
+        total_count, error_count = umapi_connector.get_action_manager().get_statistics()
+        logger.info('Number of actions replayed by %s: %d (UMAPI actions sent: %d, errors: %d)',
+                    umapi_connector.name, replayed_counts[umapi_connector.name], total_count, error_count)
+    logger.info('------------------------------------------------------------------------------------')
+
+
+def apply_plan(config_loader, plan_path):
+    """
+    Send the changes in a plan file.  Only the umapi connectors are set up: the directory isn't read.
+    :type config_loader: user_sync.config.ConfigLoader
+    :type plan_path: str
+    """
+    rule_config = config_loader.get_rule_options()
+    user_sync.connector.umapi_util.get_rate_limiter().configure(rule_config['max_requests_per_second'])
+    primary_umapi_config, secondary_umapi_configs = config_loader.get_umapi_options()
+    umapi_connectors = create_umapi_connectors(primary_umapi_config, secondary_umapi_configs, rule_config)
+    counts = user_sync.plan.apply_plan(plan_path, umapi_connectors, logger)
+    logger.info('---------------------------------- Plan Summary ----------------------------------')
+    logger.info('Number of user changes sent: %d', counts[user_sync.plan.USER_ENTRY])
+    logger.info('Number of group membership changes sent: %d', counts[user_sync.plan.GROUP_USERS_ENTRY])
+    logger.info('Number of user groups created: %d', counts[user_sync.plan.CREATE_GROUP_ENTRY])
+    for umapi_connector in umapi_connectors.connectors:
+        total_count, error_count = umapi_connector.get_action_manager().get_statistics()
+        logger.info('Number of UMAPI actions sent by %s (total, errors): (%d, %d)',
+                    umapi_connector.name, total_count, error_count)
+    logger.info('------------------------------------------------------------------------------------')
 
 
 if __name__ == '__main__':
+    # sync_processes and hook_processes start worker processes, which re-run the frozen exe
+    multiprocessing.freeze_support()
     main()
@@ -53,6 +53,7 @@ class ConfigLoader(object):
         'encoding_name': 'utf8',
         'exclude_unmapped_users': False,
         'process_groups': False,
+        'resume': False,
         'strategy': 'sync',
         'test_mode': False,
         'update_user_info': False,
@@ -68,6 +69,8 @@ class ConfigLoader(object):
         """
         self.logger = logging.getLogger('config')
         self.args = args
+        # the adobe groups named in this configuration
+        self.group_registry = user_sync.rules.AdobeGroupRegistry()
         self.main_config = self.load_main_config()
         self.invocation_options = self.load_invocation_options()
         self.directory_groups = self.load_directory_groups()
@@ -244,7 +247,7 @@ class ConfigLoader(object):
                         'You must specify the groups to read when using the adobe-users "group" option')
                 options['adobe_group_filter'] = []
                 for group in adobe_users_spec[1].split(','):
-                    options['adobe_group_filter'].append(user_sync.rules.AdobeGroup.create(group))
+                    options['adobe_group_filter'].append(self.group_registry.create(group))
             else:
                 raise AssertionException('Unknown option "%s" for adobe-users' % adobe_users_action)
         return options
@@ -358,7 +361,7 @@ class ConfigLoader(object):
 
             adobe_groups = item.get_list('adobe_groups', True)
             for adobe_group in adobe_groups or []:
-                group = user_sync.rules.AdobeGroup.create(adobe_group)
+                group = self.group_registry.create(adobe_group)
                 if group is None:
                     validation_message = ('Bad adobe group: "%s" in directory group: "%s"' %
                                           (adobe_group, directory_group))
@@ -380,8 +383,12 @@ class ConfigLoader(object):
                 options = DictConfig('extension', self.get_dict_from_sources(sources))
                 if options:
                     after_mapping_hook_text = options.get_string('after_mapping_hook', True)
-                    if after_mapping_hook_text is None:
+                    batch_hook_text = options.get_string('after_mapping_batch_hook', True)
+                    if after_mapping_hook_text is None and batch_hook_text is None:
                         raise AssertionError("No after_mapping_hook found in extension configuration")
+                    if after_mapping_hook_text is not None and batch_hook_text is not None:
+                        raise AssertionException("Extension can't have both an after_mapping_hook "
+                                                 "and an after_mapping_batch_hook")
         return options
 
     @staticmethod
@@ -465,7 +472,7 @@ class ConfigLoader(object):
         additional_groups = directory_config.get_list('additional_groups', True) or []
         try:
             additional_groups = [{'source': re.compile(r['source']),
-                                  'target': user_sync.rules.AdobeGroup.create(r['target'], index=False)}
+                                  'target': user_sync.rules.AdobeGroup.create(r['target'])}
                                  for r in additional_groups]
         except Exception as e:
             raise AssertionException("Additional group rule error: {}".format(str(e)))
@@ -504,7 +511,7 @@ class ConfigLoader(object):
         if exclude_group_names:
             exclude_groups = []
             for name in exclude_group_names:
-                group = user_sync.rules.AdobeGroup.create(name)
+                group = self.group_registry.create(name)
                 if not group or group.get_umapi_name() != user_sync.rules.PRIMARY_UMAPI_NAME:
                     validation_message = 'Illegal value for %s in config file: %s' % ('exclude_groups', name)
                     if not group:
@@ -517,31 +524,65 @@ class ConfigLoader(object):
 
         # get the limits
         limits_config = self.main_config.get_dict_config('limits')
-        max_missing = limits_config.get_value('max_adobe_only_users',(int, str),False)
-        percent_pattern = re.compile("(\d*(\.\d+)?%)")
-        if isinstance(max_missing, str) and percent_pattern.match(max_missing):
-            max_missing_percent = float(max_missing.strip('%'))
-            if 0.0 <= max_missing_percent <= 100.0:
-                options['max_adobe_only_users'] = max_missing
-            else:
-                raise AssertionException("max_adobe_only_users value must be less or equal than 100%")
-        else:
-            try:
-                options['max_adobe_only_users'] = int(max_missing)
-            except ValueError:
-                raise AssertionException("Unable to parse max_adobe_only_users value. Value must be a percentage or an integer.")
+        options['max_adobe_only_users'] = self.get_change_limit(limits_config, 'max_adobe_only_users', False)
+        stop_at_max_adobe_only_users = limits_config.get_bool('stop_at_max_adobe_only_users', True)
+        if stop_at_max_adobe_only_users is not None:
+            options['stop_at_max_adobe_only_users'] = stop_at_max_adobe_only_users
+        for limit_name in ('max_adobe_users_created', 'max_adobe_users_updated', 'max_adobe_group_removals'):
+            options[limit_name] = self.get_change_limit(limits_config, limit_name, True)
+        max_concurrent_requests = limits_config.get_int('max_concurrent_requests', True)
+        if max_concurrent_requests is not None:
+            if max_concurrent_requests < 1:
+                raise AssertionException("max_concurrent_requests value must be at least 1")
+            options['max_concurrent_requests'] = max_concurrent_requests
+        max_requests_per_second = limits_config.get_value('max_requests_per_second', (int, float), True)
+        if max_requests_per_second is not None:
+            if max_requests_per_second <= 0:
+                raise AssertionException("max_requests_per_second value must be greater than 0")
+            options['max_requests_per_second'] = max_requests_per_second
+        bulk_group_threshold = limits_config.get_int('bulk_group_threshold', True)
+        if bulk_group_threshold is not None:
+            if bulk_group_threshold < 1:
+                raise AssertionException("bulk_group_threshold value must be at least 1")
+            options['bulk_group_threshold'] = bulk_group_threshold
+        user_store_directory = limits_config.get_string('user_store_directory', True)
+        if user_store_directory is not None:
+            options['user_store_directory'] = user_store_directory
+        sync_processes = limits_config.get_int('sync_processes', True)
+        if sync_processes is not None:
+            if sync_processes < 0:
+                raise AssertionException("sync_processes value must be at least 0")
+            if sync_processes and user_store_directory is not None:
+                raise AssertionException("sync_processes can't be used with user_store_directory")
+            options['sync_processes'] = sync_processes
 
         # now get the directory extension, if any
         extension_config = self.get_directory_extension_options()
         if extension_config:
-            after_mapping_hook_text = extension_config.get_string('after_mapping_hook')
-            options['after_mapping_hook'] = compile(after_mapping_hook_text, '<per-user after-mapping-hook>', 'exec')
+            after_mapping_hook_text = extension_config.get_string('after_mapping_hook', True)
+            if after_mapping_hook_text is not None:
+                options['after_mapping_hook'] = compile(after_mapping_hook_text, '<per-user after-mapping-hook>',
+                                                        'exec')
+            else:
+                batch_hook_text = extension_config.get_string('after_mapping_batch_hook')
+                options['after_mapping_batch_hook'] = compile(batch_hook_text, '<batch after-mapping-hook>', 'exec')
+            hook_batch_size = extension_config.get_int('hook_batch_size', True)
+            if hook_batch_size is not None:
+                if hook_batch_size < 1:
+                    raise AssertionException("hook_batch_size value must be at least 1")
+                options['hook_batch_size'] = hook_batch_size
+            options['hook_cache'] = extension_config.get_string('hook_cache', True)
+            hook_processes = extension_config.get_int('hook_processes', True)
+            if hook_processes is not None:
+                if hook_processes < 0:
+                    raise AssertionException("hook_processes value must not be negative")
+                options['hook_processes'] = hook_processes
             options['extended_attributes'] = extension_config.get_list('extended_attributes', True) or []
             # declaration of extended adobe groups: this is needed for two reasons:
             # 1. it allows validation of group names, and matching them to adobe groups
             # 2. it allows removal of adobe groups not assigned by the hook
             for extended_adobe_group in extension_config.get_list('extended_adobe_groups', True) or []:
-                group = user_sync.rules.AdobeGroup.create(extended_adobe_group)
+                group = self.group_registry.create(extended_adobe_group)
                 if group is None:
                     message = 'Extension contains illegal extended_adobe_group spec: ' + str(extended_adobe_group)
                     raise AssertionException(message)
@@ -553,13 +594,36 @@ class ConfigLoader(object):
 
         # set the adobe group filter from the mapping, if requested.
         if options.get('adobe_group_mapped') is True:
-            options['adobe_group_filter'] = set(user_sync.rules.AdobeGroup.iter_groups())
+            options['adobe_group_filter'] = set(self.group_registry.iter_groups())
 
         return options
 
+    @staticmethod
+    def get_change_limit(limits_config, name, none_allowed):
+        """
+        Read a limit on the number of changes of some kind, which is either a count or a percentage.
+        :type limits_config: DictConfig
+        :type name: str
+        :type none_allowed: bool
+        :return: the count (int), the percentage (str ending in '%'), or None
+        """
+        value = limits_config.get_value(name, (int, str), none_allowed)
+        if value is None:
+            return None
+        percent_pattern = re.compile(r"(\d*(\.\d+)?%)")
+        if isinstance(value, str) and percent_pattern.match(value):
+            if 0.0 <= float(value.strip('%')) <= 100.0:
+                return value
+            raise AssertionException("%s value must be less or equal than 100%%" % name)
+        try:
+            return int(value)
+        except ValueError:
+            raise AssertionException("Unable to parse %s value. Value must be a percentage or an integer." % name)
+
     def create_umapi_options(self, connector_config_sources):
         options = self.get_dict_from_sources(connector_config_sources)
         options['test_mode'] = self.invocation_options['test_mode']
+        options['resume'] = self.invocation_options['resume']
         return options
 
     def check_unused_config_keys(self):
@@ -844,11 +908,15 @@ class ConfigFileLoader:
                              '/directory_users/connectors/*': (True, False, None),
                              '/directory_users/extension': (True, False, None),
                              '/logging/file_log_directory': (False, False, "logs"),
+                             '/limits/user_store_directory': (False, False, None),
                              }
 
     # like ROOT_CONFIG_PATH_KEYS, but for non-root configuration files
     SUB_CONFIG_PATH_KEYS = {'/enterprise/priv_key_path': (True, False, None),
-                            '/integration/priv_key_path': (True, False, None)}
+                            '/integration/priv_key_path': (True, False, None),
+                            '/user_cache/directory': (False, False, None),
+                            '/action_journal/directory': (False, False, None),
+                            '/hook_cache': (False, False, None)}
 
     @classmethod
     def load_root_config(cls, filename):
@@ -26,7 +26,7 @@ import user_sync.helper
 import user_sync.identity_type
 from user_sync.error import AssertionException
 from user_sync.version import __version__ as app_version
-from user_sync.connector.umapi_util import make_auth_dict
+from user_sync.connector.umapi_util import make_auth_dict, limit_connection
 from user_sync.helper import normalize_string
 from user_sync.identity_type import parse_identity_type
 
@@ -123,6 +123,7 @@ class AdobeConsoleConnector(object):
             )
         except Exception as e:
             raise AssertionException("Connection to org %s at endpoint %s failed: %s" % (org_id, um_endpoint, e))
+        limit_connection(self.connection)
         logger.debug('%s: connection established', self.name)
         self.umapi_users = []
         self.user_by_usr_key = {}
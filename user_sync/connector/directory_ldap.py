@@ -118,6 +118,7 @@ class LDAPDirectoryConnector(object):
         logger.debug('Connected')
         self.user_by_dn = {}
         self.additional_group_filters = None
+        self.member_group_cn_by_dn = {}
 
     @staticmethod
     def get_options(caller_config):
@@ -418,8 +419,12 @@ class LDAPDirectoryConnector(object):
         elif isinstance(groups, str):
             groups = [groups]
 
+        # the same groups turn up for many users, so each DN is only parsed once
+        cn_by_dn = self.member_group_cn_by_dn
         for group_dn in groups:
-            group_cn = self.get_cn_from_dn(group_dn)
+            group_cn = cn_by_dn.get(group_dn)
+            if group_cn is None:
+                group_cn = cn_by_dn[group_dn] = self.get_cn_from_dn(group_dn) or ''
             if group_cn:
                 group_names.append(group_cn)
         return group_names
@@ -20,6 +20,11 @@
 
 import logging
 
+try:
+    from collections.abc import MutableMapping
+except ImportError:
+    from collections import MutableMapping
+
 
 def create_logger(options):
     """
@@ -33,17 +38,154 @@ def create_logger(options):
 
 def create_blank_user():
     """
-    :rtype dict
-    """
-    user = {
-        "identity_type": None,
-        "username": None,
-        "domain": None,
-        "firstname": None,
-        "lastname": None,
-        "email": None,
-        "groups": [],
-        "country": None,
-    }
+    :rtype DirectoryUser
+    """
+    user = DirectoryUser(
+        identity_type=None,
+        username=None,
+        domain=None,
+        firstname=None,
+        lastname=None,
+        email=None,
+        groups=[],
+        country=None,
+    )
     return user
 
+
+class SharedValues(object):
+    """
+    One copy of each of the values that many users have in common, such as a domain, a country
+    code, or a tuple of groups.  Each run has its own, which it clears when it is done, so the
+    values don't outlive the users that share them.
+    """
+
+    def __init__(self):
+        self.values = {}
+
+    def share(self, value):
+        """
+        Return the shared copy of a value.
+        :type value: hashable
+        """
+        if value is None:
+            return None
+        return self.values.setdefault(value, value)
+
+    def clear(self):
+        self.values = {}
+
+
+class UserRecord(MutableMapping):
+    """
+    A user whose usual attributes are held in slots rather than a per-user dict, which is a
+    fraction of the size.  It behaves like the dict it replaces (including comparing equal
+    to a dict with the same items), so hook code and connectors can treat it as one.  Keys
+    outside the usual attributes are kept in an overflow dict.
+    """
+    __slots__ = ('_extra',)
+
+    # the keys held in slots, which subclasses must also list in __slots__
+    fields = ()
+    field_set = frozenset()
+    # the keys whose values are repeated across many users, and so are shared
+    shared_fields = frozenset()
+    # the keys whose values are lists of groups
+    group_fields = frozenset()
+
+    def __init__(self, *args, **kwargs):
+        self._extra = None
+        self.update(*args, **kwargs)
+
+    def __getitem__(self, key):
+        if key in self.field_set:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        if self._extra is None:
+            raise KeyError(key)
+        return self._extra[key]
+
+    def __setitem__(self, key, value):
+        if key in self.field_set:
+            setattr(self, key, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
+
+    def __delitem__(self, key):
+        if key in self.field_set:
+            try:
+                delattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        elif self._extra is None:
+            raise KeyError(key)
+        else:
+            del self._extra[key]
+
+    def __iter__(self):
+        for key in self.fields:
+            if hasattr(self, key):
+                yield key
+        if self._extra is not None:
+            for key in self._extra:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+    def copy(self):
+        return type(self)(self)
+
+    def compact(self, shared_values=None):
+        """
+        Replace the group lists with tuples and, if there are shared_values, replace the values
+        that many users have in common with their shared copies.  Call this once the user's groups
+        are complete.
+        :type shared_values: SharedValues
+        """
+        for key in self.group_fields:
+            groups = getattr(self, key, None)
+            if groups is not None and not isinstance(groups, tuple):
+                groups = tuple(groups)
+            if shared_values is not None:
+                groups = shared_values.share(groups)
+            if groups is not None:
+                setattr(self, key, groups)
+        if shared_values is not None:
+            for key in self.shared_fields:
+                value = getattr(self, key, None)
+                if value is not None:
+                    setattr(self, key, shared_values.share(value))
+        return self
+
+
+class DirectoryUser(UserRecord):
+    """
+    A user read from a directory connector.
+    """
+    fields = ('identity_type', 'username', 'domain', 'firstname', 'lastname', 'email', 'groups', 'country',
+              'uid', 'member_groups', 'source_attributes')
+    __slots__ = fields
+    field_set = frozenset(fields)
+    shared_fields = frozenset(('identity_type', 'domain', 'country'))
+    group_fields = frozenset(('groups', 'member_groups'))
+
+
+class AdobeUser(UserRecord):
+    """
+    A user read from a UMAPI organization.
+    """
+    fields = ('email', 'username', 'domain', 'firstname', 'lastname', 'country', 'type', 'status', 'groups',
+              'adminRoles', 'id')
+    __slots__ = fields
+    field_set = frozenset(fields)
+    shared_fields = frozenset(('domain', 'country', 'type', 'status'))
+    group_fields = frozenset(('groups', 'adminRoles'))
+
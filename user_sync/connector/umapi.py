@@ -18,8 +18,12 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import itertools
 import json
 import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 # import helper
 
 import jwt
@@ -27,12 +31,15 @@ import six
 import umapi_client
 
 import user_sync.connector.helper
+import user_sync.connector.umapi_journal
 import user_sync.config
 import user_sync.helper
 import user_sync.identity_type
 from user_sync.error import AssertionException
 from user_sync.version import __version__ as app_version
-from user_sync.connector.umapi_util import make_auth_dict
+from user_sync.connector.umapi_cache import UmapiUserCache
+from user_sync.connector.umapi_journal import ActionJournal, get_current_actions
+from user_sync.connector.umapi_util import make_auth_dict, limit_connection
 
 try:
     from jwt.contrib.algorithms.pycrypto import RSAAlgorithm
@@ -55,6 +62,7 @@ class UmapiConnector(object):
         builder = user_sync.config.OptionsBuilder(caller_config)
         builder.set_string_value('logger_name', self.name)
         builder.set_bool_value('test_mode', False)
+        builder.set_bool_value('resume', False)
         options = builder.get_options()
 
         server_config = caller_config.get_dict_config('server', True)
@@ -65,7 +73,38 @@ class UmapiConnector(object):
         server_builder.set_string_value('ims_endpoint_jwt', '/ims/exchange/jwt')
         server_builder.set_int_value('timeout', 120)
         server_builder.set_int_value('retries', 3)
+        server_builder.set_bool_value('ssl_verify', True)
+        server_builder.set_int_value('batch_size', 10)
+        server_builder.set_int_value('sender_threads', 0)
+        server_builder.set_int_value('sender_queue_size', 10)
+        server_builder.set_int_value('read_threads', 0)
+        server_builder.set_int_value('group_action_size', 100)
         options['server'] = server_options = server_builder.get_options()
+        if server_options['batch_size'] < 1:
+            raise AssertionException('%s: server batch_size must be at least 1' % self.name)
+        if server_options['sender_threads'] < 0:
+            raise AssertionException('%s: server sender_threads must not be negative' % self.name)
+        if server_options['sender_queue_size'] < 1:
+            raise AssertionException('%s: server sender_queue_size must be at least 1' % self.name)
+        if server_options['read_threads'] < 0:
+            raise AssertionException('%s: server read_threads must not be negative' % self.name)
+        self.read_threads = server_options['read_threads']
+        if server_options['group_action_size'] < 1:
+            raise AssertionException('%s: server group_action_size must be at least 1' % self.name)
+        self.group_action_size = server_options['group_action_size']
+
+        user_cache_config = caller_config.get_dict_config('user_cache', True)
+        user_cache_builder = user_sync.config.OptionsBuilder(user_cache_config)
+        user_cache_builder.set_string_value('directory', None)
+        user_cache_builder.set_int_value('max_age', 86400)
+        options['user_cache'] = user_cache_options = user_cache_builder.get_options()
+        if user_cache_options['max_age'] < 0:
+            raise AssertionException('%s: user_cache max_age must not be negative' % self.name)
+
+        action_journal_config = caller_config.get_dict_config('action_journal', True)
+        action_journal_builder = user_sync.config.OptionsBuilder(action_journal_config)
+        action_journal_builder.set_string_value('directory', None)
+        options['action_journal'] = action_journal_options = action_journal_builder.get_options()
 
         enterprise_config = caller_config.get_dict_config('enterprise')
         enterprise_builder = user_sync.config.OptionsBuilder(enterprise_config)
@@ -76,6 +115,10 @@ class UmapiConnector(object):
         self.logger = logger = user_sync.connector.helper.create_logger(options)
         if server_config:
             server_config.report_unused_values(logger)
+        if user_cache_config:
+            user_cache_config.report_unused_values(logger)
+        if action_journal_config:
+            action_journal_config.report_unused_values(logger)
         logger.debug('UMAPI initialized with options: %s', options)
 
         ims_host = server_options['ims_host']
@@ -83,46 +126,175 @@ class UmapiConnector(object):
         auth_dict = make_auth_dict(self.name, enterprise_config, org_id, enterprise_options['tech_acct'], logger)
         # this check must come after we fetch all the settings
         enterprise_config.report_unused_values(logger)
+        self.user_cache = None
+        self.plan_writer = None
+        self.plan_umapi_name = None
+        self.prefetch = None
+        if user_cache_options['directory']:
+            self.user_cache = UmapiUserCache(user_cache_options['directory'], org_id,
+                                             user_cache_options['max_age'], logger)
         # open the connection
         um_endpoint = "https://" + server_options['host'] + server_options['endpoint']
         logger.debug('%s: creating connection for org %s at endpoint %s', self.name, org_id, um_endpoint)
+        self.connection_options = {
+            'org_id': org_id,
+            'user_management_endpoint': um_endpoint,
+            'test_mode': options['test_mode'],
+            'user_agent': "user-sync/" + app_version,
+            'logger': self.logger,
+            'timeout_seconds': float(server_options['timeout']),
+            'retry_max_attempts': server_options['retries'] + 1,
+            'ssl_verify': server_options['ssl_verify'],
+            'throttle_actions': server_options['batch_size'],
+        }
         try:
             self.connection = connection = umapi_client.Connection(
-                org_id=org_id,
                 auth_dict=auth_dict,
                 ims_host=ims_host,
                 ims_endpoint_jwt=server_options['ims_endpoint_jwt'],
-                user_management_endpoint=um_endpoint,
-                test_mode=options['test_mode'],
-                user_agent="user-sync/" + app_version,
-                logger=self.logger,
-                timeout_seconds=float(server_options['timeout']),
-                retry_max_attempts=server_options['retries'] + 1,
+                **self.connection_options
             )
         except Exception as e:
             raise AssertionException("Connection to org %s at endpoint %s failed: %s" % (org_id, um_endpoint, e))
+        limit_connection(connection)
         logger.debug('%s: connection established', self.name)
         # wrap the connection in an action manager
-        self.action_manager = ActionManager(connection, org_id, logger)
+        self.action_manager = ActionManager(connection, org_id, logger, server_options['batch_size'],
+                                            server_options['sender_threads'], server_options['sender_queue_size'],
+                                            self.make_sender_connection)
+        self.journal = None
+        self.unfinished_actions = []
+        if action_journal_options['directory']:
+            self.journal = ActionJournal(action_journal_options['directory'], org_id, logger)
+            if options['resume']:
+                self.unfinished_actions = self.journal.load_unfinished()
+            # test mode changes nothing, so there is nothing to journal
+            if not options['test_mode']:
+                self.journal.resume = options['resume']
+                self.action_manager.journal = self.journal
+
+    def make_sender_connection(self):
+        """
+        Open another connection to the organization, for an action sender thread.  It reuses the
+        main connection's access token, so no further token exchange is needed.
+        :rtype: umapi_client.Connection
+        """
+        connection = umapi_client.Connection(auth=self.connection.auth, **self.connection_options)
+        limit_connection(connection)
+        return connection
 
     def get_users(self):
         return list(self.iter_users())
 
     def iter_users(self, in_group=None):
-        users = {}
+        """
+        Read all users, or all users in a group, from the organization.  If there is a user cache,
+        full reads come from its snapshot while that is fresh and refresh it otherwise.  If a full
+        read has been started by prefetch_users, this waits for it and returns its results.
+        :type in_group: str
+        """
+        if not in_group and self.prefetch is not None:
+            thread, result = self.prefetch
+            self.prefetch = None
+            thread.join()
+            if 'error' in result:
+                raise result['error']
+            self.logger.debug('%s: using %d prefetched users', self.name, len(result['users']))
+            return iter(result['users'])
+        return self.read_users(in_group)
+
+    def prefetch_users(self):
+        """
+        Start a full read of the organization's users on a background thread, buffering the
+        results for the next call to iter_users, so the read can overlap other work.
+        """
+        if self.prefetch is not None:
+            return
+        result = {}
+
+        def read():
+            try:
+                result['users'] = list(self.read_users())
+            except Exception as e:
+                result['error'] = e
+
+        thread = threading.Thread(target=read, name=self.name + '-prefetch')
+        # don't hold up exit if the run fails before the users are needed
+        thread.daemon = True
+        self.logger.debug('%s: reading users in the background', self.name)
+        thread.start()
+        self.prefetch = (thread, result)
+
+    def read_users(self, in_group=None):
+        if in_group or self.user_cache is None:
+            return self.iter_umapi_users(in_group)
+        if self.user_cache.load():
+            self.user_cache.refresh_stale(self.get_user)
+            return self.user_cache.iter_users()
+        return self.user_cache.record_users(self.iter_umapi_users())
+
+    def iter_umapi_users(self, in_group=None):
+        emails = set()
         try:
             if in_group:
                 u_query = umapi_client.UsersQuery(self.connection, in_group=in_group)
             else:
                 u_query = umapi_client.UsersQuery(self.connection)
+            if self.read_threads > 0:
+                u_query = self.iter_query_concurrently(u_query)
             for u in u_query:
                 email = u['email']
-                if not (email in users):
-                    users[email] = u
+                if not (email in emails):
+                    emails.add(email)
                     yield u
         except umapi_client.UnavailableError as e:
             raise AssertionException("Error contacting UMAPI server: %s" % e)
 
+    def iter_query_concurrently(self, query):
+        """
+        Run a multi-page query with up to read_threads page requests in flight, yielding
+        the results in page order.  The page count reported with the first page bounds
+        how far ahead we read; if the server doesn't report one, we read ahead until
+        we see the last page.
+        :type query: umapi_client.QueryMultiple
+        """
+        first_page = self.query_page(query, 0)
+        for value in first_page[0]:
+            yield value
+        if first_page[1] or not first_page[0]:
+            return
+        page_count = first_page[3] if len(first_page) > 3 else 0
+        next_page = 1
+        pending = deque()
+        with ThreadPoolExecutor(max_workers=self.read_threads) as executor:
+            while True:
+                while len(pending) < self.read_threads and (not page_count or next_page < page_count):
+                    pending.append(executor.submit(self.query_page, query, next_page))
+                    next_page += 1
+                if not pending:
+                    return
+                page = pending.popleft().result()
+                for value in page[0]:
+                    yield value
+                if page[1] or not page[0]:
+                    for future in pending:
+                        future.cancel()
+                    return
+
+    def query_page(self, query, page):
+        """
+        Fetch one page of a multi-page query.  Page reads count against the same
+        concurrent request cap as actions, when there is one.
+        :type query: umapi_client.QueryMultiple
+        :type page: int
+        :return: the tuple returned by umapi_client.Connection.query_multiple
+        """
+        request_slots = self.action_manager.request_slots
+        if request_slots is None:
+            return self.connection.query_multiple(query.object_type, page, query.url_params, query.query_params)
+        with request_slots:
+            return self.connection.query_multiple(query.object_type, page, query.url_params, query.query_params)
+
     def get_groups(self):
         return list(self.iter_groups())
 
@@ -143,8 +315,20 @@ class UmapiConnector(object):
         except umapi_client.UnavailableError as e:
             raise AssertionException("Error contacting UMAPI server: %s" % e)
 
+    def set_plan_writer(self, plan_writer, umapi_name):
+        """
+        Write this connector's changes to a plan, rather than sending them.
+        :type plan_writer: user_sync.plan.PlanWriter
+        :param umapi_name: the name the plan uses for this connector's organization
+        :type umapi_name: str
+        """
+        self.plan_writer = plan_writer
+        self.plan_umapi_name = umapi_name
+
     def create_group(self, name):
-        if name:
+        if name and self.plan_writer is not None:
+            self.plan_writer.add_create_group(self.plan_umapi_name, name)
+        elif name:
             group = umapi_client.UserGroupAction(group_name=name)
             group.create(description="Automatically created by User Sync Tool")
             return self.connection.execute_single(group)
@@ -157,11 +341,149 @@ class UmapiConnector(object):
         :type commands: Commands
         :type callback: callable(dict)
         """
-        if len(commands) > 0:
-            action_manager = self.get_action_manager()
-            action = action_manager.create_action(commands)
-            if action is not None:
-                action_manager.add_action(action, callback)
+        if len(commands) > 0 and self.plan_writer is not None:
+            self.plan_writer.add_commands(self.plan_umapi_name, commands)
+        elif len(commands) > 0:
+            if self.user_cache is not None and not self.options['test_mode']:
+                callback = self.user_cache.make_callback(commands, callback)
+            self.get_action_manager().add_commands(commands, callback)
+
+    def add_users_to_group(self, group_name, emails):
+        """
+        Add users to a group with group-level actions, rather than one action per user.
+        :type group_name: str
+        :type emails: list(str)
+        """
+        self.send_group_commands(group_name, emails, True)
+
+    def remove_users_from_group(self, group_name, emails):
+        """
+        :type group_name: str
+        :type emails: list(str)
+        """
+        self.send_group_commands(group_name, emails, False)
+
+    def send_group_commands(self, group_name, emails, add):
+        if self.plan_writer is not None:
+            if emails:
+                self.plan_writer.add_group_users(self.plan_umapi_name, group_name, emails, add)
+            return
+        action_manager = self.get_action_manager()
+        for i in range(0, len(emails), self.group_action_size):
+            chunk = emails[i:i + self.group_action_size]
+            action = umapi_client.UserGroupAction(group_name=group_name,
+                                                  requestID=action_manager.get_next_request_id())
+            if add:
+                action.add_users(users=chunk)
+            else:
+                action.remove_users(users=chunk)
+            callback = None
+            if self.user_cache is not None and not self.options['test_mode']:
+                callback = self.user_cache.make_group_callback(group_name, chunk, add)
+            action_manager.add_action(action, callback)
+
+    def flush_actions(self):
+        """
+        Send all the queued actions, so later ones are sent after them.
+        """
+        if self.plan_writer is not None:
+            self.plan_writer.add_flush(self.plan_umapi_name)
+        else:
+            self.get_action_manager().flush()
+
+    def get_user(self, email):
+        """
+        :type email: str
+        :return: the user with the given email, or None if there is no such user
+        :rtype: dict
+        """
+        try:
+            return umapi_client.UserQuery(self.connection, email).result() or None
+        except umapi_client.UnavailableError as e:
+            raise AssertionException("Error contacting UMAPI server: %s" % e)
+
+    def resume_actions(self):
+        """
+        Replay the actions that an earlier run journaled but did not finish.  The users each
+        action affects are read again, and only the parts of the action that would still make
+        a change are sent.
+        :return: the number of actions replayed
+        :rtype: int
+        """
+        def get_replay(entry):
+            request_id, intent = entry
+            if 'actions' in intent:
+                username = intent['username']
+                email = intent['email'] or (username if '@' in username else None)
+                if email is None:
+                    # there is no way to look up the user, so the action is sent as it was
+                    return request_id, intent
+                return request_id, dict(intent, actions=get_current_actions(intent['actions'], self.get_user(email)))
+            action = intent['action']
+            if 'usergroup' not in action:
+                self.logger.warning('Not replaying unknown action: %s', json.dumps(action))
+                return request_id, None
+            group_name = user_sync.helper.normalize_string(action['usergroup'])
+            steps = []
+            for step in action.get('do', []):
+                for add in (True, False):
+                    emails = []
+                    for email in step.get('add' if add else 'remove', {}).get('user', []):
+                        user = self.get_user(email)
+                        if user is None:
+                            continue
+                        in_group = group_name in {user_sync.helper.normalize_string(g) for g in user.get('groups', [])}
+                        if in_group != add:
+                            emails.append(email)
+                    steps.append((add, emails))
+            return request_id, {'group': action['usergroup'], 'steps': steps}
+
+        if not self.unfinished_actions:
+            return 0
+        self.logger.info('Checking %d unfinished actions from the action journal', len(self.unfinished_actions))
+        if self.user_cache is not None:
+            # keep the snapshot current as the changes are sent
+            self.user_cache.load()
+        replayed_ids = []
+        with ThreadPoolExecutor(max_workers=max(self.read_threads, 1)) as executor:
+            for request_id, replay in executor.map(get_replay, self.unfinished_actions):
+                if replay is not None and 'actions' in replay and replay['actions']:
+                    self.logger.info('Replaying action for user: %s', replay['username'])
+                    self.send_commands(Commands.from_dict(replay))
+                elif replay is not None and any(emails for _, emails in replay.get('steps', [])):
+                    self.logger.info('Replaying action for group: %s', replay['group'])
+                    for add, emails in replay['steps']:
+                        self.send_group_commands(replay['group'], emails, add)
+                elif replay is not None:
+                    self.logger.debug('Action %s is no longer needed', request_id)
+                    if self.action_manager.journal is not None:
+                        self.journal.record_outcome(request_id, user_sync.connector.umapi_journal.SKIPPED)
+                    continue
+                replayed_ids.append(request_id)
+        # the replays are journaled as new actions once they are sent
+        self.action_manager.flush()
+        if self.action_manager.journal is not None:
+            for request_id in replayed_ids:
+                self.journal.record_outcome(request_id, user_sync.connector.umapi_journal.REPLAYED)
+            self.journal.sync()
+        self.unfinished_actions = []
+        return len(replayed_ids)
+
+    def save_user_cache(self):
+        """
+        Write the user cache, if there is one, once all of this run's actions have been sent.
+        """
+        if self.user_cache is not None:
+            self.user_cache.save()
+
+    def drop_user_cache(self):
+        """
+        Delete the user cache, if there is one, when the run stops after some of its actions may
+        have been sent.  Those actions aren't all in the snapshot, so the next run reads the server.
+        """
+        if self.user_cache is not None and self.action_manager.get_statistics()[0] > 0:
+            self.user_cache.invalidate('the run stopped after sending actions')
+            self.user_cache.save()
 
 
 class Commands(object):
@@ -240,6 +562,40 @@ class Commands(object):
     def __len__(self):
         return len(self.do_list)
 
+    def to_dict(self):
+        """
+        :return: the commands, in a form that can be written as JSON
+        :rtype: dict
+        """
+        actions = []
+        for name, params in self.do_list:
+            params = dict(params)
+            if 'groups' in params:
+                params['groups'] = sorted(params['groups'])
+            if params.get('on_conflict') is not None:
+                params['on_conflict'] = params['on_conflict'].name
+            actions.append([name, params])
+        return {'identity_type': self.identity_type, 'email': self.email, 'username': self.username,
+                'domain': self.domain, 'actions': actions}
+
+    @classmethod
+    def from_dict(cls, content):
+        """
+        :param content: commands as returned by to_dict
+        :type content: dict
+        :rtype: Commands
+        """
+        commands = cls(content.get('identity_type'), content.get('email'), content.get('username'),
+                       content.get('domain'))
+        for name, params in content['actions']:
+            params = dict(params)
+            if 'groups' in params:
+                params['groups'] = set(params['groups'])
+            if params.get('on_conflict') is not None:
+                params['on_conflict'] = umapi_client.IfAlreadyExistsOptions[params['on_conflict']]
+            commands.do_list.append((name, params))
+        return commands
+
     def convert_user_attributes_to_params(self, attributes):
         params = {}
         for key, value in six.iteritems(attributes):
@@ -251,30 +607,60 @@ class Commands(object):
         return params
 
 
+# numbers the actions of every action manager, which may be making actions on several threads at once;
+# taking the next value from a count is a single step, so no two actions get the same number
+request_numbers = itertools.count(1)
+
+
 class ActionManager(object):
-    next_request_id = 1
 
-    def __init__(self, connection, org_id, logger):
+    def __init__(self, connection, org_id, logger, batch_size=10, sender_threads=0, sender_queue_size=10,
+                 connection_factory=None):
         """
+        If sender_threads is 0, each batch is sent from the calling thread as soon as it fills.
+        Otherwise full batches are put on a queue (holding at most sender_queue_size batches)
+        that is drained by that many background threads, so callers only block on the network
+        when the queue is full.
+        A umapi_client Connection keeps per-call state, so it can't send from several threads
+        at once.  If there is a connection_factory, each sender thread sends through its own
+        connection from it; otherwise sends through the shared connection take turns.
         :type connection: umapi_client.Connection
         :type org_id: str
         :type logger: logging.Logger
+        :type batch_size: int
+        :type sender_threads: int
+        :type sender_queue_size: int
+        :type connection_factory: callable() -> umapi_client.Connection
         """
         self.action_count = 0
         self.error_count = 0
         self.items = []
+        # queued items whose commands can still take more commands for the same user, by user
+        self.open_items = {}
         self.connection = connection
+        self.connection_factory = connection_factory
+        # serializes the sends made through the shared connection
+        self.connection_lock = threading.Lock()
         self.org_id = org_id
+        self.batch_size = max(int(batch_size), 1)
         self.logger = logger.getChild('action')
+        self.sender_thread_count = max(int(sender_threads), 0)
+        self.sender_queue = six.moves.queue.Queue(max(int(sender_queue_size), 1))
+        self.sender_threads = []
+        self.sender_error = None
+        # optional semaphore, shared with other action managers, that caps the requests in flight
+        self.request_slots = None
+        # optional ActionJournal that records each action's intent before it is sent, and its outcome
+        self.journal = None
+        # serializes result processing (statistics, logging, callbacks) across sender threads
+        self.lock = threading.RLock()
 
     def get_statistics(self):
         """Return the count of actions sent so far, and how many had errors."""
         return self.action_count, self.error_count
 
     def get_next_request_id(self):
-        request_id = 'action_%d' % ActionManager.next_request_id
-        ActionManager.next_request_id += 1
-        return request_id
+        return 'action_%d' % next(request_numbers)
 
     def create_action(self, commands):
         identity_type = commands.identity_type
@@ -306,43 +692,210 @@ class ActionManager(object):
 
     def add_action(self, action, callback=None):
         """
+        Queue an action for sending.  Queued actions are sent in batches of batch_size,
+        so the action may not be sent until enough others are queued or flush is called.
         :type action: umapi_client.UserAction
         :type callback: callable(umapi_client.UserAction, bool, dict)
         """
-        item = {
+        self._add_item({
             'action': action,
-            'callback': callback
+            'commands': None,
+            'callbacks': [callback] if callback else [],
+        })
+
+    def add_commands(self, commands, callback=None):
+        """
+        Queue commands for sending.  Until their action is sent, later commands for the
+        same user are merged into it, after the commands already there, so each user gets
+        one action with all of their steps in order.  The callback is invoked with the
+        result of the merged action.
+        :type commands: Commands
+        :type callback: callable(dict)
+        """
+        self._check_sender_error()
+        key = self._get_commands_key(commands)
+        item = self.open_items.get(key)
+        if item is not None and self._can_merge(item['commands'], commands):
+            if item['commands'].email is None:
+                item['commands'].email = commands.email
+            item['commands'].do_list.extend(commands.do_list)
+            if callback:
+                item['callbacks'].append(callback)
+            self.logger.debug('Merged commands for user: %s', commands.username)
+            return
+        # copy the commands, so merging doesn't change the caller's object
+        merged = Commands(commands.identity_type, commands.email, commands.username, commands.domain)
+        merged.do_list = list(commands.do_list)
+        item = {
+            'action': None,
+            'commands': merged,
+            'callbacks': [callback] if callback else [],
         }
+        self.open_items[key] = item
+        self._add_item(item)
+
+    @staticmethod
+    def _get_commands_key(commands):
+        return (commands.identity_type,
+                user_sync.helper.normalize_string(commands.username),
+                user_sync.helper.normalize_string(commands.domain or ''))
+
+    @staticmethod
+    def _can_merge(queued, commands):
+        """
+        Nothing can follow removal from the organization, and commands that name
+        different email addresses for the user stay in separate actions.
+        """
+        if any(name == 'remove_from_organization' for name, _ in queued.do_list):
+            return False
+        return (queued.email is None or commands.email is None or
+                user_sync.helper.normalize_string(queued.email) == user_sync.helper.normalize_string(commands.email))
+
+    def _add_item(self, item):
+        self._check_sender_error()
         self.items.append(item)
-        self.action_count += 1
-        self.logger.debug('Added action: %s', json.dumps(action.wire_dict()))
-        self._execute_action(action)
+        if len(self.items) >= self.batch_size:
+            self._execute_batch()
 
     def has_work(self):
-        return len(self.items) > 0
+        return len(self.items) > 0 or self.sender_queue.unfinished_tasks > 0
 
-    def _execute_action(self, action):
+    def _execute_batch(self):
         """
-        :type action: umapi_client.UserAction
+        Send (or hand off to the sender threads) the oldest batch of queued actions.
+        """
+        batch, self.items = self.items[:self.batch_size], self.items[self.batch_size:]
+        batch = [item for item in batch if self._prepare_item(item)]
+        if not batch:
+            return
+        if self.journal is not None:
+            # the batch's intents must be on disk before it is sent
+            self.journal.sync()
+        if not self.sender_thread_count:
+            self._send_batch(batch, self.connection, self.connection_lock)
+            return
+        if not self.sender_threads:
+            self._start_sender_threads()
+        # blocks while the queue is full, which keeps the producer from running too far ahead
+        self.sender_queue.put(batch)
+
+    def _prepare_item(self, item):
+        """
+        Close an item to further merging and make sure it has its action.
+        :return: False if no action could be made for the item's commands
+        """
+        commands = item['commands']
+        if commands is not None:
+            key = self._get_commands_key(commands)
+            if self.open_items.get(key) is item:
+                del self.open_items[key]
+            item['action'] = self.create_action(commands)
+            if item['action'] is None:
+                return False
+        with self.lock:
+            self.action_count += 1
+        self.logger.debug('Added action: %s', json.dumps(item['action'].wire_dict()))
+        if self.journal is not None:
+            intent = commands.to_dict() if commands is not None else {'action': item['action'].wire_dict()}
+            self.journal.record_intent(item['action'].frame.get('requestID'), intent)
+        return True
+
+    def _send_batch(self, batch, connection, connection_lock=None):
+        """
+        Send a batch of actions in a single multi-action request.
+        The connection may split actions that exceed its command or group limits, so
+        we always send immediately and account for the whole batch, whatever the
+        connection reports as its own sent count.
+        :type batch: list(dict)
+        :type connection: umapi_client.Connection
+        :param connection_lock: held while sending, if the connection is shared between threads
+        :type connection_lock: threading.Lock
         """
         try:
-            _, sent, _ = self.connection.execute_single(action)
+            if connection_lock is not None:
+                connection_lock.acquire()
+            try:
+                if self.request_slots is None:
+                    connection.execute_multiple([item['action'] for item in batch], immediate=True)
+                else:
+                    with self.request_slots:
+                        connection.execute_multiple([item['action'] for item in batch], immediate=True)
+            finally:
+                if connection_lock is not None:
+                    connection_lock.release()
         except umapi_client.BatchError as e:
-            self.process_sent_items(e.statistics[1], e)
+            self._process_batch(batch, e)
         except umapi_client.UnavailableError as e:
+            self._process_batch(batch, e)
             raise AssertionException("Error contacting UMAPI server: %s" % e)
         else:
-            self.process_sent_items(sent)
+            self._process_batch(batch)
+
+    def _start_sender_threads(self):
+        for i in range(self.sender_thread_count):
+            thread = threading.Thread(target=self._sender_loop, name='%s-sender-%d' % (self.logger.name, i))
+            thread.daemon = True
+            thread.start()
+            self.sender_threads.append(thread)
+
+    def _sender_loop(self):
+        connection, connection_lock = None, None
+        while True:
+            batch = self.sender_queue.get()
+            try:
+                if batch is None:
+                    return
+                if self.sender_error is not None:
+                    self._drop_batch(batch)
+                    continue
+                if connection is None:
+                    if self.connection_factory is None:
+                        connection, connection_lock = self.connection, self.connection_lock
+                    else:
+                        try:
+                            connection = self.connection_factory()
+                        except Exception:
+                            self._drop_batch(batch)
+                            raise
+                self._send_batch(batch, connection, connection_lock)
+            except Exception as e:
+                # remember the first failure; it is re-raised on the producer's thread
+                self.sender_error = self.sender_error or e
+            finally:
+                self.sender_queue.task_done()
+
+    def _drop_batch(self, batch):
+        """
+        Account for a batch that is not sent because an earlier batch failed.
+        :type batch: list(dict)
+        """
+        self._process_batch(batch, AssertionException("Not sent because an earlier batch failed"), sent=False)
+
+    def _check_sender_error(self):
+        if self.sender_error is not None:
+            error, self.sender_error = self.sender_error, None
+            self.shutdown()
+            raise error
 
     def flush(self):
-        try:
-            _, sent, _ = self.connection.execute_queued()
-        except umapi_client.BatchError as e:
-            self.process_sent_items(e.statistics[1], e)
-        except umapi_client.UnavailableError as e:
-            raise AssertionException("Error contacting UMAPI server: %s" % e)
-        else:
-            self.process_sent_items(sent)
+        """
+        Send all queued actions and wait for them to complete.
+        """
+        while self.items:
+            self._execute_batch()
+        self.sender_queue.join()
+        self._check_sender_error()
+
+    def shutdown(self):
+        """
+        Stop the sender threads (if any) once they have drained the queue.
+        They are restarted if more actions are sent later.
+        """
+        threads, self.sender_threads = self.sender_threads, []
+        for _ in threads:
+            self.sender_queue.put(None)
+        for thread in threads:
+            thread.join()
 
     def process_sent_items(self, total_sent, batch_error=None):
         """
@@ -353,29 +906,53 @@ class ActionManager(object):
         """
         # update queue
         sent_items, self.items = self.items[:total_sent], self.items[total_sent:]
+        sent_items = [item for item in sent_items if self._prepare_item(item)]
+        self._process_batch(sent_items, batch_error)
 
-        # collect sent actions, their errors, their callbacks
-        details = [(item['action'], item['action'].execution_errors(), item['callback']) for item in sent_items]
-
-        # log errors
-        if batch_error:
-            request_ids = str([action.frame.get("requestID") for action, _, _ in details])
-            self.logger.critical("Unexpected response! Sent actions %s may have failed: %s", request_ids, batch_error)
-            self.error_count += total_sent
-        else:
-            for action, errors, _ in details:
-                if errors:
-                    self.error_count += 1
-                    for error in errors:
-                        self.logger.error('Error in requestID: %s (User: %s, Command: %s): code: "%s" message: "%s"',
-                                          action.frame.get("requestID"),
-                                          error.get("target", "<Unknown>"), error.get("command", "<Unknown>"),
-                                          error.get('errorCode', "<None>"), error.get('message', "<None>"))
-        # invoke callbacks
-        for action, errors, callback in details:
-            if callable(callback):
-                callback({
-                    "action": action,
-                    "is_success": not batch_error and not errors,
-                    "errors": [batch_error] if batch_error else errors
-                })
+    def _process_batch(self, sent_items, batch_error=None, sent=True):
+        """
+        Log any processing errors for a sent batch, update the statistics, and invoke any callbacks.
+        Batches can complete on several sender threads, so this is serialized.
+        :param sent_items: queue items that were sent together
+        :param batch_error: exception for a batch-level error that affected all items, if there was one
+        :param sent: False if the items were never sent, in which case batch_error says why
+        """
+        with self.lock:
+            # collect sent actions, their errors, their callbacks
+            details = [(item['action'], item['action'].execution_errors(), item['callbacks'])
+                       for item in sent_items]
+
+            # log errors
+            if batch_error:
+                request_ids = str([action.frame.get("requestID") for action, _, _ in details])
+                if sent:
+                    self.logger.critical("Unexpected response! Sent actions %s may have failed: %s",
+                                         request_ids, batch_error)
+                else:
+                    self.logger.error("Actions %s were not sent: %s", request_ids, batch_error)
+                self.error_count += len(sent_items)
+            else:
+                for action, errors, _ in details:
+                    if errors:
+                        self.error_count += 1
+                        for error in errors:
+                            self.logger.error('Error in requestID: %s (User: %s, Command: %s): '
+                                              'code: "%s" message: "%s"',
+                                              action.frame.get("requestID"),
+                                              error.get("target", "<Unknown>"), error.get("command", "<Unknown>"),
+                                              error.get('errorCode', "<None>"), error.get('message', "<None>"))
+            if self.journal is not None:
+                for action, errors, _ in details:
+                    outcome = user_sync.connector.umapi_journal.FAILURE if batch_error or errors \
+                        else user_sync.connector.umapi_journal.SUCCESS
+                    self.journal.record_outcome(action.frame.get('requestID'), outcome)
+                self.journal.sync()
+            # invoke callbacks
+            for action, errors, callbacks in details:
+                for callback in callbacks:
+                    if callable(callback):
+                        callback({
+                            "action": action,
+                            "is_success": not batch_error and not errors,
+                            "errors": [batch_error] if batch_error else errors
+                        })
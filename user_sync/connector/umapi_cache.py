@@ -0,0 +1,287 @@
+# Copyright (c) 2016-2017 Adobe Inc.  All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import json
+import os
+import threading
+import time
+
+from umapi_client import IfAlreadyExistsOptions
+
+from user_sync.error import AssertionException
+from user_sync.helper import normalize_string
+
+
+class UmapiUserCache(object):
+    """
+    An on-disk snapshot of the users in one UMAPI organization.
+
+    A snapshot is taken whenever all of the organization's users are read from the server,
+    and is used in place of that read until it is older than max_age seconds.  Actions
+    that the server reports as successful are applied to the snapshot as they complete,
+    so it tracks the changes made by each run.  If an action fails, or can't be matched
+    to a user in the snapshot, the snapshot is invalidated and the next read goes to the server.
+    A create that leaves an existing user alone doesn't say what that user looks like, so
+    it only marks the user's entry as stale; stale entries are read again from the server
+    before the snapshot is next used.
+    """
+
+    # the user attributes that update commands can change, by UMAPI parameter name
+    attribute_names = {
+        'email': 'email',
+        'first_name': 'firstname',
+        'last_name': 'lastname',
+        'country': 'country',
+        'username': 'username',
+    }
+
+    def __init__(self, directory, org_id, max_age, logger):
+        """
+        :type directory: str
+        :type org_id: str
+        :type max_age: int
+        :type logger: logging.Logger
+        """
+        self.path = os.path.join(directory, org_id + '.json')
+        self.org_id = org_id
+        self.max_age = max_age
+        self.logger = logger
+        self.created = None
+        self.users = None
+        # the users whose entries must be read again, as email (or username) by key
+        self.stale = {}
+        self.changed = False
+        # snapshot updates come in on action sender threads
+        self.lock = threading.Lock()
+
+    def load(self):
+        """
+        Load the snapshot from disk, if there is one that isn't too old.
+        :return: whether a usable snapshot was loaded
+        """
+        if self.users is not None:
+            return True
+        try:
+            with open(self.path, 'r') as f:
+                content = json.load(f)
+        except (IOError, OSError, ValueError) as e:
+            if os.path.exists(self.path):
+                self.logger.warning("Ignoring unreadable user cache '%s': %s", self.path, e)
+            return False
+        if content.get('org_id') != self.org_id:
+            self.logger.warning("Ignoring user cache '%s': it is for a different organization", self.path)
+            return False
+        age = time.time() - content.get('created', 0)
+        if age > self.max_age:
+            self.logger.info("User cache '%s' is %d seconds old, so reading all users", self.path, age)
+            return False
+        self.created = content['created']
+        self.users = {self.get_key(u): u for u in content.get('users', [])}
+        self.stale = dict(content.get('stale', {}))
+        self.logger.info("Using user cache '%s' (%d users, %d seconds old)", self.path, len(self.users), age)
+        return True
+
+    def iter_users(self):
+        return iter(list(self.users.values()))
+
+    def refresh_stale(self, get_user):
+        """
+        Read the stale entries of a loaded snapshot again.
+        :param get_user: reads one user from the server by email or username, returning None if there is none
+        :type get_user: callable(str) -> dict
+        """
+        if not self.stale:
+            return
+        self.logger.info("Reading %d changed users for user cache '%s'", len(self.stale), self.path)
+        for key, name in sorted(self.stale.items()):
+            user = get_user(name)
+            with self.lock:
+                self.users.pop(key, None)
+                if user is not None:
+                    self.users[self.get_key(user)] = user
+        with self.lock:
+            self.stale = {}
+            self.changed = True
+
+    def record_users(self, users):
+        """
+        Wrap an iterator over a full read of the organization's users, so that the users
+        become the new snapshot if (and only if) the read is completed.
+        :type users: iterable(dict)
+        """
+        created = time.time()
+        snapshot = {}
+        for user in users:
+            snapshot[self.get_key(user)] = user
+            yield user
+        with self.lock:
+            self.created = created
+            self.users = snapshot
+            self.stale = {}
+            self.changed = True
+
+    def save(self):
+        """
+        Write the snapshot to disk, if it has been read or changed in this run.
+        """
+        with self.lock:
+            if not self.changed:
+                return
+            self.changed = False
+            directory = os.path.dirname(self.path)
+            temp_path = self.path + '.tmp'
+            try:
+                if directory and not os.path.isdir(directory):
+                    os.makedirs(directory)
+                if self.users is None:
+                    if os.path.exists(self.path):
+                        os.remove(self.path)
+                    return
+                with open(temp_path, 'w') as f:
+                    json.dump({'org_id': self.org_id, 'created': self.created,
+                               'users': list(self.users.values()), 'stale': self.stale}, f)
+                if hasattr(os, 'replace'):
+                    os.replace(temp_path, self.path)
+                else:
+                    if os.path.exists(self.path):
+                        os.remove(self.path)
+                    os.rename(temp_path, self.path)
+            except (IOError, OSError) as e:
+                raise AssertionException("Can't write user cache '%s': %s" % (self.path, e))
+            self.logger.debug("Wrote user cache '%s' (%d users)", self.path, len(self.users))
+
+    def invalidate(self, reason):
+        if self.users is not None:
+            self.logger.info("Invalidating user cache '%s': %s", self.path, reason)
+        self.users = None
+        self.stale = {}
+        self.changed = True
+
+    def make_callback(self, commands, callback=None):
+        """
+        Return an action callback that applies the given commands to the snapshot once
+        they've been sent successfully, then calls the given callback (if any).
+        :type commands: user_sync.connector.umapi.Commands
+        :type callback: callable(dict)
+        """
+        def update_cache(result):
+            with self.lock:
+                if self.users is not None:
+                    if result['is_success']:
+                        self.apply_commands(commands)
+                    else:
+                        self.invalidate('an action for %s failed' % commands.username)
+            if callable(callback):
+                callback(result)
+        return update_cache
+
+    def make_group_callback(self, group_name, users, add):
+        """
+        Return an action callback that applies a group-level membership change to the snapshot.
+        :param users: the users named by the group-level action
+        :type group_name: str
+        :type users: list(str)
+        :type add: bool
+        """
+        def update_cache(result):
+            with self.lock:
+                if self.users is None:
+                    return
+                if not result['is_success']:
+                    self.invalidate('an action for group %s failed' % group_name)
+                    return
+                keys_by_email = None
+                for name in users:
+                    key = self.get_key({'username': name})
+                    if key not in self.users:
+                        # the action named the user by an email address that isn't their username
+                        if keys_by_email is None:
+                            keys_by_email = {normalize_string(u['email']): k for k, u in self.users.items()
+                                             if u.get('email')}
+                        key = keys_by_email.get(normalize_string(name))
+                    if key is None:
+                        self.invalidate('%s is not in the cache' % name)
+                        return
+                    user = self.users[key]
+                    groups = [g for g in user['groups'] if normalize_string(g) != normalize_string(group_name)]
+                    user['groups'] = groups + [group_name] if add else groups
+                self.changed = True
+        return update_cache
+
+    def apply_commands(self, commands):
+        """
+        :type commands: user_sync.connector.umapi.Commands
+        """
+        key = self.get_key({'username': commands.username, 'domain': commands.domain, 'email': commands.email})
+        user = self.users.get(key)
+        for command_name, params in commands.do_list:
+            if command_name == 'create' and params.get('on_conflict') == IfAlreadyExistsOptions.ignoreIfAlreadyExists:
+                # the user may have existed already, in which case this changed nothing, so the
+                # user is read again rather than taking the attributes and groups from the commands
+                self.users.pop(key, None)
+                self.stale[key] = commands.email or commands.username
+                self.changed = True
+                return
+            if command_name == 'create':
+                if user is None:
+                    user = {'email': params.get('email', commands.email), 'username': commands.username,
+                            'domain': commands.domain, 'type': commands.identity_type,
+                            'firstname': None, 'lastname': None, 'country': None, 'groups': [],
+                            'status': 'active'}
+                    self.users[key] = user
+                self.update_attributes(user, params)
+            elif user is None:
+                self.invalidate('%s is not in the cache' % commands.username)
+                return
+            elif command_name == 'update':
+                self.update_attributes(user, params)
+            elif command_name == 'add_to_groups':
+                current = {normalize_string(g) for g in user['groups']}
+                user['groups'] = user['groups'] + sorted(g for g in params['groups']
+                                                         if normalize_string(g) not in current)
+            elif command_name == 'remove_from_groups':
+                if params.get('all_groups'):
+                    user['groups'] = []
+                else:
+                    removed = {normalize_string(g) for g in params['groups']}
+                    user['groups'] = [g for g in user['groups'] if normalize_string(g) not in removed]
+            elif command_name == 'remove_from_organization':
+                del self.users[key]
+                user = None
+            else:
+                self.invalidate('unknown command %s' % command_name)
+                return
+        self.changed = True
+
+    def update_attributes(self, user, params):
+        for param_name, attribute_name in self.attribute_names.items():
+            if param_name in params:
+                user[attribute_name] = params[param_name]
+
+    @staticmethod
+    def get_key(user):
+        """
+        Users are keyed by username, qualified by domain unless the username is an email address.
+        :type user: dict
+        """
+        username = normalize_string(user.get('username') or user.get('email'))
+        if '@' in username:
+            return username
+        return username + '@' + normalize_string(user.get('domain') or '')
@@ -0,0 +1,211 @@
+# Copyright (c) 2016-2017 Adobe Inc.  All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from user_sync.error import AssertionException
+from user_sync.helper import normalize_string
+
+# the outcomes of a journaled action
+SUCCESS = 'success'
+FAILURE = 'failure'
+# the action was replayed by a later run, which journaled the replay as a new action
+REPLAYED = 'replayed'
+# the action was no longer needed when a later run went to replay it
+SKIPPED = 'skipped'
+
+
+class ActionJournal(object):
+    """
+    An append-only, on-disk record of the actions sent to one UMAPI organization.
+
+    Before each action is sent, its intent (the commands for a user, or the wire form of
+    a group action) is written to the journal, and once the server has answered, its outcome
+    is written.  The journal is started afresh by each run that sends actions, but a run
+    that resumes an earlier one reads the journal first and appends to it.  The actions with
+    no outcome, or whose outcome was a failure, are the ones that run replays.  A run that
+    doesn't resume sets aside a journal with unfinished actions, rather than starting over it.
+
+    Entries are written through to the disk (with fsync) once per batch, by calling sync
+    before the batch is sent and again once its outcomes are written, so the journal
+    survives a crash of the host as well as of the run.
+    """
+
+    def __init__(self, directory, org_id, logger):
+        """
+        :type directory: str
+        :type org_id: str
+        :type logger: logging.Logger
+        """
+        self.path = os.path.join(directory, org_id + '.journal')
+        self.logger = logger
+        # whether this run resumes an earlier one
+        self.resume = False
+        self.file = None
+        # intents and outcomes are written from the action sender threads
+        self.lock = threading.Lock()
+
+    def load_unfinished(self):
+        """
+        Read the journal left by earlier runs.
+        :return: the intents of the actions that were not sent or failed, in the order they were sent,
+        as (request_id, intent)
+        :rtype: list(tuple(str, dict))
+        """
+        unfinished = OrderedDict()
+        try:
+            with open(self.path, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # the last line is cut short if the run died while writing it
+                        self.logger.warning("Ignoring unreadable line in action journal '%s'", self.path)
+                        continue
+                    request_id = entry.get('id')
+                    if 'intent' in entry:
+                        unfinished[request_id] = entry['intent']
+                    elif entry.get('outcome') in (SUCCESS, REPLAYED, SKIPPED):
+                        unfinished.pop(request_id, None)
+        except (IOError, OSError) as e:
+            if os.path.exists(self.path):
+                raise AssertionException("Can't read action journal '%s': %s" % (self.path, e))
+            self.logger.info("No action journal '%s', so there is nothing to resume", self.path)
+        return list(unfinished.items())
+
+    def open(self):
+        """
+        Open the journal for writing.  A run that resumes an earlier one appends to the journal;
+        any other run starts a new one, first renaming the old journal if it has unfinished actions.
+        """
+        directory = os.path.dirname(self.path)
+        try:
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            if not self.resume and os.path.exists(self.path) and self.load_unfinished():
+                saved_path = base_path = self.path + time.strftime('.%Y%m%d-%H%M%S')
+                count = 1
+                while os.path.exists(saved_path):
+                    count += 1
+                    saved_path = '%s-%d' % (base_path, count)
+                os.rename(self.path, saved_path)
+                self.logger.warning("Action journal '%s' has unfinished actions that were not resumed; "
+                                    "it was kept as '%s'", self.path, saved_path)
+            self.file = open(self.path, 'a' if self.resume else 'w')
+        except (IOError, OSError) as e:
+            raise AssertionException("Can't write action journal '%s': %s" % (self.path, e))
+        self.file.write(json.dumps({'run': time.time(), 'resume': self.resume}, sort_keys=True) + '\n')
+
+    def write(self, entry):
+        with self.lock:
+            if self.file is None:
+                # the journal is only opened once there is something to record, so a run
+                # that sends nothing (such as one that writes a plan) leaves it alone
+                self.open()
+            self.file.write(json.dumps(entry, sort_keys=True) + '\n')
+            self.file.flush()
+
+    def sync(self):
+        """
+        Make sure the entries written so far are on disk, not just in the operating system's cache.
+        """
+        with self.lock:
+            if self.file is None:
+                return
+            self.file.flush()
+            try:
+                os.fsync(self.file.fileno())
+            except (IOError, OSError) as e:
+                raise AssertionException("Can't write action journal '%s': %s" % (self.path, e))
+
+    def record_intent(self, request_id, intent):
+        """
+        :type request_id: str
+        :param intent: the commands for a user (as from Commands.to_dict), or {'action': wire_dict}
+        :type intent: dict
+        """
+        self.write({'id': request_id, 'intent': intent})
+
+    def record_outcome(self, request_id, outcome):
+        """
+        :type request_id: str
+        :type outcome: str
+        """
+        self.write({'id': request_id, 'outcome': outcome})
+
+
+# user attributes by UMAPI parameter name
+attribute_names = {
+    'email': 'email',
+    'first_name': 'firstname',
+    'last_name': 'lastname',
+    'country': 'country',
+}
+
+
+def get_current_actions(actions, user):
+    """
+    Work out which of a user's journaled actions still need to be done.
+    :param actions: the user's actions, as in Commands.to_dict
+    :type actions: list
+    :param user: the user as just read from the server, or None if the user doesn't exist
+    :type user: dict
+    :return: the actions that would still make a change
+    :rtype: list
+    """
+    current = []
+    groups = None if user is None else {normalize_string(g) for g in user.get('groups', [])}
+    for name, params in actions:
+        if name == 'create':
+            if user is not None:
+                continue
+            # everything after the creation applies to the new user
+            groups = set()
+            user = {}
+        elif user is None:
+            continue
+        elif name == 'update':
+            params = dict((key, value) for key, value in params.items()
+                          if key not in attribute_names or user.get(attribute_names[key]) != value)
+            if not params:
+                continue
+        elif name == 'add_to_groups':
+            params = dict(params, groups=[g for g in params['groups'] if normalize_string(g) not in groups])
+            if not params['groups']:
+                continue
+            groups.update(normalize_string(g) for g in params['groups'])
+        elif name == 'remove_from_groups':
+            if not params.get('all_groups'):
+                params = dict(params, groups=[g for g in params['groups'] if normalize_string(g) in groups])
+                if not params['groups']:
+                    continue
+                groups.difference_update(normalize_string(g) for g in params['groups'])
+            elif not groups:
+                continue
+            else:
+                groups = set()
+        elif name == 'remove_from_organization':
+            user = None
+        current.append([name, params])
+    return current
@@ -1,3 +1,10 @@
+import threading
+import time
+from collections import deque
+from email.utils import parsedate_tz, mktime_tz
+
+import requests
+
 from user_sync.error import AssertionException
 from crypto.PublicKey import  RSA
 
@@ -35,3 +42,146 @@ def make_auth_dict(name, config, org_id, tech_acct, logger):
                                      (config.get_full_scope(), e))
     auth_dict['private_key_data'] = key_data
     return auth_dict
+
+
+class RateLimiter(object):
+    """
+    A token bucket shared by all UMAPI connections in the process.
+
+    Requests wait for a token before they are sent.  When the server throttles a request,
+    every request waits out its Retry-After time, and the rate is halved; each successful
+    request then raises the rate a little, up to the configured maximum.  With no maximum,
+    requests are not limited until the first time they are throttled.
+    """
+    min_rate = 0.1
+    window = 10.0
+
+    def __init__(self, max_rate=None):
+        """
+        :param max_rate: requests per second (None for no limit)
+        """
+        self.lock = threading.Lock()
+        self.configure(max_rate)
+
+    def configure(self, max_rate):
+        with self.lock:
+            self.max_rate = self.rate = float(max_rate) if max_rate else None
+            self.next_time = 0.0
+            self.paused_until = 0.0
+            self.decrease_after = 0.0
+            self.recent_times = deque()
+            self.request_count = 0
+            self.throttled_count = 0
+            self.wait_time = 0.0
+
+    def acquire(self):
+        """
+        Wait until a request can be sent.
+        """
+        with self.lock:
+            now = time.time()
+            start = max(now, self.paused_until)
+            if self.rate:
+                # next_time is when the request would go if they were evenly spaced,
+                # but bursts of up to a second's worth of requests are allowed
+                interval = 1.0 / self.rate
+                next_time = max(self.next_time, start)
+                start = max(start, next_time - (max(self.rate, 1.0) - 1) * interval)
+                self.next_time = next_time + interval
+            delay = start - now
+            self.request_count += 1
+            self.wait_time += delay
+            self.recent_times.append(start)
+            while self.recent_times and self.recent_times[0] < now - self.window:
+                self.recent_times.popleft()
+        if delay > 0:
+            time.sleep(delay)
+
+    def throttled(self, retry_after):
+        """
+        Note that a request was throttled, and hold all requests for the given number of seconds.
+        """
+        with self.lock:
+            now = time.time()
+            self.throttled_count += 1
+            self.paused_until = max(self.paused_until, now + max(retry_after, 1))
+            # requests already in flight when the server started throttling will be throttled too,
+            # so only slow down once for each pause
+            if now >= self.decrease_after:
+                if self.rate:
+                    rate = self.rate
+                else:
+                    elapsed = now - self.recent_times[0] if self.recent_times else 0.0
+                    rate = len(self.recent_times) / max(elapsed, 1.0)
+                self.rate = max(rate / 2, self.min_rate)
+                self.decrease_after = self.paused_until
+
+    def succeeded(self):
+        with self.lock:
+            if self.rate:
+                # roughly one more request per second for each second of success
+                self.rate += 1.0 / self.rate
+                if self.max_rate:
+                    self.rate = min(self.rate, self.max_rate)
+
+    def get_statistics(self):
+        """
+        :return: the number of requests, the number that were throttled, the current rate
+        (None if there is no limit), and the total seconds requests waited
+        """
+        with self.lock:
+            return self.request_count, self.throttled_count, self.rate, self.wait_time
+
+
+rate_limiter = RateLimiter()
+
+
+def get_rate_limiter():
+    """
+    :rtype: RateLimiter
+    """
+    return rate_limiter
+
+
+class RateLimitedAdapter(requests.adapters.HTTPAdapter):
+    """
+    Sends a connection's requests through a RateLimiter.
+    """
+
+    def __init__(self, limiter, **kwargs):
+        requests.adapters.HTTPAdapter.__init__(self, **kwargs)
+        self.limiter = limiter
+
+    def send(self, request, **kwargs):
+        self.limiter.acquire()
+        response = requests.adapters.HTTPAdapter.send(self, request, **kwargs)
+        if response.status_code == 429:
+            self.limiter.throttled(get_retry_after(response.headers.get('Retry-After')))
+        else:
+            self.limiter.succeeded()
+        return response
+
+
+def get_retry_after(value):
+    """
+    :param value: a Retry-After header value, which is either seconds or a date
+    :return: seconds
+    """
+    if not value:
+        return 0
+    try:
+        return int(value)
+    except ValueError:
+        date = parsedate_tz(value)
+        return mktime_tz(date) - time.time() if date else 0
+
+
+def limit_connection(connection, limiter=None):
+    """
+    Send all of a umapi_client Connection's requests through the shared rate limiter.
+    :type connection: umapi_client.Connection
+    :type limiter: RateLimiter
+    """
+    adapter = RateLimitedAdapter(limiter or get_rate_limiter())
+    connection.session.mount('https://', adapter)
+    connection.session.mount('http://', adapter)
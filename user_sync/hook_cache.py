@@ -0,0 +1,115 @@
+# Copyright (c) 2016-2017 Adobe Inc.  All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import hashlib
+import json
+import marshal
+import os
+
+from user_sync.error import AssertionException
+
+
+class HookResultCache(object):
+    """
+    An on-disk record of the after-mapping hook's results from earlier runs.
+
+    Results are keyed by a hash of everything the hook sees for a user: the source attributes
+    and groups, and the target attributes and groups before the hook runs.  The file also
+    records a hash of the hook code, and is ignored if the code has changed.  This is only
+    correct for hook code whose results depend on nothing but those inputs.  Each run writes
+    back just the results it used, so users who have left the directory drop out of the cache.
+    """
+
+    def __init__(self, path, code, logger):
+        """
+        :type path: str
+        :param code: the compiled hook code
+        :type logger: logging.Logger
+        """
+        self.path = path
+        self.code_hash = hashlib.sha256(marshal.dumps(code)).hexdigest()
+        self.logger = logger
+        self.previous_results = {}
+        self.results = {}
+        self.hits = 0
+
+    def load(self):
+        try:
+            with open(self.path, 'r') as f:
+                content = json.load(f)
+        except (IOError, OSError, ValueError) as e:
+            if os.path.exists(self.path):
+                self.logger.warning("Ignoring unreadable hook cache '%s': %s", self.path, e)
+            return
+        if content.get('code_hash') != self.code_hash:
+            self.logger.info("Ignoring hook cache '%s': the hook code has changed", self.path)
+            return
+        self.previous_results = content.get('results', {})
+        self.logger.info("Using hook cache '%s' (%d users)", self.path, len(self.previous_results))
+
+    def get(self, key):
+        """
+        :type key: str
+        :return: the cached (target_attributes, target_groups), or None
+        """
+        result = self.previous_results.get(key)
+        if result is None:
+            return None
+        self.hits += 1
+        self.results[key] = result
+        return result[0], set(result[1])
+
+    def put(self, key, target_attributes, target_groups):
+        """
+        :type key: str
+        :type target_attributes: dict
+        :type target_groups: set(str)
+        """
+        self.results[key] = (dict(target_attributes), sorted(target_groups))
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        temp_path = self.path + '.tmp'
+        try:
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(temp_path, 'w') as f:
+                json.dump({'code_hash': self.code_hash, 'results': self.results}, f)
+            if hasattr(os, 'replace'):
+                os.replace(temp_path, self.path)
+            else:
+                if os.path.exists(self.path):
+                    os.remove(self.path)
+                os.rename(temp_path, self.path)
+        except (IOError, OSError) as e:
+            raise AssertionException("Can't write hook cache '%s': %s" % (self.path, e))
+        self.logger.debug("Wrote hook cache '%s' (%d users, %d reused)", self.path, len(self.results), self.hits)
+
+    @staticmethod
+    def get_key(hook_user):
+        """
+        :param hook_user: the hook's variables for one user, before it runs
+        :type hook_user: dict
+        :rtype: str
+        """
+        content = json.dumps([hook_user['source_attributes'], sorted(hook_user['source_groups']),
+                              hook_user['target_attributes'], sorted(hook_user['target_groups'])],
+                             sort_keys=True, default=repr)
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
@@ -0,0 +1,212 @@
+# Copyright (c) 2016-2017 Adobe Inc.  All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import json
+import os
+import threading
+import time
+
+import six
+
+from user_sync.connector.umapi import Commands
+from user_sync.error import AssertionException
+
+PLAN_VERSION = 1
+
+# the kinds of entry in a plan
+USER_ENTRY = 'user'
+GROUP_USERS_ENTRY = 'group_users'
+CREATE_GROUP_ENTRY = 'create_group'
+FLUSH_ENTRY = 'flush'
+
+
+class PlanWriter(object):
+    """
+    Writes the changes worked out by a sync to a plan file, rather than sending them.
+
+    A plan is a JSON Lines file: a header line, one line per change, and an end line with
+    the number of changes, so that a plan cut short by a failed run can't be applied.  Each
+    change names the organization it is for (null for the primary).  Changes are written in
+    the order the sync made them, and flush entries mark the points where the sync waited for
+    an organization's changes to be sent, so applying the plan keeps the same ordering.
+    """
+
+    def __init__(self, path, logger):
+        """
+        :type path: str
+        :type logger: logging.Logger
+        """
+        self.path = path
+        self.logger = logger
+        self.entry_count = 0
+        # connectors for different organizations may write concurrently
+        self.lock = threading.Lock()
+        try:
+            directory = os.path.dirname(path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            self.file = open(path, 'w')
+        except (IOError, OSError) as e:
+            raise AssertionException("Can't write plan file '%s': %s" % (path, e))
+        self.write_line({'plan_version': PLAN_VERSION, 'created': time.time()})
+
+    def write_line(self, content):
+        self.file.write(json.dumps(content, sort_keys=True) + '\n')
+
+    def add_entry(self, entry):
+        with self.lock:
+            self.write_line(entry)
+            self.entry_count += 1
+
+    def add_commands(self, umapi_name, commands):
+        """
+        :type umapi_name: str
+        :type commands: Commands
+        """
+        entry = commands.to_dict()
+        entry.update(org=umapi_name, type=USER_ENTRY)
+        self.add_entry(entry)
+
+    def add_group_users(self, umapi_name, group_name, emails, add):
+        """
+        :type umapi_name: str
+        :type group_name: str
+        :type emails: list(str)
+        :param add: whether the users are added to the group, rather than removed
+        :type add: bool
+        """
+        self.add_entry({'org': umapi_name, 'type': GROUP_USERS_ENTRY, 'group': group_name,
+                        'add': add, 'users': list(emails)})
+
+    def add_create_group(self, umapi_name, group_name):
+        self.add_entry({'org': umapi_name, 'type': CREATE_GROUP_ENTRY, 'group': group_name})
+
+    def add_flush(self, umapi_name):
+        self.add_entry({'org': umapi_name, 'type': FLUSH_ENTRY})
+
+    def close(self, complete=True):
+        """
+        :param complete: whether the sync finished; if not, the plan is left without its end line
+        :type complete: bool
+        """
+        with self.lock:
+            if self.file is None:
+                return
+            if complete:
+                self.write_line({'end': True, 'entries': self.entry_count})
+            self.file.close()
+            self.file = None
+        if complete:
+            self.logger.info("Wrote plan file '%s' (%d changes)", self.path, self.entry_count)
+        else:
+            self.logger.warning("Plan file '%s' is incomplete and can't be applied", self.path)
+
+
+def read_plan(path):
+    """
+    Read the changes in a plan file, one at a time.
+    :type path: str
+    :return: an iterator over the plan's entries
+    """
+    try:
+        with open(path, 'r') as f:
+            header = read_plan_line(path, f.readline())
+            if header is None or header.get('plan_version') != PLAN_VERSION:
+                raise AssertionException("'%s' is not a plan file of version %d" % (path, PLAN_VERSION))
+            entry_count = 0
+            for line in f:
+                entry = read_plan_line(path, line)
+                if entry is None:
+                    continue
+                if entry.get('end'):
+                    if entry.get('entries') != entry_count:
+                        raise AssertionException("Plan file '%s' has %d changes, but its end line says %s" %
+                                                 (path, entry_count, entry.get('entries')))
+                    return
+                entry_count += 1
+                yield entry
+    except (IOError, OSError) as e:
+        raise AssertionException("Can't read plan file '%s': %s" % (path, e))
+    raise AssertionException("Plan file '%s' is incomplete: it was not written by a finished run" % path)
+
+
+def read_plan_line(path, line):
+    line = line.strip()
+    if not line:
+        return None
+    try:
+        return json.loads(line)
+    except ValueError as e:
+        raise AssertionException("Plan file '%s' has an unreadable line: %s" % (path, e))
+
+
+def apply_plan(path, umapi_connectors, logger):
+    """
+    Send the changes in a plan file.  The plan is read twice: once to check that it is
+    complete and that its organizations are all configured, and once to send the changes.
+    :type path: str
+    :type umapi_connectors: user_sync.rules.UmapiConnectors
+    :type logger: logging.Logger
+    :return: the number of each kind of change that was sent
+    :rtype: dict(str, int)
+    """
+    connectors = {None: umapi_connectors.get_primary_connector()}
+    connectors.update(umapi_connectors.get_secondary_connectors())
+
+    unknown_orgs = set()
+    for entry in read_plan(path):
+        if entry.get('org') not in connectors:
+            unknown_orgs.add(entry.get('org'))
+    if unknown_orgs:
+        raise AssertionException("Plan file '%s' has changes for unknown umapi connectors: %s" %
+                                 (path, sorted(unknown_orgs)))
+
+    for connector in six.itervalues(connectors):
+        if connector.user_cache is not None:
+            # keep the snapshot current as the changes are sent
+            connector.user_cache.load()
+
+    counts = {USER_ENTRY: 0, GROUP_USERS_ENTRY: 0, CREATE_GROUP_ENTRY: 0}
+    for entry in read_plan(path):
+        connector = connectors[entry['org']]
+        entry_type = entry['type']
+        if entry_type == USER_ENTRY:
+            connector.send_commands(Commands.from_dict(entry))
+        elif entry_type == GROUP_USERS_ENTRY:
+            if entry['add']:
+                connector.add_users_to_group(entry['group'], entry['users'])
+            else:
+                connector.remove_users_from_group(entry['group'], entry['users'])
+        elif entry_type == CREATE_GROUP_ENTRY:
+            logger.info("Creating user group '%s' on '%s'", entry['group'], entry['org'] or 'primary org')
+            try:
+                connector.create_group(entry['group'])
+            except Exception as e:
+                logger.critical("Unable to create user group '%s' on '%s' (error: %s)",
+                                entry['group'], entry['org'] or 'primary org', e)
+                continue
+        elif entry_type == FLUSH_ENTRY:
+            connector.flush_actions()
+            continue
+        else:
+            raise AssertionException("Plan file '%s' has a change of unknown type: %s" % (path, entry_type))
+        counts[entry_type] += 1
+    umapi_connectors.execute_actions()
+    return counts
@@ -20,26 +20,83 @@
 # SOFTWARE.
 
 import logging
+import marshal
+import operator
 import six
 import re
-from itertools import chain
+import threading
+import zlib
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from itertools import chain, compress
 
 import user_sync.connector.umapi
+import user_sync.connector.umapi_util
 import user_sync.error
+import user_sync.hook_cache
 import user_sync.identity_type
-from collections import defaultdict
+import user_sync.user_store
+from collections import defaultdict, deque, OrderedDict
+from user_sync.connector.helper import AdobeUser, DirectoryUser, SharedValues
 from user_sync.helper import normalize_string, CSVAdapter, JobStats
 
 GROUP_NAME_DELIMITER = '::'
 PRIMARY_UMAPI_NAME = None
 
 
+class UserKey(six.text_type):
+    """
+    The key that matches directory users with Adobe users: "id_type,username,domain", with the
+    domain left empty if the username is an email address.  Keys are strings, so they hash and
+    compare as cheaply as strings do, and can be looked up by their text.  They are only made
+    from parts that are already normalized, so the parts can be recovered without re-checking them.
+    Strings don't allow instance slots, so the parts are split out when asked for rather than
+    kept alongside the key; that keeps a key the same size as the string it replaces.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def make(cls, id_type, username, domain):
+        """
+        :type id_type: str (a parsed identity type)
+        :type username: str (normalized)
+        :type domain: str (normalized, or empty)
+        :rtype: UserKey
+        """
+        return cls(u','.join((six.text_type(id_type), six.text_type(username), six.text_type(domain))))
+
+    def get_parts(self):
+        """
+        :return: the identity type, username, and domain
+        :rtype: list
+        """
+        id_type, rest = self.split(u',', 1)
+        username, domain = rest.rsplit(u',', 1)
+        return [id_type, username, domain]
+
+    def get_identity_type(self):
+        return self[:self.index(u',')]
+
+    def get_username(self):
+        return self[self.index(u',') + 1:self.rindex(u',')]
+
+    def get_domain(self):
+        return self[self.rindex(u',') + 1:]
+
+
 class RuleProcessor(object):
+    # the directory attributes that are synced to adobe users
+    user_attribute_names = ('email', 'firstname', 'lastname')
+    # the directory attributes that after-mapping hooks can change
+    hook_attribute_names = ('email', 'username', 'domain', 'firstname', 'lastname', 'country')
+    # how many matched users have their attributes compared at once
+    matched_user_batch_size = 10000
     # rule processing option defaults
     # these are in alphabetical order!  Always add new ones that way!
     default_options = {
         'adobe_group_filter': None,
+        'after_mapping_batch_hook': None,
         'after_mapping_hook': None,
+        'bulk_group_threshold': None,
         'default_country_code': None,
         'delete_strays': False,
         'directory_group_filter': None,
@@ -49,28 +106,44 @@ class RuleProcessor(object):
         'exclude_strays': False,
         'exclude_users': [],
         'extended_attributes': None,
+        'hook_batch_size': None,
+        'hook_cache': None,
+        'hook_processes': 0,
         'process_groups': False,
+        'max_adobe_group_removals': None,
         'max_adobe_only_users': 200,
+        'max_adobe_users_created': None,
+        'max_adobe_users_updated': None,
+        'max_concurrent_requests': None,
+        'max_requests_per_second': None,
         'new_account_type': user_sync.identity_type.ENTERPRISE_IDENTITY_TYPE,
         'remove_strays': False,
+        'stop_at_max_adobe_only_users': False,
         'strategy': 'sync',
         'stray_list_input_path': None,
         'stray_list_output_path': None,
+        'sync_processes': 0,
         'test_mode': False,
         'update_user_info': False,
+        'user_store_directory': None,
         'username_filter_regex': None,
     }
 
-    def __init__(self, caller_options):
+    def __init__(self, caller_options, group_registry=None):
         """
         :type caller_options:dict
+        :type group_registry: AdobeGroupRegistry
         """
         options = dict(self.default_options)
         options.update(caller_options)
         self.options = options
+        self.group_registry = group_registry if group_registry is not None else AdobeGroupRegistry()
+        # the values the run's users have in common, which they share one copy of
+        self.shared_values = SharedValues()
         self.directory_user_by_user_key = {}
         self.filtered_directory_user_by_user_key = {}
         self.umapi_info_by_name = {}
+        self.additional_group_matcher = None
         # counters for action summary log
         self.action_summary = {
             # these are in alphabetical order!  Always add new ones that way!
@@ -91,6 +164,8 @@ class RuleProcessor(object):
         self.exclude_groups = self.normalize_groups(options['exclude_groups'])
         self.exclude_identity_types = options['exclude_identity_types']
         self.exclude_users = options['exclude_users']
+        self.user_exclusion_matcher = UserExclusionMatcher(self.exclude_identity_types, self.exclude_groups,
+                                                           self.exclude_users)
 
         # There's a big difference between how we handle the primary umapi,
         # and how we handle secondary umapis.  We care about all the (non-excluded)
@@ -112,8 +187,27 @@ class RuleProcessor(object):
         self.secondary_users_created = set()
         self.updated_user_keys = set()
 
+        # with a user store directory, the users and the larger sets of user keys are kept on disk
+        self.user_store = None
+        if options['user_store_directory']:
+            self.user_store = store = user_sync.user_store.ExternalUserStore(options['user_store_directory'], logger)
+            self.directory_user_by_user_key = user_sync.user_store.StoredDirectoryUsers(store)
+            self.filtered_directory_user_by_user_key = user_sync.user_store.StoredDirectoryUsers(store, selected=True)
+            self.included_user_keys = user_sync.user_store.StoredUserKeySet(store, 'included')
+            self.primary_users_created = user_sync.user_store.StoredUserKeySet(store, 'primary_created')
+            self.secondary_users_created = user_sync.user_store.StoredUserKeySet(store, 'secondary_created')
+            self.updated_user_keys = user_sync.user_store.StoredUserKeySet(store, 'updated')
+
+        # with sync processes, the adobe users are matched in worker processes, each of which
+        # handles the users whose keys hash to it; the pool is made when first needed
+        self.sync_processes = options['sync_processes']
+        self.shard_executor = None
+
         # stray key input path comes in, stray_list_output_path goes out
         self.stray_key_map = {}
+        # normalized identity types and domains for get_user_key, by their raw values
+        self.identity_type_cache = {}
+        self.domain_cache = {}
         if options['stray_list_input_path']:
             self.read_stray_key_map(options['stray_list_input_path'])
         self.stray_list_output_path = options['stray_list_output_path']
@@ -132,6 +226,21 @@ class RuleProcessor(object):
             self.will_manage_strays = False
             self.will_process_strays = False
 
+        # limits on the changes of each kind, checked as the changes are found.  Going over
+        # max_adobe_only_users normally just keeps the strays from being processed, so it only
+        # stops the run if that's asked for, and only when the strays are going to be acted on
+        self.create_limit = ChangeLimit('max_adobe_users_created', options['max_adobe_users_created'],
+                                        'Adobe users created')
+        self.update_limit = ChangeLimit('max_adobe_users_updated', options['max_adobe_users_updated'],
+                                        'Adobe users updated')
+        self.group_removal_limit = ChangeLimit('max_adobe_group_removals', options['max_adobe_group_removals'],
+                                               'Adobe users removed from groups')
+        self.stray_limit = ChangeLimit('max_adobe_only_users',
+                                       options['max_adobe_only_users']
+                                       if self.will_manage_strays and options['stop_at_max_adobe_only_users']
+                                       else None,
+                                       'Adobe-only users')
+
         # in/out variables for per-user after-mapping-hook code
         self.after_mapping_hook_scope = {
             # in: attributes retrieved from customer directory system (eg 'c', 'givenName')
@@ -171,31 +280,55 @@ class RuleProcessor(object):
         :type umapi_connectors: UmapiConnectors
         """
         logger = self.logger
-
-        self.prepare_umapi_infos()
-
-        if directory_connector is not None:
-            load_directory_stats = JobStats("Load from Directory", divider="-")
-            load_directory_stats.log_start(logger)
-            self.read_desired_user_groups(directory_groups, directory_connector)
-            load_directory_stats.log_end(logger)
-
-        for umapi_info in self.umapi_info_by_name.values():
-            self.validate_and_log_additional_groups(umapi_info)
-
-        umapi_stats = JobStats('Push to UMAPI' if self.push_umapi else 'Sync with UMAPI', divider="-")
-        umapi_stats.log_start(logger)
-        if directory_connector is not None:
-            # note: push mode is not supported because if it is, we won't have a list of groups
-            # that exist in the console.  we don't want to attempt to create groups that already exist
-            if self.options.get('process_groups') and not self.push_umapi and self.options.get('auto_create'):
-                self.create_umapi_groups(umapi_connectors)
-            self.sync_umapi_users(umapi_connectors)
-        if self.will_process_strays:
-            self.process_strays(umapi_connectors)
-        umapi_connectors.execute_actions()
-        umapi_stats.log_end(logger)
-        self.log_action_summary(umapi_connectors)
+        actions_executed = False
+        try:
+            self.prepare_umapi_infos()
+
+            if directory_connector is not None:
+                if not self.push_umapi and self.options['adobe_group_filter'] is None:
+                    self.prefetch_umapi_users(umapi_connectors)
+                load_directory_stats = JobStats("Load from Directory", divider="-")
+                load_directory_stats.log_start(logger)
+                self.read_desired_user_groups(directory_groups, directory_connector)
+                load_directory_stats.log_end(logger)
+
+            for umapi_info in self.umapi_info_by_name.values():
+                self.validate_and_log_additional_groups(umapi_info)
+
+            umapi_stats = JobStats('Push to UMAPI' if self.push_umapi else 'Sync with UMAPI', divider="-")
+            umapi_stats.log_start(logger)
+            if directory_connector is not None:
+                # note: push mode is not supported because if it is, we won't have a list of groups
+                # that exist in the console.  we don't want to attempt to create groups that already exist
+                if self.options.get('process_groups') and not self.push_umapi and self.options.get('auto_create'):
+                    self.create_umapi_groups(umapi_connectors)
+                self.sync_umapi_users(umapi_connectors)
+            if self.will_process_strays:
+                self.process_strays(umapi_connectors)
+            umapi_connectors.execute_actions()
+            actions_executed = True
+            umapi_stats.log_end(logger)
+            self.log_action_summary(umapi_connectors)
+        finally:
+            if not actions_executed:
+                umapi_connectors.drop_user_caches()
+            if self.shard_executor is not None:
+                self.shard_executor.shutdown()
+            if self.user_store is not None:
+                self.user_store.close()
+            self.shared_values.clear()
+
+    def prefetch_umapi_users(self, umapi_connectors):
+        """
+        Start reading the users of every organization we are going to sync, so that reading
+        them overlaps the directory load.  Secondaries are only read if groups are mapped to
+        them, which is the same test sync_umapi_users uses to decide whether to sync them.
+        :type umapi_connectors: UmapiConnectors
+        """
+        umapi_connectors.get_primary_connector().prefetch_users()
+        for umapi_name, umapi_connector in six.iteritems(umapi_connectors.get_secondary_connectors()):
+            if len(self.get_umapi_info(umapi_name).get_mapped_groups()) > 0:
+                umapi_connector.prefetch_users()
 
     def validate_and_log_additional_groups(self, umapi_info):
         """
@@ -289,6 +422,16 @@ class RuleProcessor(object):
             spacer = ''
             connectors = [('', umapi_connectors.get_primary_connector())]
 
+        # the rate limiter is shared by all connections, so it gets its own lines
+        limiter_summary = []
+        requests, throttled, rate, wait_time = user_sync.connector.umapi_util.get_rate_limiter().get_statistics()
+        if requests:
+            limiter_summary = [
+                ('Number of UMAPI requests (total, throttled)', '(%d, %d)' % (requests, throttled)),
+                ('UMAPI request rate limit (per second)', 'none' if rate is None else '%.1f' % rate),
+                ('Seconds waited for the UMAPI rate limit', '%.1f' % wait_time),
+            ]
+
         # to line up the stats, we pad them out to the longest stat description length,
         # so first we compute that pad length
         pad = 0
@@ -299,6 +442,8 @@ class RuleProcessor(object):
             umapi_summary_description = umapi_summary_format % (spacer, name)
             if len(umapi_summary_description) > pad:
                 pad = len(umapi_summary_description)
+        for description, _ in limiter_summary:
+            pad = max(pad, len(description))
 
         # do the report
         if self.options['test_mode']:
@@ -314,6 +459,8 @@ class RuleProcessor(object):
             sent, errors = umapi_connector.get_action_manager().get_statistics()
             description = (umapi_summary_format % (spacer, name)).rjust(pad, ' ')
             logger.info('  %s: (%s, %s, %s)', description, sent, sent - errors, errors)
+        for description, value in limiter_summary:
+            logger.info('  %s: %s', description.rjust(pad, ' '), value)
         logger.info('------------------------------------------------------------------------------------')
 
     def is_primary_org(self, umapi_info):
@@ -338,9 +485,9 @@ class RuleProcessor(object):
         """
         Make sure we have prepared organizations for all the mapped groups, including extensions.
         """
-        for adobe_group in AdobeGroup.iter_groups():
+        for adobe_group in self.group_registry.iter_groups():
             umapi_info = self.get_umapi_info(adobe_group.get_umapi_name())
-            umapi_info.add_mapped_group(adobe_group.get_group_name())
+            umapi_info.add_mapped_group(adobe_group)
 
     def read_desired_user_groups(self, mappings, directory_connector):
         """
@@ -361,11 +508,28 @@ class RuleProcessor(object):
         directory_groups = set(six.iterkeys(mappings)) if self.will_process_groups() else set()
         if directory_group_filter is not None:
             directory_groups.update(directory_group_filter)
+        # target groups by directory group set, for resolve_target_groups
+        resolutions = {}
+        # made when first needed, from the additional_groups rules
+        self.additional_group_matcher = None
+        hook_runner = None
+        if options['after_mapping_hook'] is not None or options['after_mapping_batch_hook'] is not None:
+            hook_cache = None
+            if options['hook_cache'] is not None:
+                hook_cache = user_sync.hook_cache.HookResultCache(
+                    options['hook_cache'], options['after_mapping_hook'] or options['after_mapping_batch_hook'],
+                    self.logger)
+                hook_cache.load()
+            hook_runner = AfterMappingHookRunner(options, self.after_mapping_hook_scope, self.apply_hook_result,
+                                                 self.log_after_mapping_hook_scope, self.logger, hook_cache)
         directory_users = directory_connector.load_users_and_groups(groups=directory_groups,
                                                                     extended_attributes=extended_attributes,
                                                                     all_users=directory_group_filter is None)
 
         for directory_user in directory_users:
+            if not isinstance(directory_user, DirectoryUser):
+                directory_user = DirectoryUser(directory_user)
+            directory_user.compact(self.shared_values)
             user_key = self.get_directory_user_key(directory_user)
             if not user_key:
                 self.logger.warning("Ignoring directory user with empty user key: %s", directory_user)
@@ -380,69 +544,136 @@ class RuleProcessor(object):
             filtered_directory_user_by_user_key[user_key] = directory_user
             self.get_umapi_info(PRIMARY_UMAPI_NAME).add_desired_group_for(user_key, None)
 
-            # set up groups in hook scope; the target groups will be used whether or not there's customer hook code
-            self.after_mapping_hook_scope['source_groups'] = set()
-            self.after_mapping_hook_scope['target_groups'] = set()
+            if hook_runner is None:
+                # without hook code, the target groups depend only on the directory groups
+                groups_by_umapi_info = self.resolve_target_groups(
+                    frozenset(directory_user['groups']), mappings, resolutions)
+                for umapi_info, groups in groups_by_umapi_info:
+                    umapi_info.add_desired_groups_for(user_key, groups)
+                self.add_additional_groups(user_key, directory_user)
+                self.store_selected_user(user_key, directory_user)
+                continue
+
+            # set up the hook's view of the user: the source data and the usual mapping results
+            source_groups = set()
+            target_groups = set()
             for group in directory_user['groups']:
-                self.after_mapping_hook_scope['source_groups'].add(group)  # this is a directory group name
+                source_groups.add(group)  # this is a directory group name
                 adobe_groups = mappings.get(group)
                 if adobe_groups is not None:
                     for adobe_group in adobe_groups:
-                        self.after_mapping_hook_scope['target_groups'].add(adobe_group.get_qualified_name())
-
-            # only if there actually is hook code: set up rest of hook scope, invoke hook, update user attributes
-            if options['after_mapping_hook'] is not None:
-                self.after_mapping_hook_scope['source_attributes'] = directory_user['source_attributes'].copy()
-
-                target_attributes = dict()
-                target_attributes['email'] = directory_user.get('email')
-                target_attributes['username'] = directory_user.get('username')
-                target_attributes['domain'] = directory_user.get('domain')
-                target_attributes['firstname'] = directory_user.get('firstname')
-                target_attributes['lastname'] = directory_user.get('lastname')
-                target_attributes['country'] = directory_user.get('country')
-                self.after_mapping_hook_scope['target_attributes'] = target_attributes
-
-                # invoke the customer's hook code
-                self.log_after_mapping_hook_scope(before_call=True)
-                exec(options['after_mapping_hook'], self.after_mapping_hook_scope)
-                self.log_after_mapping_hook_scope(after_call=True)
-
-                # copy modified attributes back to the user object
-                directory_user.update(self.after_mapping_hook_scope['target_attributes'])
-
-            for target_group_qualified_name in self.after_mapping_hook_scope['target_groups']:
-                target_group = AdobeGroup.lookup(target_group_qualified_name)
-                if target_group is not None:
-                    umapi_info = self.get_umapi_info(target_group.get_umapi_name())
-                    umapi_info.add_desired_group_for(user_key, target_group.get_group_name())
-                else:
-                    self.logger.error('Target adobe group %s is not known; ignored', target_group_qualified_name)
-
-            additional_groups = self.options.get('additional_groups', [])
-            member_groups = directory_user.get('member_groups', [])
-            for member_group in member_groups:
-                for group_rule in additional_groups:
-                    source = group_rule['source']
-                    target = group_rule['target']
-                    target_name = target.get_group_name()
-                    umapi_info = self.get_umapi_info(target.get_umapi_name())
-                    if not group_rule['source'].match(member_group):
-                        continue
-                    try:
-                        rename_group = source.sub(target_name, member_group)
-                    except Exception as e:
-                        raise user_sync.error.AssertionException("Additional group resolution error: {}".format(str(e)))
-                    umapi_info.add_mapped_group(rename_group)
-                    umapi_info.add_additional_group(rename_group, member_group)
-                    umapi_info.add_desired_group_for(user_key, rename_group)
+                        target_groups.add(adobe_group.get_qualified_name())
+            target_attributes = dict((name, directory_user.get(name)) for name in self.hook_attribute_names)
+            hook_runner.add(user_key, directory_user, {
+                'source_attributes': directory_user['source_attributes'].copy(),
+                'source_groups': source_groups,
+                'target_attributes': target_attributes,
+                'target_groups': target_groups,
+            })
+
+        if hook_runner is not None:
+            hook_runner.finish()
 
         self.logger.debug('Total directory users after filtering: %d', len(filtered_directory_user_by_user_key))
-        if self.logger.isEnabledFor(logging.DEBUG):
+        if self.logger.isEnabledFor(logging.DEBUG) and self.user_store is None:
             self.logger.debug('Group work list: %s', dict([(umapi_name, umapi_info.get_desired_groups_by_user_key())
                                                            for umapi_name, umapi_info
                                                            in six.iteritems(self.umapi_info_by_name)]))
 
+    def apply_hook_result(self, user_key, directory_user, target_attributes, target_groups):
+        """
+        Apply the after-mapping hook's results for one user.
+        :type user_key: str
+        :type directory_user: dict
+        :type target_attributes: dict
+        :type target_groups: set(str)
+        """
+        # copy modified attributes back to the user object
+        directory_user.update(target_attributes)
+
+        for target_group_qualified_name in target_groups:
+            target_group = self.group_registry.lookup(target_group_qualified_name)
+            if target_group is not None:
+                umapi_info = self.get_umapi_info(target_group.get_umapi_name())
+                umapi_info.add_desired_group_for(user_key, target_group)
+            else:
+                self.logger.error('Target adobe group %s is not known; ignored', target_group_qualified_name)
+
+        self.add_additional_groups(user_key, directory_user)
+        self.store_selected_user(user_key, directory_user)
+
+    def store_selected_user(self, user_key, directory_user):
+        """
+        When the users are kept in a user store, move a selected user whose mapped groups are
+        complete, and those groups, out of memory and into the store.
+        :type user_key: str
+        :type directory_user: dict
+        """
+        if self.user_store is None:
+            return
+        desired_groups = {}
+        for umapi_name, umapi_info in six.iteritems(self.umapi_info_by_name):
+            groups = umapi_info.get_desired_groups_by_user_key().pop(user_key, None)
+            if groups is not None:
+                desired_groups[umapi_name] = groups
+        self.filtered_directory_user_by_user_key.store_selected_user(user_key, directory_user, desired_groups)
+
+    def get_desired_groups_by_user_key(self, umapi_info):
+        """
+        :type umapi_info: UmapiTargetInfo
+        :return: the groups in the umapi for each selected user that has any there
+        :rtype: dict(str, set(str))
+        """
+        if self.user_store is None:
+            return umapi_info.get_desired_groups_by_user_key()
+        return user_sync.user_store.StoredUserGroups(self.user_store, umapi_info.get_name())
+
+    def resolve_target_groups(self, directory_groups, mappings, resolutions):
+        """
+        Find the Adobe groups that a set of directory groups maps to.  Many users share the
+        same set of directory groups, so each distinct set is only resolved once.
+        :type directory_groups: frozenset(str)
+        :type mappings: dict(str, list(AdobeGroup))
+        :type resolutions: dict
+        :return: the normalized target group names for each umapi
+        :rtype: list((UmapiTargetInfo, frozenset(str)))
+        """
+        resolution = resolutions.get(directory_groups)
+        if resolution is not None:
+            return resolution
+        target_names = set()
+        for group in directory_groups:
+            for adobe_group in mappings.get(group) or []:
+                target_names.add(adobe_group.get_qualified_name())
+        groups_by_umapi_name = defaultdict(set)
+        for target_group_qualified_name in target_names:
+            target_group = self.group_registry.lookup(target_group_qualified_name)
+            if target_group is not None:
+                groups_by_umapi_name[target_group.get_umapi_name()].add(target_group.normalized_name)
+            else:
+                self.logger.error('Target adobe group %s is not known; ignored', target_group_qualified_name)
+        resolution = [(self.get_umapi_info(umapi_name), frozenset(groups))
+                      for umapi_name, groups in six.iteritems(groups_by_umapi_name)]
+        resolutions[directory_groups] = resolution
+        return resolution
+
+    def add_additional_groups(self, user_key, directory_user):
+        """
+        Add the groups that the additional_groups rules derive from the user's member groups.
+        :type user_key: str
+        :type directory_user: dict
+        """
+        member_groups = directory_user.get('member_groups')
+        if not member_groups:
+            return
+        matcher = self.additional_group_matcher
+        if matcher is None:
+            self.additional_group_matcher = matcher = AdditionalGroupMatcher(
+                self.options.get('additional_groups') or [], self.get_umapi_info)
+        for member_group in member_groups:
+            for umapi_info, groups in matcher.resolve(member_group):
+                umapi_info.add_desired_groups_for(user_key, groups)
+
     def is_directory_user_in_groups(self, directory_user, groups):
         """
         :type directory_user: dict
@@ -469,6 +700,10 @@ class RuleProcessor(object):
         else:
             verb = "Sync"
         exclude_unmapped_users = self.will_exclude_unmapped_users()
+        # percentage limits on the changes to matched users are of the selected directory users
+        selected_user_count = len(self.filtered_directory_user_by_user_key)
+        for change_limit in (self.create_limit, self.update_limit, self.group_removal_limit):
+            change_limit.set_base(selected_user_count)
         # first sync the primary connector, so the users get created in the primary
         if umapi_connectors.get_secondary_connectors():
             self.logger.debug('%sing users to primary umapi...', verb)
@@ -476,14 +711,16 @@ class RuleProcessor(object):
             self.logger.debug('%sing users to umapi...', verb)
         umapi_info, umapi_connector = self.get_umapi_info(PRIMARY_UMAPI_NAME), umapi_connectors.get_primary_connector()
         if self.push_umapi:
-            primary_adds_by_user_key = umapi_info.get_desired_groups_by_user_key()
+            primary_adds_by_user_key = self.get_desired_groups_by_user_key(umapi_info)
         else:
-            primary_adds_by_user_key = self.update_umapi_users_for_connector(umapi_info, umapi_connector)
+            primary_adds_by_user_key = self.update_umapi_users(umapi_info, umapi_connector)
         for user_key, groups_to_add in six.iteritems(primary_adds_by_user_key):
             if exclude_unmapped_users and not groups_to_add:
                 # If user is not part of any group and ignore outcast is enabled. Do not create user.
                 continue
             # We always create every user in the primary umapi, because it's believed to own the directories.
+            if not self.push_umapi:
+                self.create_limit.add()
             self.logger.info('Creating user with user key: %s', user_key)
             self.primary_users_created.add(user_key)
             self.create_umapi_user(user_key, groups_to_add, umapi_info, umapi_connector)
@@ -495,12 +732,14 @@ class RuleProcessor(object):
                 continue
             self.logger.debug('%sing users to secondary umapi %s...', verb, umapi_name)
             if self.push_umapi:
-                secondary_adds_by_user_key = umapi_info.get_desired_groups_by_user_key()
+                secondary_adds_by_user_key = self.get_desired_groups_by_user_key(umapi_info)
             else:
-                secondary_adds_by_user_key = self.update_umapi_users_for_connector(umapi_info, umapi_connector)
+                secondary_adds_by_user_key = self.update_umapi_users(umapi_info, umapi_connector)
             for user_key, groups_to_add in six.iteritems(secondary_adds_by_user_key):
                 # We only create users who have group mappings in the secondary umapi
                 if groups_to_add:
+                    if not self.push_umapi:
+                        self.create_limit.add()
                     self.logger.info('Adding user to umapi %s with user key: %s', umapi_name, user_key)
                     self.secondary_users_created.add(user_key)
                     if user_key not in self.primary_users_created:
@@ -625,8 +864,8 @@ class RuleProcessor(object):
                 username = self.email_override[username]
             return user_sync.connector.umapi.Commands(identity_type=id_type, username=username, domain=domain)
 
-        # do the secondary umapis first, in case we are deleting user accounts from the primary umapi at the end
-        for umapi_name, umapi_connector in six.iteritems(umapi_connectors.get_secondary_connectors()):
+        def manage_secondary_strays(secondary):
+            umapi_name, umapi_connector = secondary
             secondary_strays = self.get_stray_keys(umapi_name)
             for user_key in primary_strays:
                 if user_key in secondary_strays:
@@ -651,8 +890,14 @@ class RuleProcessor(object):
                         # haven't done anything, don't send commands
                         continue
                     umapi_connector.send_commands(commands)
-            # make sure the commands for each umapi are executed before moving to the next
-            umapi_connector.get_action_manager().flush()
+            # make sure the commands for each umapi are executed before we report it as done
+            umapi_connector.flush_actions()
+
+        # do the secondary umapis first, in case we are deleting user accounts from the primary umapi at the end.
+        # The secondaries are independent of each other, so they are processed concurrently,
+        # but all of them must have finished before we touch the primary.
+        umapi_connectors.run_concurrently(manage_secondary_strays,
+                                          list(six.iteritems(umapi_connectors.get_secondary_connectors())))
 
         # finish with the primary umapi
         primary_connector = umapi_connectors.get_primary_connector()
@@ -677,13 +922,12 @@ class RuleProcessor(object):
                 continue
             primary_connector.send_commands(commands)
         # make sure the actions get sent
-        primary_connector.get_action_manager().flush()
+        primary_connector.flush_actions()
 
     def get_user_attributes(self, directory_user):
         attributes = {}
-        attributes['email'] = directory_user['email']
-        attributes['firstname'] = directory_user['firstname']
-        attributes['lastname'] = directory_user['lastname']
+        for key in self.user_attribute_names:
+            attributes[key] = directory_user[key]
         return attributes
 
     def get_identity_type_from_directory_user(self, directory_user):
@@ -759,8 +1003,12 @@ class RuleProcessor(object):
         :type umapi_connector: user_sync.connector.umapi.UmapiConnector
         """
         directory_user = self.directory_user_by_user_key[user_key]
+        username = directory_user['username']
         commands = self.create_umapi_commands_for_directory_user(directory_user, self.will_update_user_info(umapi_info),
                                                                  umapi_connector.trusted)
+        if self.user_store is not None and directory_user['username'] != username:
+            # later commands for the user have to see the changed username
+            self.directory_user_by_user_key[user_key] = directory_user
         if not commands:
             return
         if self.will_process_groups():
@@ -798,12 +1046,14 @@ class RuleProcessor(object):
                 self.logger.info('Managing groups in %s for user key: %s added: %s removed: %s',
                                  umapi_info.get_name(), user_key, groups_to_add, groups_to_remove)
 
-        if user_key in self.directory_user_by_user_key:
-            directory_user = self.directory_user_by_user_key[user_key]
+        directory_user = self.directory_user_by_user_key.get(user_key)
+        if directory_user is not None:
             identity_type = self.get_identity_type_from_directory_user(directory_user)
+            username = directory_user['username']
         else:
             directory_user = umapi_user
             identity_type = umapi_user.get('type')
+            username = None
 
         # if user has email-type username and it is different from email address, then we need to
         # override the username with email address
@@ -814,6 +1064,9 @@ class RuleProcessor(object):
                 directory_user['email'] = umapi_user['email']
                 attributes_to_update['username'] = umapi_user['username']
                 directory_user['username'] = umapi_user['email']
+            if self.user_store is not None and username is not None:
+                # later commands for the user have to see the changed directory user
+                self.directory_user_by_user_key[user_key] = directory_user
 
         commands = user_sync.connector.umapi.Commands(identity_type, directory_user['email'],
                                                       directory_user['username'], directory_user['domain'])
@@ -822,6 +1075,96 @@ class RuleProcessor(object):
         commands.add_groups(groups_to_add)
         umapi_connector.send_commands(commands)
 
+    def iter_umapi_users(self, umapi_info, umapi_connector):
+        """
+        :type umapi_info: UmapiTargetInfo
+        :type umapi_connector: user_sync.connector.umapi.UmapiConnector
+        :return: the adobe users to sync, which are only those in the adobe_group_filter groups if there are any
+        """
+        if self.options['adobe_group_filter'] is not None:
+            return self.get_umapi_user_in_groups(umapi_info, umapi_connector, self.options['adobe_group_filter'])
+        return umapi_connector.iter_users()
+
+    def update_umapi_users(self, umapi_info, umapi_connector):
+        """
+        Sync the adobe users of an organization, in worker processes if there are sync processes.
+        :type umapi_info: UmapiTargetInfo
+        :type umapi_connector: user_sync.connector.umapi.UmapiConnector
+        :return: the groups of the selected directory users to be created in the organization
+        :rtype: map(string, set)
+        """
+        if self.sync_processes:
+            return self.update_umapi_users_in_shards(umapi_info, umapi_connector)
+        return self.update_umapi_users_for_connector(umapi_info, umapi_connector)
+
+    def update_umapi_users_in_shards(self, umapi_info, umapi_connector):
+        """
+        Do the work of update_umapi_users_for_connector in worker processes.  The users are split
+        into shards by a hash of their user key, so a directory user and the adobe user with the
+        same key are always in the same shard.  Each worker matches and diffs the users of one
+        shard and makes the commands for their changes, while the users are read and the commands
+        sent here.  The workers' results are merged, so that the stray limits, the bulk group
+        threshold and the action summary all apply to the whole run rather than to one shard.
+        :type umapi_info: UmapiTargetInfo
+        :type umapi_connector: user_sync.connector.umapi.UmapiConnector
+        :rtype: map(string, set)
+        """
+        umapi_name = umapi_info.get_name()
+        shard_count = self.sync_processes
+        shards = [UserShard(umapi_name, umapi_info.get_mapped_groups(), umapi_connector.trusted)
+                  for _ in range(shard_count)]
+        desired_groups_by_user_key = umapi_info.get_desired_groups_by_user_key()
+        for user_key, directory_user in six.iteritems(self.directory_user_by_user_key):
+            shards[get_shard_index(user_key, shard_count)].directory_user_by_user_key[user_key] = directory_user
+        for user_key, directory_user in six.iteritems(self.filtered_directory_user_by_user_key):
+            shard = shards[get_shard_index(user_key, shard_count)]
+            shard.filtered_directory_user_by_user_key[user_key] = directory_user
+            if user_key in desired_groups_by_user_key:
+                shard.desired_groups_by_user_key[user_key] = desired_groups_by_user_key[user_key]
+        if not self.is_primary_org(umapi_info):
+            for user_key in self.included_user_keys:
+                shards[get_shard_index(user_key, shard_count)].included_user_keys.add(user_key)
+        for umapi_user in self.iter_umapi_users(umapi_info, umapi_connector):
+            user_key = self.get_umapi_user_key(umapi_user)
+            if not user_key:
+                self.logger.warning("Ignoring umapi user with empty user key: %s", umapi_user)
+                continue
+            shards[get_shard_index(user_key, shard_count)].umapi_users.append(umapi_user)
+
+        if self.shard_executor is None:
+            self.shard_executor = ProcessPoolExecutor(max_workers=shard_count)
+            self.logger.debug('Syncing users in %d processes', shard_count)
+        # the hook code isn't needed to sync, and can't be pickled
+        options = dict(self.options, after_mapping_hook=None, after_mapping_batch_hook=None,
+                       stray_list_input_path=None)
+        if self.will_process_strays:
+            self.add_stray(umapi_name, None)
+        user_to_group_map = {}
+        pending_group_changes = {}
+        for result in self.shard_executor.map(run_sync_shard, [options] * shard_count, shards):
+            # the limits apply to the whole run, so they are checked before the shard's commands are sent
+            self.update_limit.add(result.update_count)
+            self.group_removal_limit.add(result.group_removal_count)
+            if self.is_primary_org(umapi_info) and self.will_process_strays:
+                self.stray_limit.add(len(result.strays))
+            for commands in result.commands:
+                umapi_connector.send_commands(commands)
+            user_to_group_map.update(result.user_to_group_map)
+            pending_group_changes.update(result.pending_group_changes)
+            if self.will_process_strays:
+                self.stray_key_map[umapi_name].update(result.strays)
+            self.included_user_keys.update(result.included_user_keys)
+            self.updated_user_keys.update(result.updated_user_keys)
+            self.email_override.update(result.email_override)
+            self.primary_user_count += result.primary_user_count
+            self.excluded_user_count += result.excluded_user_count
+            for user_key, changes in six.iteritems(result.directory_user_changes):
+                self.directory_user_by_user_key[user_key].update(changes)
+        if pending_group_changes:
+            self.send_group_changes(umapi_info, umapi_connector, pending_group_changes)
+        umapi_info.set_umapi_users_loaded()
+        return user_to_group_map
+
     def update_umapi_users_for_connector(self, umapi_info, umapi_connector):
         """
         This is the main function that goes over adobe users and looks for and processes differences.
@@ -834,14 +1177,6 @@ class RuleProcessor(object):
         :type umapi_connector: user_sync.connector.umapi.UmapiConnector
         :rtype: map(string, set)
         """
-        filtered_directory_user_by_user_key = self.filtered_directory_user_by_user_key
-
-        # the way we construct the return vaue is to start with a map from all directory users
-        # to their groups in this umapi, make a copy, and pop off any adobe users we find.
-        # That way, any key/value pairs left in the map are the unmatched adobe users and their groups.
-        user_to_group_map = umapi_info.get_desired_groups_by_user_key()
-        user_to_group_map = {} if user_to_group_map is None else user_to_group_map.copy()
-
         # compute all static options before looping over users
         in_primary_org = self.is_primary_org(umapi_info)
         update_user_info = self.will_update_user_info(umapi_info)
@@ -851,40 +1186,48 @@ class RuleProcessor(object):
         if self.will_process_strays:
             self.add_stray(umapi_info.get_name(), None)
 
-        if self.options['adobe_group_filter'] is not None:
-            umapi_users = self.get_umapi_user_in_groups(umapi_info, umapi_connector, self.options['adobe_group_filter'])
+        # with a bulk group threshold, users whose only changes are to their groups are held back
+        # until all the adobe users have been seen, so that large changes to one group can be
+        # sent as group-level actions
+        pending_group_changes = {} if process_groups and self.options['bulk_group_threshold'] else None
+
+        # group memberships are compared as bitsets of interned group names
+        interner = umapi_info.get_group_interner()
+        mapped_bits = interner.get_bits(umapi_info.get_mapped_groups())
+        exclude_bits = interner.get_bits(self.exclude_groups) if in_primary_org else 0
+
+        # matched users whose attributes need comparing
+        matched_users = []
+
+        umapi_users = self.iter_umapi_users(umapi_info, umapi_connector)
+        if self.user_store is None:
+            # the way we construct the return vaue is to start with a map from all directory users
+            # to their groups in this umapi, make a copy, and pop off any adobe users we find.
+            # That way, any key/value pairs left in the map are the unmatched adobe users and their groups.
+            user_to_group_map = umapi_info.get_desired_groups_by_user_key()
+            user_to_group_map = {} if user_to_group_map is None else user_to_group_map.copy()
+            matched_umapi_users = self.match_umapi_users(umapi_info, umapi_users, user_to_group_map)
         else:
-            umapi_users = umapi_connector.iter_users()
+            # the unmatched directory users are recorded in the store as the users are merged
+            create_kind = 'create:%s' % (umapi_info.get_name() or '')
+            user_to_group_map = user_sync.user_store.StoredUserGroups(self.user_store, umapi_info.get_name(),
+                                                                      create_kind)
+            matched_umapi_users = self.merge_umapi_users(umapi_info, umapi_users, create_kind)
         # Walk all the adobe users, getting their group data, matching them with directory users,
         # and adjusting their attribute and group data accordingly.
-        for umapi_user in umapi_users:
-            # get the basic data about this user; initialize change markers to "no change"
-            user_key = self.get_umapi_user_key(umapi_user)
-            if not user_key:
-                self.logger.warning("Ignoring umapi user with empty user key: %s", umapi_user)
-                continue
-            if umapi_info.get_umapi_user(user_key) is not None:
-                self.logger.debug("Ignoring umapi user. This user has already been processed: %s", umapi_user)
-                continue
-            umapi_info.add_umapi_user(user_key, umapi_user)
+        for user_key, umapi_user, desired_groups, directory_user in matched_umapi_users:
+            # initialize change markers to "no change"
             attribute_differences = {}
-            current_groups = self.normalize_groups(umapi_user.get('groups'))
+            current_bits = interner.get_raw_bits(umapi_user.get('groups'))
             groups_to_add = set()
             groups_to_remove = set()
 
-            # If this adobe user matches any directory user, pop them out of the
-            # map because we know they don't need to be created.
-            # Also, keep track of the mapped groups for the directory user
-            # so we can update the adobe user's groups as needed.
-            desired_groups = user_to_group_map.pop(user_key, None) or set()
-
-            # check for excluded users
-            if self.is_umapi_user_excluded(in_primary_org, user_key, current_groups):
+            # check for excluded users (only the excluded groups matter to the check)
+            if self.is_umapi_user_excluded(in_primary_org, user_key, interner.get_names(current_bits & exclude_bits)):
                 continue
 
             self.map_email_override(umapi_user)
 
-            directory_user = filtered_directory_user_by_user_key.get(user_key)
             if directory_user is None:
                 # There's no selected directory user matching this adobe user
                 # so we mark this adobe user as a stray, and we mark him
@@ -895,27 +1238,197 @@ class RuleProcessor(object):
                 elif self.will_process_strays:
                     self.logger.debug("Found Adobe-only user: %s", user_key)
                     self.add_stray(umapi_info.get_name(), user_key,
-                                   None if not process_groups else current_groups & umapi_info.get_mapped_groups())
+                                   None if not process_groups else interner.get_names(current_bits & mapped_bits))
+                    if in_primary_org:
+                        self.stray_limit.add()
             else:
                 # There is a selected directory user who matches this adobe user,
                 # so mark any changed umapi attributes,
                 # and mark him for addition and removal of the appropriate mapped groups
                 if update_user_info or process_groups:
                     self.logger.debug("Adobe user matched on customer side: %s", user_key)
-                if update_user_info:
-                    attribute_differences = self.get_user_attribute_difference(directory_user, umapi_user)
                 if process_groups:
-                    groups_to_add = desired_groups - current_groups
-                    groups_to_remove = (current_groups - desired_groups) & umapi_info.get_mapped_groups()
+                    desired_bits = interner.get_bits(desired_groups) if desired_groups else 0
+                    groups_to_add = interner.get_names(desired_bits & ~current_bits)
+                    groups_to_remove = interner.get_names(current_bits & ~desired_bits & mapped_bits)
+                    if groups_to_remove:
+                        self.group_removal_limit.add()
+                if update_user_info:
+                    # attributes are compared for many matched users at once
+                    matched_users.append((user_key, directory_user, umapi_user, groups_to_add, groups_to_remove))
+                    if len(matched_users) >= self.matched_user_batch_size:
+                        self.send_matched_user_changes(umapi_info, umapi_connector, pending_group_changes,
+                                                       matched_users)
+                        matched_users = []
+                    continue
 
             # Finally, execute the attribute and group adjustments
-            self.update_umapi_user(umapi_info, user_key, umapi_connector,
-                                   attribute_differences, groups_to_add, groups_to_remove, umapi_user)
+            self.send_user_changes(umapi_info, umapi_connector, pending_group_changes, user_key, umapi_user,
+                                   attribute_differences, groups_to_add, groups_to_remove)
+
+        if matched_users:
+            self.send_matched_user_changes(umapi_info, umapi_connector, pending_group_changes, matched_users)
+
+        if pending_group_changes:
+            self.send_group_changes(umapi_info, umapi_connector, pending_group_changes)
 
         # mark the umapi's adobe users as processed and return the remaining ones in the map
         umapi_info.set_umapi_users_loaded()
         return user_to_group_map
 
+    def match_umapi_users(self, umapi_info, umapi_users, user_to_group_map):
+        """
+        Match the adobe users of a umapi with the directory users held in memory.
+        :type umapi_info: UmapiTargetInfo
+        :type umapi_users: iterable(dict)
+        :param user_to_group_map: the groups in this umapi of each directory user, from which matched
+        users are removed
+        :type user_to_group_map: dict(str, set(str))
+        :return: for each adobe user, its user key, the adobe user, and the groups and directory user
+        it matches (or None)
+        """
+        filtered_directory_user_by_user_key = self.filtered_directory_user_by_user_key
+        for umapi_user in umapi_users:
+            user_key = self.get_umapi_user_key(umapi_user)
+            if not user_key:
+                self.logger.warning("Ignoring umapi user with empty user key: %s", umapi_user)
+                continue
+            if umapi_info.get_umapi_user(user_key) is not None:
+                self.logger.debug("Ignoring umapi user. This user has already been processed: %s", umapi_user)
+                continue
+            umapi_user = AdobeUser(umapi_user).compact(self.shared_values)
+            umapi_info.add_umapi_user(user_key, umapi_user)
+            # If this adobe user matches any directory user, pop them out of the
+            # map because we know they don't need to be created.
+            # Also, keep track of the mapped groups for the directory user
+            # so we can update the adobe user's groups as needed.
+            desired_groups = user_to_group_map.pop(user_key, None)
+            yield user_key, umapi_user, desired_groups, filtered_directory_user_by_user_key.get(user_key)
+
+    def merge_umapi_users(self, umapi_info, umapi_users, create_kind):
+        """
+        Match the adobe users of a umapi with the directory users in the user store.  The adobe
+        users are first written to the store; then both sides are read back in user key order
+        and merged.  Selected directory users with groups in this umapi that match no adobe
+        user are added to the create_kind set in the store.
+        :type umapi_info: UmapiTargetInfo
+        :type umapi_users: iterable(dict)
+        :type create_kind: str
+        :return: for each adobe user, its user key, the adobe user, and the groups and directory user
+        it matches (or None), in user key order
+        """
+        store = self.user_store
+        umapi_name = umapi_info.get_name()
+        for umapi_user in umapi_users:
+            user_key = self.get_umapi_user_key(umapi_user)
+            if not user_key:
+                self.logger.warning("Ignoring umapi user with empty user key: %s", umapi_user)
+                continue
+            if not store.add_adobe_user(umapi_name, user_key, AdobeUser(umapi_user).compact(self.shared_values)):
+                self.logger.debug("Ignoring umapi user. This user has already been processed: %s", umapi_user)
+        merged_users = user_sync.user_store.merge_sorted(store.iter_adobe_users(umapi_name),
+                                                         store.iter_selected_users())
+        for user_key, umapi_user, selected_user in merged_users:
+            if selected_user is None:
+                yield user_key, umapi_user, None, None
+                continue
+            directory_user, desired_groups_by_umapi_name = selected_user
+            desired_groups = desired_groups_by_umapi_name.get(umapi_name)
+            if umapi_user is not None:
+                yield user_key, umapi_user, desired_groups, directory_user
+            elif desired_groups is not None:
+                store.add_user_key(create_kind, user_key)
+
+    def send_matched_user_changes(self, umapi_info, umapi_connector, pending_group_changes, matched_users):
+        """
+        Compare the attributes of a batch of matched users, and send their changes.
+        :type umapi_info: UmapiTargetInfo
+        :type umapi_connector: user_sync.connector.umapi.UmapiConnector
+        :param matched_users: for each user, its user key, directory user, adobe user, and groups to add and remove
+        :type matched_users: list(tuple)
+        """
+        all_attribute_differences = self.get_user_attribute_differences([m[1] for m in matched_users],
+                                                                         [m[2] for m in matched_users])
+        for (user_key, _, umapi_user, groups_to_add, groups_to_remove), attribute_differences in \
+                zip(matched_users, all_attribute_differences):
+            self.send_user_changes(umapi_info, umapi_connector, pending_group_changes, user_key, umapi_user,
+                                   attribute_differences or {}, groups_to_add, groups_to_remove)
+
+    def send_user_changes(self, umapi_info, umapi_connector, pending_group_changes, user_key, umapi_user,
+                          attribute_differences, groups_to_add, groups_to_remove):
+        """
+        Send the changes for one adobe user, unless they are group changes to be held back for send_group_changes.
+        """
+        if attribute_differences:
+            self.update_limit.add()
+        if (pending_group_changes is not None and not attribute_differences and
+                (groups_to_add or groups_to_remove) and self.get_group_action_user(umapi_user) is not None):
+            pending_group_changes[user_key] = (umapi_user, groups_to_add, groups_to_remove)
+        else:
+            self.update_umapi_user(umapi_info, user_key, umapi_connector,
+                                   attribute_differences, groups_to_add, groups_to_remove, umapi_user)
+
+    def send_group_changes(self, umapi_info, umapi_connector, pending_group_changes):
+        """
+        Send group changes held back by update_umapi_users_for_connector.  When at least
+        bulk_group_threshold users are added to (or removed from) the same group, that change
+        is sent as group-level actions; the remaining changes are sent per user as usual.
+        :type umapi_info: UmapiTargetInfo
+        :type umapi_connector: user_sync.connector.umapi.UmapiConnector
+        :type pending_group_changes: dict(str, tuple(dict, set(str), set(str)))
+        """
+        threshold = self.options['bulk_group_threshold']
+        users_by_added_group = defaultdict(list)
+        users_by_removed_group = defaultdict(list)
+        for user_key, (umapi_user, groups_to_add, groups_to_remove) in six.iteritems(pending_group_changes):
+            for group in groups_to_add:
+                users_by_added_group[group].append(user_key)
+            for group in groups_to_remove:
+                users_by_removed_group[group].append(user_key)
+        bulk_removes = {group: user_keys for group, user_keys in six.iteritems(users_by_removed_group)
+                        if len(user_keys) >= threshold}
+        bulk_adds = {group: user_keys for group, user_keys in six.iteritems(users_by_added_group)
+                     if len(user_keys) >= threshold}
+
+        for user_key, (umapi_user, groups_to_add, groups_to_remove) in six.iteritems(pending_group_changes):
+            groups_to_add = {group for group in groups_to_add if group not in bulk_adds}
+            groups_to_remove = {group for group in groups_to_remove if group not in bulk_removes}
+            self.updated_user_keys.add(user_key)
+            if groups_to_add or groups_to_remove:
+                self.update_umapi_user(umapi_info, user_key, umapi_connector,
+                                       None, groups_to_add, groups_to_remove, umapi_user)
+
+        for group, user_keys in sorted(six.iteritems(bulk_removes)):
+            self.logger.info('Removing %d users from group %s%s', len(user_keys), group, self.get_org_suffix(umapi_info))
+            self.logger.debug('Users removed from group %s: %s', group, user_keys)
+            umapi_connector.remove_users_from_group(
+                group, [self.get_group_action_user(pending_group_changes[user_key][0]) for user_key in user_keys])
+        for group, user_keys in sorted(six.iteritems(bulk_adds)):
+            self.logger.info('Adding %d users to group %s%s', len(user_keys), group, self.get_org_suffix(umapi_info))
+            self.logger.debug('Users added to group %s: %s', group, user_keys)
+            umapi_connector.add_users_to_group(
+                group, [self.get_group_action_user(pending_group_changes[user_key][0]) for user_key in user_keys])
+
+    @staticmethod
+    def get_group_action_user(umapi_user):
+        """
+        Group-level actions name their users without a domain or identity type, so only users
+        whose username is their email address can be named in them; any other user (such as an
+        Adobe ID, or a federated user with a separate username) has its group changes sent per user.
+        :type umapi_user: dict
+        :return: the name for the user in a group-level action, or None if there is none
+        :rtype: str
+        """
+        if umapi_user.get('type') == 'adobeID':
+            return None
+        username = umapi_user.get('username')
+        if not username or normalize_string(username) != normalize_string(umapi_user.get('email')):
+            return None
+        return umapi_user['email']
+
+    def get_org_suffix(self, umapi_info):
+        return '' if self.is_primary_org(umapi_info) else ' in %s' % umapi_info.get_name()
+
     def map_email_override(self, umapi_user):
         """
         for users with email-type usernames that don't match the email address, we need to add some
@@ -941,19 +1454,11 @@ class RuleProcessor(object):
             self.primary_user_count += 1
             # in the primary umapi, we actually check the exclusion conditions
             identity_type, username, domain = self.parse_user_key(user_key)
-            if identity_type in self.exclude_identity_types:
-                self.logger.debug("Excluding adobe user (due to type): %s", user_key)
+            reason = self.user_exclusion_matcher.match(identity_type, username, current_groups)
+            if reason is not None:
+                self.logger.debug("Excluding adobe user (due to %s): %s", reason, user_key)
                 self.excluded_user_count += 1
                 return True
-            if len(current_groups & self.exclude_groups) > 0:
-                self.logger.debug("Excluding adobe user (due to group): %s", user_key)
-                self.excluded_user_count += 1
-                return True
-            for re_ in self.exclude_users:
-                if re_.match(username):
-                    self.logger.debug("Excluding adobe user (due to name): %s", user_key)
-                    self.excluded_user_count += 1
-                    return True
             self.included_user_keys.add(user_key)
             return False
         else:
@@ -976,16 +1481,32 @@ class RuleProcessor(object):
 
 
     def get_user_attribute_difference(self, directory_user, umapi_user):
-        differences = {}
-        attributes = self.get_user_attributes(directory_user)
-        for key, value in six.iteritems(attributes):
-            umapi_value = umapi_user.get(key)
+        return self.get_user_attribute_differences([directory_user], [umapi_user])[0] or {}
+
+    def get_user_attribute_differences(self, directory_users, umapi_users):
+        """
+        Compare the attributes of matched directory and adobe users.  The comparison is done
+        one attribute at a time across all the users: each attribute's values are gathered into
+        aligned lists and compared with map(), so the per-value work runs in C rather than in a
+        Python loop over users, and only users with changes get a dict.  This is column-wise,
+        not vectorized (numpy isn't a dependency).
+        :type directory_users: list(dict)
+        :type umapi_users: list(dict) (in the same order as directory_users)
+        :return: for each pair of users, the changed directory attributes, or None if there are none
+        :rtype: list(dict)
+        """
+        differences = [None] * len(directory_users)
+        for key in self.user_attribute_names:
+            values = [directory_user[key] for directory_user in directory_users]
+            umapi_values = [umapi_user.get(key) for umapi_user in umapi_users]
             if key == 'email':
-                diff = normalize_string(value) != normalize_string(umapi_value)
+                changed = map(operator.ne, map(normalize_string, values), map(normalize_string, umapi_values))
             else:
-                diff = value != umapi_value
-            if diff:
-                differences[key] = value
+                changed = map(operator.ne, values, umapi_values)
+            for index in compress(range(len(values)), changed):
+                if differences[index] is None:
+                    differences[index] = {}
+                differences[index][key] = values[index]
         return differences
 
     def get_directory_user_key(self, directory_user):
@@ -1020,30 +1541,42 @@ class RuleProcessor(object):
         :return: string "id_type,username,domain" (or None)
         :rtype: str
         """
-        id_type = user_sync.identity_type.parse_identity_type(id_type)
-        email = normalize_string(email) if email else None
-        username = normalize_string(username) or email
-        domain = normalize_string(domain)
-
+        # identity types and domains come from a small set of values, so their normalized forms are cached
+        if id_type in self.identity_type_cache:
+            id_type = self.identity_type_cache[id_type]
+        else:
+            id_type = self.identity_type_cache[id_type] = user_sync.identity_type.parse_identity_type(id_type)
         if not id_type:
             return None
+        username = normalize_string(username)
         if not username:
-            return None
+            username = normalize_string(email) if email else None
+            if not username:
+                return None
         if username.find('@') >= 0:
-            domain = ""
-        elif not domain:
-            return None
-        return six.text_type(id_type) + u',' + six.text_type(username) + u',' + six.text_type(domain)
+            domain = u""
+        else:
+            if domain in self.domain_cache:
+                domain = self.domain_cache[domain]
+            else:
+                domain = self.domain_cache[domain] = normalize_string(domain)
+            if not domain:
+                return None
+        return UserKey.make(id_type, username, domain)
 
     def parse_user_key(self, user_key):
         """
         Returns the identity_type, username, and domain for the user.
         The domain part is empty except if the username is not an email address.
-        :rtype: tuple
+        :rtype: list
         """
+        if isinstance(user_key, UserKey):
+            return user_key.get_parts()
         return user_key.split(',')
 
     def get_username_from_user_key(self, user_key):
+        if isinstance(user_key, UserKey):
+            return user_key.get_username()
         return self.parse_user_key(user_key)[1]
 
     def read_stray_key_map(self, file_path, delimiter=None):
@@ -1122,6 +1655,8 @@ class RuleProcessor(object):
     def log_after_mapping_hook_scope(self, before_call=None, after_call=None):
         if (before_call is None and after_call is None) or (before_call is not None and after_call is not None):
             raise ValueError("Exactly one of 'before_call', 'after_call' must be passed (and not None)")
+        if not self.logger.isEnabledFor(logging.DEBUG):
+            return
         when = 'before' if before_call is not None else 'after'
         if before_call is not None:
             self.logger.debug('.')
@@ -1133,11 +1668,468 @@ class RuleProcessor(object):
             self.logger.debug('Hook storage, %s: %s', when, self.after_mapping_hook_scope['hook_storage'])
 
 
+class ChangeLimit(object):
+    """
+    A limit on how many changes of one kind a run makes.  The changes are counted as they are
+    found, and the run is stopped as soon as there are more than the limit allows, rather than
+    after all the users have been read.  A limit is either a count or a percentage; a percentage
+    limit only applies once the number it is a percentage of has been given to set_base.
+    """
+
+    def __init__(self, name, value, description):
+        """
+        :param name: the name of the setting the limit comes from
+        :type name: str
+        :param value: the count (int), the percentage (str ending in '%'), or None for no limit
+        :param description: what is counted, for the error message
+        :type description: str
+        """
+        self.name = name
+        self.value = value
+        self.description = description
+        self.is_percentage = isinstance(value, six.string_types) and '%' in value
+        self.limit = None if value is None or self.is_percentage else value
+        self.count = 0
+
+    def set_base(self, base):
+        """
+        :param base: the number that a percentage limit is a percentage of
+        :type base: int
+        """
+        if self.is_percentage:
+            self.limit = int(base * float(self.value.strip('%')) / 100)
+
+    def add(self, count=1):
+        self.count += count
+        if self.limit is not None and self.count > self.limit:
+            raise user_sync.error.AssertionException(
+                'Stopping the run: there are more %s (%d) than the %s setting (%s) allows' %
+                (self.description, self.count, self.name, self.value))
+
+
+def get_shard_index(user_key, shard_count):
+    """
+    :return: the shard that the user with this key belongs to, which is the same in every process
+    :rtype: int
+    """
+    return zlib.crc32(user_key.encode('utf-8')) % shard_count
+
+
+class UserShard(object):
+    """
+    The users of one shard, as sent to a worker process to be synced with one organization.
+    """
+
+    def __init__(self, umapi_name, mapped_groups, trusted):
+        """
+        :type umapi_name: str
+        :type mapped_groups: set(str)
+        :type trusted: bool
+        """
+        self.umapi_name = umapi_name
+        self.mapped_groups = mapped_groups
+        self.trusted = trusted
+        self.directory_user_by_user_key = {}
+        self.filtered_directory_user_by_user_key = {}
+        self.desired_groups_by_user_key = {}
+        self.included_user_keys = set()
+        self.umapi_users = []
+
+
+class ShardResult(object):
+    """
+    The results of syncing one shard of users, as sent back from a worker process.
+    """
+
+    def __init__(self, processor, connector, umapi_name, usernames):
+        """
+        :type processor: ShardRuleProcessor
+        :type connector: ShardUmapiConnector
+        :type umapi_name: str
+        :param usernames: the usernames of the directory users before the sync
+        :type usernames: dict(str, str)
+        """
+        self.commands = connector.commands
+        self.user_to_group_map = processor.user_to_group_map
+        self.pending_group_changes = processor.pending_group_changes
+        self.strays = processor.get_stray_keys(umapi_name)
+        self.included_user_keys = processor.included_user_keys
+        self.updated_user_keys = processor.updated_user_keys
+        self.email_override = processor.email_override
+        self.primary_user_count = processor.primary_user_count
+        self.excluded_user_count = processor.excluded_user_count
+        self.update_count = processor.update_limit.count
+        self.group_removal_count = processor.group_removal_limit.count
+        # syncing can change the username (and email) of a directory user, which later commands must see
+        self.directory_user_changes = {}
+        for user_key, directory_user in six.iteritems(processor.directory_user_by_user_key):
+            if directory_user['username'] != usernames[user_key]:
+                self.directory_user_changes[user_key] = {'username': directory_user['username'],
+                                                         'email': directory_user['email']}
+
+
+class ShardUmapiConnector(object):
+    """
+    Stands in for a umapi connector in a worker process: it has the shard's adobe users, and
+    keeps the commands it is sent so they can be sent by the real connector.
+    """
+
+    def __init__(self, umapi_users, trusted):
+        self.umapi_users = umapi_users
+        self.trusted = trusted
+        self.commands = []
+
+    def iter_users(self, in_group=None):
+        return iter(self.umapi_users)
+
+    def send_commands(self, commands):
+        self.commands.append(commands)
+
+
+class ShardRuleProcessor(RuleProcessor):
+    """
+    Syncs one shard of the users with an organization, in a worker process.  Group changes
+    that are held back for bulk actions are kept rather than sent, because whether a change
+    is big enough to be sent in bulk depends on the users of all the shards.
+    """
+
+    def __init__(self, options):
+        # the limits are checked against the changes of all the shards, as the results are merged
+        super(ShardRuleProcessor, self).__init__(dict(options, sync_processes=0, adobe_group_filter=None,
+                                                      max_adobe_users_created=None, max_adobe_users_updated=None,
+                                                      max_adobe_group_removals=None, max_adobe_only_users=None))
+        self.user_to_group_map = {}
+        self.pending_group_changes = {}
+
+    def send_group_changes(self, umapi_info, umapi_connector, pending_group_changes):
+        self.pending_group_changes.update(pending_group_changes)
+
+    def sync_shard(self, shard):
+        """
+        :type shard: UserShard
+        :rtype: ShardResult
+        """
+        self.directory_user_by_user_key = shard.directory_user_by_user_key
+        self.filtered_directory_user_by_user_key = shard.filtered_directory_user_by_user_key
+        self.included_user_keys = shard.included_user_keys
+        usernames = dict((user_key, directory_user['username'])
+                         for user_key, directory_user in six.iteritems(self.directory_user_by_user_key))
+        umapi_info = self.get_umapi_info(shard.umapi_name)
+        umapi_info.mapped_groups = shard.mapped_groups
+        umapi_info.desired_groups_by_user_key = shard.desired_groups_by_user_key
+        connector = ShardUmapiConnector(shard.umapi_users, shard.trusted)
+        self.user_to_group_map = self.update_umapi_users_for_connector(umapi_info, connector)
+        return ShardResult(self, connector, shard.umapi_name, usernames)
+
+
+def run_sync_shard(options, shard):
+    """
+    Sync one shard of the users, in a worker process.
+    :type options: dict
+    :type shard: UserShard
+    :rtype: ShardResult
+    """
+    return ShardRuleProcessor(options).sync_shard(shard)
+
+
+class UserExclusionMatcher(object):
+    """
+    Checks adobe users against the exclude_identity_types, exclude_groups and exclude_users
+    rules.  The exclude_users patterns are combined into a single regex, with a named group
+    around each pattern so that the rule which matched can still be reported.  Patterns that
+    can't be combined (e.g. because they use backreferences, which combining would renumber)
+    are checked one at a time after the combined regex.
+    """
+
+    backreference_pattern = re.compile(r'\\[1-9]|\(\?P=')
+
+    def __init__(self, identity_types, groups, user_patterns):
+        """
+        :type identity_types: list(str)
+        :param groups: normalized group names
+        :type groups: set(str)
+        :param user_patterns: compiled regexes, each anchored to match a whole username
+        :type user_patterns: list(re.Pattern)
+        """
+        self.identity_types = frozenset(identity_types)
+        self.groups = frozenset(groups)
+        self.user_patterns = list(user_patterns)
+        self.combined_pattern = None
+        self.separate_indexes = []
+        combinable = []
+        for index, pattern in enumerate(self.user_patterns):
+            if self.backreference_pattern.search(pattern.pattern) or pattern.flags != self.user_patterns[0].flags:
+                self.separate_indexes.append(index)
+            else:
+                combinable.append(index)
+        if len(combinable) > 1:
+            try:
+                self.combined_pattern = re.compile(
+                    '|'.join('(?P<rule%d>%s)' % (i, self.user_patterns[i].pattern) for i in combinable),
+                    self.user_patterns[combinable[0]].flags)
+            except (re.error, AssertionError, OverflowError):
+                # e.g. inline flags or too many groups for this python's regex engine
+                combinable = []
+        if self.combined_pattern is None:
+            self.separate_indexes = list(range(len(self.user_patterns)))
+
+    def match(self, identity_type, username, current_groups):
+        """
+        :type identity_type: str
+        :type username: str
+        :param current_groups: the user's normalized group names
+        :type current_groups: set(str)
+        :return: a description of the rule that excludes the user, or None if no rule does
+        :rtype: str
+        """
+        if identity_type in self.identity_types:
+            return 'type'
+        if current_groups and not self.groups.isdisjoint(current_groups):
+            return 'group'
+        if self.combined_pattern is not None:
+            match = self.combined_pattern.match(username)
+            if match:
+                index = int(match.lastgroup[len('rule'):])
+                return "name pattern '%s'" % self.user_patterns[index].pattern
+        for index in self.separate_indexes:
+            if self.user_patterns[index].match(username):
+                return "name pattern '%s'" % self.user_patterns[index].pattern
+        return None
+
+
+class AdditionalGroupMatcher(object):
+    """
+    Resolves a user's member groups to Adobe groups using the additional_groups rules.  The same
+    member groups turn up for many users, so each distinct member group is only run through the
+    rules once.  That first time, each resulting group is also recorded as a mapped group of its
+    umapi, along with the member group it came from (so conflicts can be reported).
+    """
+
+    def __init__(self, rules, get_umapi_info):
+        """
+        :param rules: the additional_groups rules, each a dict with a 'source' regex and a 'target' AdobeGroup
+        :type rules: list(dict)
+        :param get_umapi_info: returns the UmapiTargetInfo with a given name
+        """
+        self.rules = [(rule['source'], rule['target'].get_group_name(), rule['target'].get_umapi_name())
+                      for rule in rules]
+        self.get_umapi_info = get_umapi_info
+        self.resolved = {}
+
+    def resolve(self, member_group):
+        """
+        :type member_group: str
+        :return: for each umapi that the member group maps into, its info and the normalized group names
+        :rtype: list((UmapiTargetInfo, tuple(str)))
+        """
+        result = self.resolved.get(member_group)
+        if result is not None:
+            return result
+        groups_by_umapi_name = OrderedDict()
+        for source, target_name, umapi_name in self.rules:
+            if not source.match(member_group):
+                continue
+            try:
+                rename_group = source.sub(target_name, member_group)
+            except Exception as e:
+                raise user_sync.error.AssertionException("Additional group resolution error: {}".format(str(e)))
+            umapi_info = self.get_umapi_info(umapi_name)
+            umapi_info.add_mapped_group(rename_group)
+            umapi_info.add_additional_group(rename_group, member_group)
+            groups_by_umapi_name.setdefault(umapi_name, []).append(normalize_string(rename_group))
+        self.resolved[member_group] = result = [(self.get_umapi_info(umapi_name), tuple(groups))
+                                                for umapi_name, groups in six.iteritems(groups_by_umapi_name)]
+        return result
+
+
+class AfterMappingHookRunner(object):
+    """
+    Runs the after-mapping hook for directory users.  A per-user hook (after_mapping_hook) is
+    run for each user as it is added, unless hook_batch_size or hook_processes is set.  Then,
+    as with a batch hook (after_mapping_batch_hook), users are collected into chunks of
+    hook_batch_size users, and each chunk is handed to the hook code at once.  If hook_processes
+    is set, chunks are run in that many worker processes.  That is only correct for hooks that
+    don't rely on state carried between users, because each worker has its own hook_storage.
+    """
+
+    default_batch_size = 1000
+
+    def __init__(self, options, scope, apply_result, log_scope, logger, cache=None):
+        """
+        :type options: dict
+        :param scope: the hook's variables, when it is run in this process
+        :param apply_result: called with (user_key, directory_user, target_attributes, target_groups)
+        :param log_scope: called with before_call=True or after_call=True around a per-user call
+        :type logger: logging.Logger
+        :type cache: user_sync.hook_cache.HookResultCache
+        """
+        self.batch = options['after_mapping_batch_hook'] is not None
+        self.code = options['after_mapping_batch_hook'] if self.batch else options['after_mapping_hook']
+        self.processes = options['hook_processes'] or 0
+        self.batch_size = options['hook_batch_size']
+        if self.batch_size is None:
+            self.batch_size = self.default_batch_size if self.batch or self.processes else 1
+        self.scope = scope
+        self.apply_result = apply_result
+        self.log_scope = log_scope
+        self.logger = logger
+        self.cache = cache
+        self.pending = []
+        self.executor = None
+        self.running = deque()
+        self.marshaled_code = None
+        if self.processes:
+            # code objects can't be pickled, but they can be marshaled
+            self.marshaled_code = marshal.dumps(self.code)
+            self.executor = ProcessPoolExecutor(max_workers=self.processes)
+            logger.debug('Running the after-mapping hook in %d processes', self.processes)
+
+    def add(self, user_key, directory_user, hook_user):
+        """
+        :type user_key: str
+        :type directory_user: dict
+        :param hook_user: the hook's variables for this user
+        :type hook_user: dict
+        """
+        cache_key = None
+        if self.cache is not None:
+            # the key has to be taken before the hook changes the user's variables
+            cache_key = self.cache.get_key(hook_user)
+            result = self.cache.get(cache_key)
+            if result is not None:
+                self.apply_result(user_key, directory_user, *result)
+                return
+        self.pending.append((user_key, directory_user, hook_user, cache_key))
+        if len(self.pending) >= self.batch_size:
+            self.run_pending()
+
+    def finish(self):
+        try:
+            if self.pending:
+                self.run_pending()
+            while self.running:
+                self.apply_worker_results()
+            if self.cache is not None:
+                self.cache.save()
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
+
+    def run_pending(self):
+        chunk, self.pending = self.pending, []
+        hook_users = [hook_user for _, _, hook_user, _ in chunk]
+        if self.executor is None:
+            if self.batch:
+                results = run_batch_hook(self.code, self.scope, hook_users)
+            else:
+                results = []
+                for hook_user in hook_users:
+                    self.scope.update(hook_user)
+                    self.log_scope(before_call=True)
+                    exec(self.code, self.scope)
+                    self.log_scope(after_call=True)
+                    results.append((self.scope['target_attributes'], self.scope['target_groups']))
+            self.apply_results(chunk, results)
+            return
+        self.running.append((chunk, self.executor.submit(run_hook_in_worker, self.marshaled_code, self.batch,
+                                                         hook_users)))
+        # keep a couple of chunks queued for each worker, without holding every user's results
+        while len(self.running) > 2 * self.processes:
+            self.apply_worker_results()
+
+    def apply_worker_results(self):
+        chunk, future = self.running.popleft()
+        results, log_records = future.result()
+        # the hook's log messages are logged here, because a spawned worker has no log handlers
+        for record in log_records:
+            if self.logger.isEnabledFor(record.levelno):
+                self.logger.handle(record)
+        self.apply_results(chunk, results)
+
+    def apply_results(self, chunk, results):
+        for (user_key, directory_user, _, cache_key), (target_attributes, target_groups) in zip(chunk, results):
+            if cache_key is not None:
+                self.cache.put(cache_key, target_attributes, target_groups)
+            self.apply_result(user_key, directory_user, target_attributes, target_groups)
+
+
+def run_batch_hook(code, scope, hook_users):
+    """
+    Run batch hook code, which sees the users of a chunk as a list called users, each a dict of
+    the variables a per-user hook would see.
+    :return: the (target_attributes, target_groups) for each user
+    """
+    scope['users'] = hook_users
+    try:
+        exec(code, scope)
+    finally:
+        scope['users'] = None
+    return [(hook_user['target_attributes'], hook_user['target_groups']) for hook_user in hook_users]
+
+
+class LogRecordCollector(logging.Handler):
+    """
+    Keeps the log records of a worker process, so they can be sent back to the main process.
+    """
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.records = []
+
+    def emit(self, record):
+        # the message is formatted here, since its args and exception may not be picklable
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        self.records.append(record)
+
+    def take_records(self):
+        records, self.records = self.records, []
+        return records
+
+
+# the hook variables in a worker process, by hook code
+_worker_scopes = {}
+_worker_log_collector = LogRecordCollector()
+
+
+def run_hook_in_worker(marshaled_code, batch, hook_users):
+    """
+    Run marshaled hook code over a chunk of users in a worker process.
+    :return: the (target_attributes, target_groups) for each user, and the hook's log records
+    """
+    worker = _worker_scopes.get(marshaled_code)
+    if worker is None:
+        code = marshal.loads(marshaled_code)
+        # this logger isn't registered with logging, so its records only go to the collector
+        logger = logging.Logger('processor')
+        logger.addHandler(_worker_log_collector)
+        scope = {'logger': logger, 'hook_storage': None}
+        _worker_scopes[marshaled_code] = worker = (code, scope)
+    code, scope = worker
+    try:
+        if batch:
+            results = run_batch_hook(code, scope, hook_users)
+        else:
+            results = []
+            for hook_user in hook_users:
+                scope.update(hook_user)
+                exec(code, scope)
+                results.append((scope['target_attributes'], scope['target_groups']))
+    finally:
+        log_records = _worker_log_collector.take_records()
+    return results, log_records
+
+
 class UmapiConnectors(object):
-    def __init__(self, primary_connector, secondary_connectors):
+    def __init__(self, primary_connector, secondary_connectors, max_concurrent_requests=None):
         """
         :type primary_connector: user_sync.connector.umapi.UmapiConnector
         :type secondary_connectors: dict(str, user_sync.connector.umapi.UmapiConnector)
+        :type max_concurrent_requests: int
         """
         self.primary_connector = primary_connector
         self.secondary_connectors = secondary_connectors
@@ -1146,48 +2138,82 @@ class UmapiConnectors(object):
         connectors.extend(six.itervalues(secondary_connectors))
         self.connectors = connectors
 
+        # the cap on UMAPI requests in flight at once is shared by all the connectors
+        self.max_concurrent_requests = max_concurrent_requests
+        if max_concurrent_requests:
+            request_slots = threading.BoundedSemaphore(max_concurrent_requests)
+            for connector in connectors:
+                connector.get_action_manager().request_slots = request_slots
+
     def get_primary_connector(self):
         return self.primary_connector
 
     def get_secondary_connectors(self):
         return self.secondary_connectors
 
+    def run_concurrently(self, func, items):
+        """
+        Call func on each of the items, each in its own worker thread, and wait for all of them.
+        The first exception raised by any of the calls is re-raised here.
+        :type func: callable
+        :type items: list
+        """
+        if len(items) <= 1:
+            for item in items:
+                func(item)
+            return
+        with ThreadPoolExecutor(max_workers=len(items)) as executor:
+            futures = [executor.submit(func, item) for item in items]
+        for future in futures:
+            future.result()
+
     def execute_actions(self):
         while True:
-            had_work = False
-            for connector in self.connectors:
-                action_manager = connector.get_action_manager()
-                if action_manager.has_work():
-                    action_manager.flush()
-                    had_work = True
-            if not had_work:
+            busy_connectors = [connector for connector in self.connectors
+                               if connector.get_action_manager().has_work()]
+            if not busy_connectors:
                 break
+            self.run_concurrently(lambda connector: connector.get_action_manager().flush(), busy_connectors)
+        # everything has been sent, so let any background senders exit
+        for connector in self.connectors:
+            connector.get_action_manager().shutdown()
+            connector.save_user_cache()
+
+    def drop_user_caches(self):
+        for connector in self.connectors:
+            connector.drop_user_cache()
 
 
 class AdobeGroup(object):
-    index_map = {}
+    __slots__ = ('group_name', 'umapi_name', 'normalized_name', 'group_id')
 
-    def __init__(self, group_name, umapi_name, index=True):
+    def __init__(self, group_name, umapi_name, group_id=None):
         """
         :type group_name: str
         :type umapi_name: str
+        :type group_id: int
         """
         self.group_name = group_name
         self.umapi_name = umapi_name
-        if index:
-            AdobeGroup.index_map[(group_name, umapi_name)] = self
+        self.normalized_name = normalize_string(group_name)
+        # the group's index in its AdobeGroupRegistry, if it has been registered
+        self.group_id = group_id
 
     def __eq__(self, other):
-        return self.__dict__ == other.__dict__
+        return (isinstance(other, AdobeGroup) and
+                self.group_name == other.group_name and self.umapi_name == other.umapi_name)
 
     def __ne__(self, other):
         return not self.__eq__(other)
 
     def __hash__(self):
-        return hash(frozenset(self.__dict__))
+        return hash((self.group_name, self.umapi_name))
 
     def __str__(self):
-        return str(self.__dict__)
+        return str({'group_name': self.group_name, 'umapi_name': self.umapi_name})
+
+    def __repr__(self):
+        return "AdobeGroup(%r, %r)" % (self.group_name, self.umapi_name)
 
     def get_qualified_name(self):
         prefix = ""
@@ -1215,23 +2241,136 @@ class AdobeGroup(object):
         return group_name, umapi_name
 
     @classmethod
-    def lookup(cls, qualified_name):
-        return cls.index_map.get(cls._parse(qualified_name))
-
-    @classmethod
-    def create(cls, qualified_name, index=True):
+    def create(cls, qualified_name):
+        """
+        Parse a qualified name into a group that isn't registered with any run.
+        :type qualified_name: str
+        :rtype: AdobeGroup
+        """
         group_name, umapi_name = cls._parse(qualified_name)
-        existing = cls.index_map.get((group_name, umapi_name))
-        if existing:
-            return existing
-        elif len(group_name) > 0:
-            return cls(group_name, umapi_name, index)
-        else:
+        if len(group_name) > 0:
+            return cls(group_name, umapi_name)
+        return None
+
+
+class AdobeGroupRegistry(object):
+    """
+    The Adobe groups known to one run.  Each (umapi, group) pair is registered once and given
+    a small integer id, and qualified names are only parsed the first time they are seen.
+    """
+
+    def __init__(self):
+        self.groups = []
+        self.group_by_key = {}
+        self.group_by_qualified_name = {}
+
+    def create(self, qualified_name):
+        """
+        Return the registered group with the given qualified name, registering it if it's new.
+        :type qualified_name: str
+        :rtype: AdobeGroup
+        """
+        group = self.group_by_qualified_name.get(qualified_name)
+        if group is not None:
+            return group
+        group_name, umapi_name = AdobeGroup._parse(qualified_name)
+        if len(group_name) == 0:
             return None
+        group = self.group_by_key.get((group_name, umapi_name))
+        if group is None:
+            group = AdobeGroup(group_name, umapi_name, len(self.groups))
+            self.groups.append(group)
+            self.group_by_key[(group_name, umapi_name)] = group
+        self.group_by_qualified_name[qualified_name] = group
+        return group
 
-    @classmethod
-    def iter_groups(cls):
-        return six.itervalues(cls.index_map)
+    def lookup(self, qualified_name):
+        """
+        :type qualified_name: str
+        :rtype: AdobeGroup
+        """
+        group = self.group_by_qualified_name.get(qualified_name)
+        if group is None:
+            group = self.group_by_key.get(AdobeGroup._parse(qualified_name))
+            if group is not None:
+                self.group_by_qualified_name[qualified_name] = group
+        return group
+
+    def get(self, group_id):
+        """
+        :type group_id: int
+        :rtype: AdobeGroup
+        """
+        return self.groups[group_id]
+
+    def iter_groups(self):
+        return iter(self.groups)
+
+    def __len__(self):
+        return len(self.groups)
+
+
+class GroupInterner(object):
+    """
+    Interns normalized group names as bit positions, so that sets of groups can be held
+    and compared as ints.  Group names come from a small vocabulary, so the raw names are
+    cached as well and each distinct spelling is only normalized once.
+    """
+
+    def __init__(self):
+        self.names = []
+        self.bit_by_name = {}
+        self.bit_by_raw_name = {}
+
+    def get_bit(self, group_name):
+        """
+        :type group_name: str (normalized)
+        :rtype: int
+        """
+        bit = self.bit_by_name.get(group_name)
+        if bit is None:
+            bit = self.bit_by_name[group_name] = 1 << len(self.names)
+            self.names.append(group_name)
+        return bit
+
+    def get_bits(self, group_names):
+        """
+        :type group_names: iterable(str) (normalized)
+        :rtype: int
+        """
+        bits = 0
+        for group_name in group_names:
+            bits |= self.get_bit(group_name)
+        return bits
+
+    def get_raw_bits(self, group_names):
+        """
+        :type group_names: Optional(iterable(str)) (not normalized)
+        :rtype: int
+        """
+        bits = 0
+        if group_names is not None:
+            bit_by_raw_name = self.bit_by_raw_name
+            for group_name in group_names:
+                bit = bit_by_raw_name.get(group_name)
+                if bit is None:
+                    bit = bit_by_raw_name[group_name] = self.get_bit(normalize_string(group_name))
+                bits |= bit
+        return bits
+
+    def get_names(self, bits):
+        """
+        :type bits: int
+        :rtype: set(str)
+        """
+        names = set()
+        index = 0
+        while bits:
+            if bits & 1:
+                names.add(self.names[index])
+            bits >>= 1
+            index += 1
+        return names
 
 
 class UmapiTargetInfo(object):
@@ -1248,6 +2387,7 @@ class UmapiTargetInfo(object):
         self.stray_by_user_key = {}
         self.groups_added_by_user_key = {}
         self.groups_removed_by_user_key = {}
+        self.group_interner = GroupInterner()
 
         # keep track of auto-mapped additional groups for conflict tracking.
         # if feature is disabled, this dict will be empty
@@ -1258,11 +2398,14 @@ class UmapiTargetInfo(object):
 
     def add_mapped_group(self, group):
         """
-        :type group: str
+        :type group: str | AdobeGroup
         """
-        normalized_group_name = normalize_string(group)
-        self.mapped_groups.add(normalized_group_name)
-        self.non_normalize_mapped_groups.add(group)
+        if isinstance(group, AdobeGroup):
+            self.mapped_groups.add(group.normalized_name)
+            self.non_normalize_mapped_groups.add(group.group_name)
+        else:
+            self.mapped_groups.add(normalize_string(group))
+            self.non_normalize_mapped_groups.add(group)
 
     def add_additional_group(self, rename_group, member_group):
         normalized_rename_group = normalize_string(rename_group)
@@ -1275,6 +2418,9 @@ class UmapiTargetInfo(object):
     def get_mapped_groups(self):
         return self.mapped_groups
 
+    def get_group_interner(self):
+        return self.group_interner
+
     def get_non_normalize_mapped_groups(self):
         return self.non_normalize_mapped_groups
 
@@ -1291,14 +2437,26 @@ class UmapiTargetInfo(object):
     def add_desired_group_for(self, user_key, group):
         """
         :type user_key: str
-        :type group: Optional(str)
+        :type group: Optional(str | AdobeGroup)
         """
         desired_groups = self.get_desired_groups(user_key)
         if desired_groups is None:
             self.desired_groups_by_user_key[user_key] = desired_groups = set()
-        if group is not None:
-            normalized_group_name = normalize_string(group)
-            desired_groups.add(normalized_group_name)
+        if isinstance(group, AdobeGroup):
+            desired_groups.add(group.normalized_name)
+        elif group is not None:
+            desired_groups.add(normalize_string(group))
+
+    def add_desired_groups_for(self, user_key, groups):
+        """
+        Add groups whose names are already normalized.
+        :type user_key: str
+        :type groups: iterable(str)
+        """
+        desired_groups = self.get_desired_groups(user_key)
+        if desired_groups is None:
+            self.desired_groups_by_user_key[user_key] = desired_groups = set()
+        desired_groups.update(groups)
 
     def add_umapi_user(self, user_key, user):
         """
@@ -0,0 +1,530 @@
+# Copyright (c) 2016-2017 Adobe Inc.  All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+"""
+A local stand-in for the UMAPI and IMS servers, for load testing User Sync without Adobe.
+
+The stand-in serves a synthetic organization of users and groups over HTTPS, accepts the
+same query and action requests as UMAPI, and can add latency, throttle with 429 responses
+and fail some requests with 503 responses.  It keeps counts and timings of the requests
+it serves, which it reports when it is stopped and serves at /standin/stats.
+"""
+
+import json
+import logging
+import os
+import random
+import re
+import shutil
+import ssl
+import tempfile
+import threading
+import time
+
+import six
+from six.moves import BaseHTTPServer, socketserver
+from six.moves.urllib.parse import unquote, urlparse, parse_qs
+
+import user_sync.certgen
+
+
+class StandinPopulation(object):
+    """
+    The users and groups of the stand-in organization.
+
+    The synthetic users are generated from their index when they are read, so that large
+    populations don't need to be held in memory; only users that have been created, changed
+    or removed by actions are stored.
+    """
+
+    identity_types = {
+        'addAdobeID': 'adobeID',
+        'createEnterpriseID': 'enterpriseID',
+        'createFederatedID': 'federatedID',
+    }
+
+    def __init__(self, user_count, group_count, groups_per_user, domain='example.com'):
+        """
+        :type user_count: int
+        :type group_count: int
+        :type groups_per_user: int
+        :type domain: str
+        """
+        self.user_count = user_count
+        self.domain = domain
+        self.groups_per_user = min(groups_per_user, group_count)
+        self.base_group_names = ['Group %d' % i for i in range(group_count)]
+        self.groups = {name.lower(): name for name in self.base_group_names}
+        self.base_user_pattern = re.compile(r'^user(\d+)@' + re.escape(domain.lower()) + '$')
+        # users changed by actions, by key; removed users are None
+        self.changed_users = {}
+        # keys of users created by actions, in the order they were created
+        self.created_keys = []
+        self.version = 0
+        self.group_members = {}
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def get_key(user, domain=None):
+        user = user.lower()
+        if '@' in user or not domain:
+            return user
+        return user + '@' + domain.lower()
+
+    def get_base_user(self, index):
+        email = 'user%07d@%s' % (index, self.domain)
+        groups = [self.base_group_names[(index + i) % len(self.base_group_names)]
+                  for i in range(self.groups_per_user)]
+        return {'email': email, 'username': email, 'domain': self.domain, 'type': 'federatedID',
+                'firstname': 'First%d' % index, 'lastname': 'Last%d' % index, 'country': 'US',
+                'groups': groups, 'status': 'active'}
+
+    def get_base_index(self, key):
+        match = self.base_user_pattern.match(key)
+        if match:
+            index = int(match.group(1))
+            if index < self.user_count and key == 'user%07d@%s' % (index, self.domain.lower()):
+                return index
+        return None
+
+    def get_user(self, key):
+        """
+        :return: a copy of the user with the given key, or None if there is no such user
+        """
+        with self.lock:
+            if key in self.changed_users:
+                user = self.changed_users[key]
+                return None if user is None else dict(user, groups=list(user['groups']))
+            index = self.get_base_index(key)
+            return None if index is None else self.get_base_user(index)
+
+    def put_user(self, key, user):
+        """
+        :param user: the new user record, or None to remove the user
+        """
+        with self.lock:
+            if self.get_base_index(key) is None and key not in self.changed_users:
+                if user is None:
+                    return
+                self.created_keys.append(key)
+            self.changed_users[key] = user
+            self.version += 1
+
+    def get_position_count(self):
+        return self.user_count + len(self.created_keys)
+
+    def get_user_at(self, position):
+        if position < self.user_count:
+            key = 'user%07d@%s' % (position, self.domain.lower())
+            if key not in self.changed_users:
+                return self.get_base_user(position)
+        else:
+            key = self.created_keys[position - self.user_count]
+        return self.changed_users[key]
+
+    def get_users_page(self, page, page_size, group=None):
+        """
+        :return: the users on the given page, and the number of pages
+        """
+        with self.lock:
+            if group is None:
+                count = self.get_position_count()
+                users = [self.get_user_at(position)
+                         for position in range(page * page_size, min((page + 1) * page_size, count))]
+                users = [u for u in users if u is not None]
+            else:
+                members = self.get_group_members(group)
+                count = len(members)
+                users = members[page * page_size:(page + 1) * page_size]
+        return users, max((count + page_size - 1) // page_size, 1)
+
+    def get_group_members(self, group):
+        group = group.lower()
+        members, version = self.group_members.get(group, (None, None))
+        if version != self.version:
+            members = []
+            for position in range(self.get_position_count()):
+                user = self.get_user_at(position)
+                if user is not None and group in {g.lower() for g in user['groups']}:
+                    members.append(user)
+            self.group_members[group] = (members, self.version)
+        return members
+
+    def execute(self, action, test_only):
+        """
+        Run the commands in one action, stopping at the first command that fails.
+        :type action: dict
+        :type test_only: bool
+        :return: the failed step and error code and message, or None if all steps succeeded
+        """
+        with self.lock:
+            if 'usergroup' in action:
+                return self.execute_group_commands(action['usergroup'], action.get('do', []), test_only)
+            key = self.get_key(action.get('user', ''), action.get('domain'))
+            user = self.get_user(key)
+            error = None
+            for step, command in enumerate(action.get('do', [])):
+                name, params = next(six.iteritems(command))
+                result = self.execute_user_command(key, action, user, name, params)
+                if isinstance(result, tuple):
+                    error = (step,) + result
+                    break
+                user = result
+            if not test_only:
+                self.put_user(key, user)
+            return error
+
+    def execute_user_command(self, key, action, user, name, params):
+        """
+        :return: the user record after the command (None if there is no user),
+        or an error code and message if the command failed
+        """
+        if name in self.identity_types:
+            if user is not None:
+                option = params.get('option', 'errorIfAlreadyExists')
+                if option == 'errorIfAlreadyExists':
+                    return 'error.user.already_exists', 'User %s already exists' % key
+                if option == 'ignoreIfAlreadyExists':
+                    return user
+            else:
+                email = params.get('email') or action.get('user')
+                username = action.get('user') if name == 'createFederatedID' else email
+                user = {'email': email, 'username': username,
+                        'domain': action.get('domain') or email[email.index('@') + 1:],
+                        'type': self.identity_types[name], 'firstname': None, 'lastname': None,
+                        'country': None, 'groups': [], 'status': 'active'}
+            for attribute in ('firstname', 'lastname', 'country'):
+                if attribute in params:
+                    user[attribute] = params[attribute]
+            return user
+        if user is None:
+            return 'error.user.nonexistent', 'User %s does not exist' % key
+        if name == 'update':
+            for attribute in ('email', 'username', 'firstname', 'lastname', 'country'):
+                if attribute in params:
+                    user[attribute] = params[attribute]
+        elif name == 'add':
+            groups = list(self.groups.values()) if params == 'all' else \
+                [g for names in params.values() for g in names]
+            for group in groups:
+                if group.lower() not in self.groups:
+                    return 'error.group.not_found', 'Group %s was not found' % group
+            current = {g.lower() for g in user['groups']}
+            user['groups'] += [self.groups[g.lower()] for g in groups if g.lower() not in current]
+        elif name == 'remove':
+            if params == 'all':
+                user['groups'] = []
+            else:
+                removed = {g.lower() for names in params.values() for g in names}
+                user['groups'] = [g for g in user['groups'] if g.lower() not in removed]
+        elif name in ('removeFromOrg', 'removeFromDomain'):
+            return None
+        return user
+
+    def execute_group_commands(self, group, commands, test_only):
+        for step, command in enumerate(commands):
+            name, params = next(six.iteritems(command))
+            exists = group.lower() in self.groups
+            if name == 'createUserGroup':
+                if exists:
+                    if params.get('option') != 'ignoreIfAlreadyExists':
+                        return step, 'error.group.already_exists', 'Group %s already exists' % group
+                elif not test_only:
+                    self.groups[group.lower()] = group
+                    self.version += 1
+            elif not exists:
+                return step, 'error.group.not_found', 'Group %s was not found' % group
+            elif name == 'deleteUserGroup':
+                if not test_only:
+                    del self.groups[group.lower()]
+                    self.version += 1
+            elif name in ('add', 'remove') and 'user' in params:
+                for email in params['user']:
+                    key = self.get_key(email)
+                    user = self.get_user(key)
+                    if user is None:
+                        return step, 'error.user.nonexistent', 'User %s does not exist' % email
+                    if name == 'add':
+                        if group.lower() not in {g.lower() for g in user['groups']}:
+                            user['groups'].append(self.groups[group.lower()])
+                    else:
+                        user['groups'] = [g for g in user['groups'] if g.lower() != group.lower()]
+                    if not test_only:
+                        self.put_user(key, user)
+        return None
+
+    def get_groups(self):
+        with self.lock:
+            return sorted(self.groups.values())
+
+
+class StandinStats(object):
+    """
+    Counts and timings of the requests served, by kind of request.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.start_time = time.time()
+            self.requests = {}
+
+    def record(self, kind, status, duration):
+        with self.lock:
+            stats = self.requests.setdefault(kind, {'statuses': {}, 'durations': []})
+            stats['statuses'][status] = stats['statuses'].get(status, 0) + 1
+            stats['durations'].append(duration)
+
+    def get_summary(self):
+        with self.lock:
+            summary = {'elapsed': time.time() - self.start_time, 'requests': {}}
+            for kind, stats in six.iteritems(self.requests):
+                durations = sorted(stats['durations'])
+                summary['requests'][kind] = {
+                    'count': len(durations),
+                    'statuses': {str(status): count for status, count in six.iteritems(stats['statuses'])},
+                    'mean': sum(durations) / len(durations),
+                    'p50': self.percentile(durations, 50),
+                    'p95': self.percentile(durations, 95),
+                    'p99': self.percentile(durations, 99),
+                    'max': durations[-1],
+                }
+            return summary
+
+    @staticmethod
+    def percentile(durations, percent):
+        return durations[min(len(durations) * percent // 100, len(durations) - 1)]
+
+    def log_summary(self, logger):
+        summary = self.get_summary()
+        logger.info('Served requests for %.1f seconds', summary['elapsed'])
+        for kind, stats in sorted(six.iteritems(summary['requests'])):
+            statuses = ', '.join('%s: %d' % item for item in sorted(six.iteritems(stats['statuses'])))
+            logger.info('%s: %d requests (%s); seconds mean %.3f, p50 %.3f, p95 %.3f, p99 %.3f, max %.3f',
+                        kind, stats['count'], statuses, stats['mean'], stats['p50'], stats['p95'],
+                        stats['p99'], stats['max'])
+
+
+class StandinServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    An HTTPS server that answers IMS token requests and UMAPI requests from a StandinPopulation.
+    """
+    daemon_threads = True
+
+    def __init__(self, address, population, endpoint='/v2/usermanagement', page_size=200, latency=0.0,
+                 latency_jitter=0.0, rate_limit=0.0, retry_after=1, error_rate=0.0, seed=None,
+                 logger=None):
+        """
+        :type address: (str, int)
+        :type population: StandinPopulation
+        :param endpoint: the UMAPI endpoint path, as in the umapi connector's server settings
+        :param page_size: the number of users or groups in each query page
+        :param latency: seconds added to each UMAPI response
+        :param latency_jitter: up to this many more seconds are added at random to each UMAPI response
+        :param rate_limit: UMAPI requests per second allowed before 429 responses are returned (0 for no limit)
+        :param retry_after: the Retry-After seconds sent with 429 and 503 responses
+        :param error_rate: the fraction of UMAPI requests that get a 503 response
+        :param seed: seed for the random latency and errors, to make runs repeatable
+        :type logger: logging.Logger
+        """
+        BaseHTTPServer.HTTPServer.__init__(self, address, StandinRequestHandler)
+        self.population = population
+        self.endpoint = endpoint.rstrip('/')
+        self.page_size = page_size
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.rate_limit = rate_limit
+        self.retry_after = retry_after
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.random_lock = threading.Lock()
+        self.logger = logger or logging.getLogger('standin')
+        self.stats = StandinStats()
+        self.tokens = max(rate_limit, 1.0)
+        self.token_time = time.time()
+        self.token_lock = threading.Lock()
+        self.cert_dir = tempfile.mkdtemp()
+        key_file = os.path.join(self.cert_dir, 'private.key')
+        cert_file = os.path.join(self.cert_dir, 'certificate.crt')
+        user_sync.certgen.generate(key_file, cert_file, user_sync.certgen.get_subject_fields(True))
+        # PROTOCOL_TLS_SERVER is not in Python 2.7, where PROTOCOL_SSLv23 negotiates the same way
+        context = ssl.SSLContext(getattr(ssl, 'PROTOCOL_TLS_SERVER', ssl.PROTOCOL_SSLv23))
+        context.load_cert_chain(cert_file, key_file)
+        self.socket = context.wrap_socket(self.socket, server_side=True)
+
+    def server_close(self):
+        BaseHTTPServer.HTTPServer.server_close(self)
+        shutil.rmtree(self.cert_dir, ignore_errors=True)
+
+    def get_delay(self):
+        with self.random_lock:
+            return self.latency + self.random.uniform(0, self.latency_jitter)
+
+    def is_failure(self):
+        with self.random_lock:
+            return self.random.random() < self.error_rate
+
+    def take_token(self):
+        """
+        :return: whether the request is within the rate limit
+        """
+        if not self.rate_limit:
+            return True
+        with self.token_lock:
+            now = time.time()
+            self.tokens = min(self.tokens + (now - self.token_time) * self.rate_limit, max(self.rate_limit, 1.0))
+            self.token_time = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+class StandinRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    users_pattern = re.compile(r'^/users/([^/]+)/(\d+)/?(?:/(.+))?$')
+    groups_pattern = re.compile(r'^/groups/([^/]+)/(\d+)/?$')
+    user_groups_pattern = re.compile(r'^/([^/]+)/user-groups/?$')
+    action_pattern = re.compile(r'^/action/([^/]+)/?$')
+
+    def log_message(self, format, *args):
+        self.server.logger.debug('%s - %s', self.address_string(), format % args)
+
+    def do_GET(self):
+        self.handle_request()
+
+    def do_POST(self):
+        self.handle_request()
+
+    def handle_request(self):
+        start_time = time.time()
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if url.path.startswith('/standin/'):
+            self.handle_standin(url.path)
+            return
+        if url.path.startswith('/ims/'):
+            kind = 'ims'
+            status, content = 200, {'token_type': 'bearer', 'access_token': 'standin-token',
+                                    'expires_in': 24 * 60 * 60 * 1000}
+            headers = {}
+        else:
+            path = url.path[len(self.server.endpoint):] if url.path.startswith(self.server.endpoint) else url.path
+            kind, status, content, headers = self.handle_umapi(path, query, body)
+        # record before responding, so the stats include every response a client has seen
+        self.server.stats.record(kind, status, time.time() - start_time)
+        self.send_json(status, content, headers)
+
+    def handle_umapi(self, path, query, body):
+        """
+        :return: the kind of request, and the status, content and headers of the response
+        """
+        delay = self.server.get_delay()
+        if delay > 0:
+            time.sleep(delay)
+        if self.users_pattern.match(path):
+            kind = 'users'
+        elif self.groups_pattern.match(path) or self.user_groups_pattern.match(path):
+            kind = 'groups'
+        elif self.action_pattern.match(path) and self.command == 'POST':
+            kind = 'action'
+        else:
+            return 'unknown', 404, {'result': 'error', 'message': 'Not found'}, {}
+        retry_headers = {'Retry-After': str(self.server.retry_after)}
+        if not self.server.take_token():
+            return kind, 429, {'result': 'error', 'message': 'Too many requests'}, retry_headers
+        if self.server.is_failure():
+            return kind, 503, {'result': 'error', 'message': 'Service unavailable'}, retry_headers
+        if kind == 'action':
+            status, content = self.handle_actions(body, query.get('testOnly', ['false'])[0] == 'true')
+            return kind, status, content, {}
+        return (kind,) + self.handle_query(path, query)
+
+    def handle_query(self, path, query):
+        population = self.server.population
+        page_size = self.server.page_size
+        match = self.users_pattern.match(path)
+        if match:
+            page = int(match.group(2))
+            group = unquote(match.group(3)) if match.group(3) else None
+            if group is not None and group.lower() not in population.groups:
+                return 404, {'result': 'error', 'message': 'Group %s was not found' % group}, {}
+            values, page_count = population.get_users_page(page, page_size, group)
+            content = {'result': 'success', 'lastPage': page >= page_count - 1, 'users': values}
+        else:
+            match = self.groups_pattern.match(path)
+            page = int(match.group(2)) if match else int(query.get('page', ['1'])[0]) - 1
+            names = population.get_groups()
+            page_count = max((len(names) + page_size - 1) // page_size, 1)
+            names = names[page * page_size:(page + 1) * page_size]
+            if match:
+                content = {'result': 'success', 'lastPage': page >= page_count - 1,
+                           'groups': [{'groupName': name, 'type': 'USER_GROUP'} for name in names]}
+            else:
+                content = [{'name': name, 'type': 'USER_GROUP'} for name in names]
+        headers = {'X-Page-Count': str(page_count), 'X-Current-Page': str(page + 1),
+                   'X-Page-Size': str(page_size)}
+        return 200, content, headers
+
+    def handle_actions(self, body, test_only):
+        try:
+            actions = json.loads(body.decode('utf-8'))
+            if not isinstance(actions, list):
+                raise ValueError('expected a list of actions')
+        except ValueError as e:
+            return 400, {'result': 'error', 'message': 'Invalid request body: %s' % e}
+        errors = []
+        for index, action in enumerate(actions):
+            error = self.server.population.execute(action, test_only)
+            if error is not None:
+                step, code, message = error
+                errors.append({'index': index, 'step': step, 'requestID': action.get('requestID'),
+                               'errorCode': code, 'message': message})
+        completed = len(actions) - len(errors)
+        content = {'result': 'partial' if errors and completed else 'error' if errors else 'success',
+                   'completed': completed, 'notCompleted': len(errors),
+                   'completedInTestMode': completed if test_only else 0}
+        if errors:
+            content['errors'] = errors
+        return 200, content
+
+    def handle_standin(self, path):
+        if path == '/standin/stats':
+            self.send_json(200, self.server.stats.get_summary(), {})
+        elif path == '/standin/reset' and self.command == 'POST':
+            self.server.stats.reset()
+            self.send_json(200, {'result': 'success'}, {})
+        else:
+            self.send_json(404, {'result': 'error', 'message': 'Not found'}, {})
+
+    def send_json(self, status, content, headers):
+        data = json.dumps(content).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in six.iteritems(headers):
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
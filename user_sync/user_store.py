@@ -0,0 +1,338 @@
+# Copyright (c) 2016-2017 Adobe Inc.  All rights reserved.
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in all
+# copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+
+import os
+import sqlite3
+import tempfile
+
+import six
+from six.moves import cPickle as pickle
+
+from user_sync.error import AssertionException
+
+
+def dump_value(value):
+    return sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+
+def load_value(value):
+    return None if value is None else pickle.loads(bytes(value))
+
+
+def merge_sorted(left, right):
+    """
+    Join two iterators of (key, value) pairs that are both sorted by key, with unique keys.
+    :return: an iterator of (key, left_value, right_value), in key order, where the value from
+    a side that doesn't have the key is None
+    """
+    left = iter(left)
+    right = iter(right)
+    left_item = next(left, None)
+    right_item = next(right, None)
+    while left_item is not None or right_item is not None:
+        if right_item is None or (left_item is not None and left_item[0] < right_item[0]):
+            yield left_item[0], left_item[1], None
+            left_item = next(left, None)
+        elif left_item is None or right_item[0] < left_item[0]:
+            yield right_item[0], None, right_item[1]
+            right_item = next(right, None)
+        else:
+            yield left_item[0], left_item[1], right_item[1]
+            left_item = next(left, None)
+            right_item = next(right, None)
+
+
+class ExternalUserStore(object):
+    """
+    An on-disk store of the users in a sync, for directories too large to hold in memory.
+
+    The store is a temporary SQLite database with a table of directory users and a table of
+    Adobe users, both keyed by user key.  Because the tables are indexed by key, each side can
+    be read back in key order, which lets the two sides be matched with a merge join rather
+    than with in-memory lookups.  There is also a table of user key sets (such as the keys of
+    created users).  The database is removed when the store is closed.
+    """
+
+    # how many changes to make between commits
+    commit_interval = 10000
+
+    def __init__(self, directory, logger):
+        """
+        :param directory: the directory to create the database in
+        :type directory: str
+        :type logger: logging.Logger
+        """
+        self.logger = logger
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            handle, self.path = tempfile.mkstemp(prefix='user-sync-', suffix='.db', dir=directory)
+            os.close(handle)
+            self.connection = sqlite3.connect(self.path)
+        except (IOError, OSError, sqlite3.Error) as e:
+            raise AssertionException("Can't create user store in '%s': %s" % (directory, e))
+        self.connection.text_factory = six.text_type
+        cursor = self.connection.cursor()
+        # the database is thrown away after the run, so it doesn't need to survive a crash
+        cursor.execute('PRAGMA journal_mode = OFF')
+        cursor.execute('PRAGMA synchronous = OFF')
+        cursor.execute('PRAGMA temp_store = FILE')
+        cursor.execute('CREATE TABLE directory_users (user_key TEXT PRIMARY KEY, user BLOB, '
+                       'selected_user BLOB, desired_groups BLOB)')
+        cursor.execute('CREATE TABLE adobe_users (umapi_name TEXT, user_key TEXT, user BLOB, '
+                       'PRIMARY KEY (umapi_name, user_key))')
+        cursor.execute('CREATE TABLE user_keys (kind TEXT, user_key TEXT, PRIMARY KEY (kind, user_key))')
+        self.changes = 0
+        logger.info("Keeping users in external store: %s", self.path)
+
+    def changed(self):
+        self.changes += 1
+        if self.changes >= self.commit_interval:
+            self.connection.commit()
+            self.changes = 0
+
+    def add_directory_user(self, user_key, directory_user):
+        """
+        :type user_key: str
+        :type directory_user: dict
+        """
+        self.connection.execute('INSERT OR IGNORE INTO directory_users (user_key) VALUES (?)', (user_key,))
+        self.connection.execute('UPDATE directory_users SET user = ? WHERE user_key = ?',
+                                (dump_value(directory_user), user_key))
+        self.changed()
+
+    def add_selected_user(self, user_key, directory_user, desired_groups):
+        """
+        Record a selected directory user, along with the groups they should have in each umapi.
+        If the user key was already selected, the groups are added to the ones recorded for it.
+        :type user_key: str
+        :type directory_user: dict
+        :param desired_groups: normalized group names by umapi name
+        :type desired_groups: dict(str, set(str))
+        """
+        value = dump_value(directory_user)
+        row = self.connection.execute('SELECT desired_groups FROM directory_users WHERE user_key = ?',
+                                      (user_key,)).fetchone()
+        if row is None:
+            self.connection.execute('INSERT INTO directory_users VALUES (?, ?, ?, ?)',
+                                    (user_key, value, value, dump_value(desired_groups)))
+        else:
+            previous_groups = load_value(row[0])
+            if previous_groups:
+                for umapi_name, groups in six.iteritems(previous_groups):
+                    desired_groups.setdefault(umapi_name, set()).update(groups)
+            self.connection.execute('UPDATE directory_users SET user = ?, selected_user = ?, desired_groups = ? '
+                                    'WHERE user_key = ?', (value, value, dump_value(desired_groups), user_key))
+        self.changed()
+
+    def get_directory_user(self, user_key, selected=False):
+        """
+        :type user_key: str
+        :param selected: whether to only return selected users
+        :type selected: bool
+        :rtype: dict
+        """
+        column = 'selected_user' if selected else 'user'
+        row = self.connection.execute('SELECT %s FROM directory_users WHERE user_key = ?' % column,
+                                      (user_key,)).fetchone()
+        return None if row is None else load_value(row[0])
+
+    def count_directory_users(self, selected=False):
+        column = 'selected_user' if selected else 'user'
+        return self.connection.execute('SELECT COUNT(*) FROM directory_users WHERE %s IS NOT NULL' %
+                                       column).fetchone()[0]
+
+    def iter_selected_users(self):
+        """
+        :return: the selected directory users in user key order, as (user_key, (user, desired_groups))
+        """
+        cursor = self.connection.execute('SELECT user_key, selected_user, desired_groups FROM directory_users '
+                                         'WHERE selected_user IS NOT NULL ORDER BY user_key')
+        for user_key, user, desired_groups in cursor:
+            yield user_key, (load_value(user), load_value(desired_groups))
+
+    def add_adobe_user(self, umapi_name, user_key, umapi_user):
+        """
+        :type umapi_name: str
+        :type user_key: str
+        :type umapi_user: dict
+        :return: False if there is already an adobe user with this key in the umapi
+        :rtype: bool
+        """
+        cursor = self.connection.execute('INSERT OR IGNORE INTO adobe_users VALUES (?, ?, ?)',
+                                         (umapi_name or '', user_key, dump_value(umapi_user)))
+        self.changed()
+        return cursor.rowcount > 0
+
+    def iter_adobe_users(self, umapi_name):
+        """
+        :return: the adobe users of a umapi in user key order, as (user_key, user)
+        """
+        cursor = self.connection.execute('SELECT user_key, user FROM adobe_users WHERE umapi_name = ? '
+                                         'ORDER BY user_key', (umapi_name or '',))
+        for user_key, user in cursor:
+            yield user_key, load_value(user)
+
+    def add_user_key(self, kind, user_key):
+        self.connection.execute('INSERT OR IGNORE INTO user_keys VALUES (?, ?)', (kind, user_key))
+        self.changed()
+
+    def has_user_key(self, kind, user_key):
+        return self.connection.execute('SELECT 1 FROM user_keys WHERE kind = ? AND user_key = ?',
+                                       (kind, user_key)).fetchone() is not None
+
+    def count_user_keys(self, kind):
+        return self.connection.execute('SELECT COUNT(*) FROM user_keys WHERE kind = ?', (kind,)).fetchone()[0]
+
+    def iter_user_keys(self, kind):
+        cursor = self.connection.execute('SELECT user_key FROM user_keys WHERE kind = ? ORDER BY user_key', (kind,))
+        for row in cursor:
+            yield row[0]
+
+    def close(self):
+        self.connection.close()
+        try:
+            os.remove(self.path)
+        except OSError as e:
+            self.logger.warning("Can't remove user store '%s': %s", self.path, e)
+
+
+class StoredDirectoryUsers(object):
+    """
+    A view of the directory users in an ExternalUserStore, by user key.  It stands in for the
+    dicts of directory users that RuleProcessor keeps when the users are in memory.  Directory
+    users are written to the store as they are added.  Selected users are held in memory until
+    they are passed to store_selected_user, since their mapped groups are worked out after
+    they are selected.
+    """
+
+    def __init__(self, store, selected=False):
+        """
+        :type store: ExternalUserStore
+        :param selected: whether the view only has the selected users
+        :type selected: bool
+        """
+        self.store = store
+        self.selected = selected
+        self.pending = {}
+
+    def store_selected_user(self, user_key, directory_user, desired_groups):
+        """
+        Write a selected user held in memory to the store.
+        :type user_key: str
+        :type directory_user: dict
+        :param desired_groups: normalized group names by umapi name
+        :type desired_groups: dict(str, set(str))
+        """
+        self.pending.pop(user_key, None)
+        self.store.add_selected_user(user_key, directory_user, desired_groups)
+
+    def get(self, user_key, default=None):
+        directory_user = self.pending.get(user_key)
+        if directory_user is None:
+            directory_user = self.store.get_directory_user(user_key, self.selected)
+        return default if directory_user is None else directory_user
+
+    def __getitem__(self, user_key):
+        directory_user = self.get(user_key)
+        if directory_user is None:
+            raise KeyError(user_key)
+        return directory_user
+
+    def __setitem__(self, user_key, directory_user):
+        if self.selected:
+            self.pending[user_key] = directory_user
+        else:
+            self.store.add_directory_user(user_key, directory_user)
+
+    def __contains__(self, user_key):
+        return self.get(user_key) is not None
+
+    def __len__(self):
+        return self.store.count_directory_users(self.selected) + len(self.pending)
+
+
+class StoredUserKeySet(object):
+    """
+    A set of user keys kept in an ExternalUserStore.  It supports the set operations that
+    RuleProcessor uses on its sets of user keys.
+    """
+
+    def __init__(self, store, kind):
+        """
+        :type store: ExternalUserStore
+        :param kind: the name of the set in the store
+        :type kind: str
+        """
+        self.store = store
+        self.kind = kind
+
+    def add(self, user_key):
+        self.store.add_user_key(self.kind, user_key)
+
+    def __contains__(self, user_key):
+        return self.store.has_user_key(self.kind, user_key)
+
+    def __len__(self):
+        return self.store.count_user_keys(self.kind)
+
+    def __iter__(self):
+        return self.store.iter_user_keys(self.kind)
+
+
+class StoredUserGroups(object):
+    """
+    The selected users with groups in a umapi, and those groups.  Like the dicts it stands in
+    for, it can be iterated with six.iteritems.
+    """
+
+    def __init__(self, store, umapi_name, kind=None):
+        """
+        :type store: ExternalUserStore
+        :type umapi_name: str
+        :param kind: if given, only the users in this set of user keys in the store are included
+        :type kind: str
+        """
+        self.store = store
+        self.umapi_name = umapi_name
+        self.kind = kind
+
+    def items(self):
+        if self.kind is None:
+            users = self.store.iter_selected_users()
+        else:
+            users = merge_users(self.store.iter_user_keys(self.kind), self.store.iter_selected_users())
+        for user_key, (directory_user, desired_groups) in users:
+            groups = desired_groups.get(self.umapi_name)
+            if groups is not None:
+                yield user_key, groups
+
+    iteritems = items
+
+
+def merge_users(user_keys, users):
+    """
+    :param user_keys: sorted user keys
+    :param users: (user_key, value) pairs sorted by user key, which include all of user_keys
+    :return: the (user_key, value) pairs whose keys are in user_keys
+    """
+    for user_key, listed, value in merge_sorted(((user_key, True) for user_key in user_keys), users):
+        if listed:
+            yield user_key, value